@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+# the runtime resolves resources/, sessions/ and logs/ against the working directory
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_PATH)
+
+from benchmarks.cases import CASES
+from benchmarks.harness import compare
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("cases", nargs="*", help="cases to run, all of them by default")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the iteration counts")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--baseline", help="json results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 growth over the baseline")
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix="subot-bench-")
+    shutil.copytree(os.path.join(REPOSITORY_PATH, "resources"), os.path.join(work_path, "resources"))
+    os.chdir(work_path)
+
+    results = list()
+    try:
+        for name, case, iterations in CASES:
+            if len(args.cases) != 0 and name not in args.cases:
+                continue
+            result = case(max(1, int(iterations * args.scale)))
+            results.append(result.to_dict())
+            print(f"{result.name:40} {result.throughput:12.1f} ops/s  p50 {result.percentile(50) * 1e6:10.1f}us  "
+                  f"p99 {result.percentile(99) * 1e6:10.1f}us", file=sys.stderr)
+    finally:
+        os.chdir(REPOSITORY_PATH)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output is not None:
+        out_stream = open(args.output, "w", encoding="utf-8")
+        json.dump(report, out_stream, indent=2)
+        out_stream.close()
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline is not None:
+        in_stream = open(args.baseline, "r", encoding="utf-8")
+        baseline = json.load(in_stream)
+        in_stream.close()
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            print("regression: " + regression, file=sys.stderr)
+        if len(regressions) != 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
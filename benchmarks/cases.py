@@ -0,0 +1,298 @@
+import os
+import shutil
+import typing
+
+import telegram
+
+import startup
+from resources.designer import Resources as R
+from runtime.commands import ModelCommandBase
+from runtime.dependency_injection import ServiceCollection, ServiceEngine
+from runtime.logging import Logger
+from runtime.pipeline import ContextFactory
+from runtime.replay import ReplayRunner, WIZARD_STEPS, callback_update, message_update, wizard_updates
+from runtime.resources import Resources, XmlResourceParser
+from runtime.session import CachedSessionStorage, FileSessionStorage, LogSessionStorage, SqliteSessionStorage
+from runtime.session_codec import CompactSessionCodec, ISessionCodec, PickleSessionCodec
+
+from benchmarks.harness import BenchmarkResult, Operation, measure
+
+
+def _services() -> ServiceCollection:
+    services = ServiceCollection()
+    startup.Startup().configure_services(services)
+    return services
+
+
+def di_singleton(iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        engine = ServiceEngine(_services().services)
+
+        def operation(index: int):
+            engine.get_or_create_instance(Logger)
+        return operation
+    return measure("di.get_or_create_instance.singleton", prepare, iterations, warmup=1)
+
+
+def di_scoped(iterations: int) -> BenchmarkResult:
+    # a new session id per call, so every call builds the scoped graph
+    def prepare() -> Operation:
+        engine = ServiceEngine(_services().services)
+
+        def operation(index: int):
+            engine.get_or_create_instance(ModelCommandBase, index)
+        return operation
+    return measure("di.get_or_create_instance.scoped", prepare, iterations, warmup=1)
+
+
+def resources_get_string(iterations: int) -> BenchmarkResult:
+    names = [value for key, value in vars(R.Strings).items() if not key.startswith("_")
+             and value != R.Strings.CATEGORIES]
+
+    def prepare() -> Operation:
+        resources = Resources(XmlResourceParser())
+        resources.configuration = "en"
+
+        def operation(index: int):
+            resources.get_string(names[index % len(names)])
+        return operation
+    return measure("resources.get_string", prepare, iterations, warmup=1)
+
+
+def resources_get_string_fallback(iterations: int) -> BenchmarkResult:
+    # a regional configuration that resolves through ru-ru -> ru -> default
+    names = [value for key, value in vars(R.Strings).items() if not key.startswith("_")
+             and value != R.Strings.CATEGORIES]
+
+    def prepare() -> Operation:
+        resources = Resources(XmlResourceParser())
+        resources.configuration = "ru-RU"
+
+        def operation(index: int):
+            resources.get_string(names[index % len(names)])
+        return operation
+    return measure("resources.get_string.fallback", prepare, iterations, warmup=1)
+
+
+def resources_get_model(iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        resources = Resources(XmlResourceParser())
+        resources.configuration = "en"
+
+        def operation(index: int):
+            resources.get_model(R.Models.NEW_REQUEST)
+        return operation
+    return measure("resources.get_model", prepare, iterations, warmup=1)
+
+
+def _session_data() -> typing.Dict[str, typing.Union[str, int]]:
+    return {"__model__": "new_request", "__property__": "description", "title": "Title" * 10,
+            "description": "Description" * 40, "__message_id__": 42}
+
+
+def _model_session_data() -> typing.Dict[str, typing.Union[str, int, bool]]:
+    # what CommandsModelMiddleware leaves in a session halfway through a model
+    return {"__current_command__": "new_request", "__current_state__": "prop_set", "__stage__": "enter_val",
+            "__mode__": "auto", "__prop_index__": 1, "__holding__": 0, "__property_title": "Title",
+            "__property_description": "Description" * 4, "__property_urgent": True, "__message_id__": 12345}
+
+
+def _codec_encode(name: str, codec: ISessionCodec, iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        data = _model_session_data()
+
+        def operation(index: int):
+            codec.encode(data)
+        return operation
+    return measure(f"session.codec.{name}.encode", prepare, iterations)
+
+
+def _codec_decode(name: str, codec: ISessionCodec, iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        content = codec.encode(_model_session_data())
+
+        def operation(index: int):
+            codec.decode(content)
+        return operation
+    return measure(f"session.codec.{name}.decode", prepare, iterations)
+
+
+def codec_pickle_encode(iterations: int) -> BenchmarkResult:
+    return _codec_encode("pickle", PickleSessionCodec(), iterations)
+
+
+def codec_pickle_decode(iterations: int) -> BenchmarkResult:
+    return _codec_decode("pickle", PickleSessionCodec(), iterations)
+
+
+def codec_compact_encode(iterations: int) -> BenchmarkResult:
+    return _codec_encode("compact", CompactSessionCodec(), iterations)
+
+
+def codec_compact_decode(iterations: int) -> BenchmarkResult:
+    return _codec_decode("compact", CompactSessionCodec(), iterations)
+
+
+def session_commit(iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        shutil.rmtree("sessions/", ignore_errors=True)
+        storage = FileSessionStorage()
+        data = _session_data()
+
+        def operation(index: int):
+            storage.commit(index % 1000, data)
+        return operation
+    return measure("session.file_storage.commit", prepare, iterations)
+
+
+def session_load(iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        shutil.rmtree("sessions/", ignore_errors=True)
+        storage = FileSessionStorage()
+        data = _session_data()
+        for identifier in range(1000):
+            storage.commit(identifier, data)
+
+        def operation(index: int):
+            storage.load(index % 1000)
+        return operation
+    return measure("session.file_storage.load", prepare, iterations)
+
+
+def session_cached_roundtrip(iterations: int) -> BenchmarkResult:
+    # load and commit of one update through the write-behind cache, flushing is left to its thread
+    def prepare() -> Operation:
+        shutil.rmtree("sessions/", ignore_errors=True)
+        storage = CachedSessionStorage(FileSessionStorage())
+        data = _session_data()
+
+        def operation(index: int):
+            storage.load(index % 1000)
+            storage.commit(index % 1000, data)
+        return operation
+    return measure("session.cached_storage.roundtrip", prepare, iterations)
+
+
+def session_sqlite_commit(iterations: int) -> BenchmarkResult:
+    # commits are grouped by the writer thread, the operation pays for pickling and the handoff
+    def prepare() -> Operation:
+        for path in ("sessions.db", "sessions.db-wal", "sessions.db-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        storage = SqliteSessionStorage()
+        data = _session_data()
+
+        def operation(index: int):
+            storage.commit(index % 1000, data)
+        return operation
+    return measure("session.sqlite_storage.commit", prepare, iterations)
+
+
+def session_sqlite_load(iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        for path in ("sessions.db", "sessions.db-wal", "sessions.db-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        storage = SqliteSessionStorage()
+        data = _session_data()
+        storage.commit_many([(identifier, data) for identifier in range(1000)])
+
+        def operation(index: int):
+            storage.load(index % 1000)
+        return operation
+    return measure("session.sqlite_storage.load", prepare, iterations)
+
+
+def _session_log_commit(name: str, codec: typing.Optional[ISessionCodec], iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        shutil.rmtree("sessions-log/", ignore_errors=True)
+        storage = LogSessionStorage(codec=codec)
+        data = _session_data()
+
+        def operation(index: int):
+            storage.commit(index % 1000, data)
+        return operation
+    return measure(name, prepare, iterations)
+
+
+def _session_log_load(name: str, codec: typing.Optional[ISessionCodec], iterations: int) -> BenchmarkResult:
+    def prepare() -> Operation:
+        shutil.rmtree("sessions-log/", ignore_errors=True)
+        storage = LogSessionStorage(codec=codec)
+        data = _session_data()
+        storage.commit_many([(identifier, data) for identifier in range(1000)])
+
+        def operation(index: int):
+            storage.load(index % 1000)
+        return operation
+    return measure(name, prepare, iterations)
+
+
+def session_log_commit(iterations: int) -> BenchmarkResult:
+    return _session_log_commit("session.log_storage.commit", None, iterations)
+
+
+def session_log_load(iterations: int) -> BenchmarkResult:
+    return _session_log_load("session.log_storage.load", None, iterations)
+
+
+def session_log_commit_compact(iterations: int) -> BenchmarkResult:
+    # the same store with the compact codec, what the smaller records cost in encoding time
+    return _session_log_commit("session.log_storage.compact.commit", CompactSessionCodec(), iterations)
+
+
+def session_log_load_compact(iterations: int) -> BenchmarkResult:
+    return _session_log_load("session.log_storage.compact.load", CompactSessionCodec(), iterations)
+
+
+def request_parsing(iterations: int) -> BenchmarkResult:
+    updates: typing.List[telegram.Update] = list()
+    for index, (kind, text) in enumerate(WIZARD_STEPS):
+        if kind == "message":
+            updates.append(message_update(index, 1, text))
+        else:
+            updates.append(callback_update(index, 1, text, index))
+
+    def prepare() -> Operation:
+        def operation(index: int):
+            ContextFactory.create_request(updates[index % len(updates)])
+        return operation
+    return measure("pipeline.create_request", prepare, iterations)
+
+
+def wizard_flow(iterations: int) -> BenchmarkResult:
+    # full new_request flows through the configured pipeline, each operation is one update
+    users = iterations // len(WIZARD_STEPS) + 1
+    updates = wizard_updates(users)
+
+    def prepare() -> Operation:
+        pipeline = ReplayRunner(startup.Startup(), ()).build()
+
+        def operation(index: int):
+            pipeline.replay((updates[index],))
+        return operation
+    return measure("pipeline.wizard_flow", prepare, iterations)
+
+
+CASES: typing.Tuple[typing.Tuple[str, typing.Callable[[int], BenchmarkResult], int], ...] = (
+    ("di_singleton", di_singleton, 20000),
+    ("di_scoped", di_scoped, 5000),
+    ("resources_get_string", resources_get_string, 20000),
+    ("resources_get_string_fallback", resources_get_string_fallback, 20000),
+    ("resources_get_model", resources_get_model, 20000),
+    ("codec_pickle_encode", codec_pickle_encode, 20000),
+    ("codec_pickle_decode", codec_pickle_decode, 20000),
+    ("codec_compact_encode", codec_compact_encode, 20000),
+    ("codec_compact_decode", codec_compact_decode, 20000),
+    ("session_commit", session_commit, 2000),
+    ("session_load", session_load, 2000),
+    ("session_sqlite_commit", session_sqlite_commit, 20000),
+    ("session_sqlite_load", session_sqlite_load, 20000),
+    ("session_log_commit", session_log_commit, 20000),
+    ("session_log_load", session_log_load, 20000),
+    ("session_log_commit_compact", session_log_commit_compact, 20000),
+    ("session_log_load_compact", session_log_load_compact, 20000),
+    ("session_cached_roundtrip", session_cached_roundtrip, 20000),
+    ("request_parsing", request_parsing, 20000),
+    ("wizard_flow", wizard_flow, 2000),
+)
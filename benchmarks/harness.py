@@ -0,0 +1,109 @@
+import gc
+import sys
+import time
+import tracemalloc
+import typing
+
+# a prepared operation is called with the iteration index, so it can pick fresh ids or the next update
+Operation = typing.Callable[[int], None]
+
+
+class BenchmarkResult:
+
+    def __init__(self, name: str, latencies: typing.List[float], elapsed: float, peak_bytes: float,
+                 retained_blocks: float):
+        self.__name = name
+        self.__latencies = sorted(latencies)
+        self.__elapsed = elapsed
+        self.__peak_bytes = peak_bytes
+        self.__retained_blocks = retained_blocks
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def iterations(self) -> int:
+        return len(self.__latencies)
+
+    @property
+    def throughput(self) -> float:
+        if self.__elapsed == 0:
+            return 0.0
+        return len(self.__latencies) / self.__elapsed
+
+    def percentile(self, percent: float) -> float:
+        if len(self.__latencies) == 0:
+            return 0.0
+        index = min(len(self.__latencies) - 1, int(round(percent / 100 * (len(self.__latencies) - 1))))
+        return self.__latencies[index]
+
+    def to_dict(self) -> typing.Dict[str, typing.Union[str, int, float]]:
+        return {
+            "name": self.__name,
+            "iterations": self.iterations,
+            "ops_per_second": self.throughput,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.percentile(100),
+            "peak_bytes_per_op": self.__peak_bytes,
+            "retained_blocks_per_op": self.__retained_blocks,
+        }
+
+
+def measure(name: str, prepare: typing.Callable[[], Operation], iterations: int, warmup: int = 0,
+            memory_iterations: int = 200) -> BenchmarkResult:
+    # timing and memory tracing run on separately prepared state, tracemalloc would distort the timings
+    operation = prepare()
+    for index in range(warmup):
+        operation(index)
+
+    latencies = list()
+    gc.collect()
+    started = time.perf_counter()
+    for index in range(warmup, warmup + iterations):
+        op_started = time.perf_counter()
+        operation(index)
+        latencies.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+
+    peak_bytes, retained_blocks = _trace_memory(prepare(), warmup, min(iterations, memory_iterations))
+    return BenchmarkResult(name, latencies, elapsed, peak_bytes, retained_blocks)
+
+
+def _trace_memory(operation: Operation, warmup: int, iterations: int) -> typing.Tuple[float, float]:
+    for index in range(warmup):
+        operation(index)
+    if iterations == 0:
+        return 0.0, 0.0
+
+    gc.collect()
+    peak_total = 0
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    for index in range(warmup, warmup + iterations):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        operation(index)
+        _, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - current
+    tracemalloc.stop()
+    gc.collect()
+    blocks_after = sys.getallocatedblocks()
+    return peak_total / iterations, max(0, blocks_after - blocks_before) / iterations
+
+
+def compare(results: typing.List[typing.Dict], baseline: typing.List[typing.Dict],
+            threshold: float) -> typing.List[str]:
+    # a benchmark regresses when its median latency grows by more than the threshold
+    baseline_by_name = {entry["name"]: entry for entry in baseline}
+    regressions = list()
+    for entry in results:
+        previous = baseline_by_name.get(entry["name"])
+        if previous is None or previous["p50"] == 0:
+            continue
+        change = entry["p50"] / previous["p50"] - 1
+        if change > threshold:
+            regressions.append(f"{entry['name']}: p50 {previous['p50']:.6f}s -> {entry['p50']:.6f}s "
+                               f"(+{change * 100:.1f}%)")
+    return regressions
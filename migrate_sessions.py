@@ -0,0 +1,23 @@
+import sys
+
+import runtime.session
+import runtime.session_codec
+
+if __name__ == "__main__":
+    # python migrate_sessions.py [sessions/] [sessions.db | sessions-compact/]
+    # rewrites pickled session files with the compact codec, for bots that register CompactSessionCodec,
+    # which does not read pickles
+    base_path = sys.argv[1] if len(sys.argv) > 1 else "sessions/"
+    target_path = sys.argv[2] if len(sys.argv) > 2 else "sessions.db"
+    if not base_path.endswith('/'):
+        base_path += '/'
+
+    codec = runtime.session_codec.CompactSessionCodec()
+    if target_path.endswith('/'):
+        storage = runtime.session.FileSessionStorage(codec, target_path)
+    else:
+        storage = runtime.session.SqliteSessionStorage(target_path, codec)
+    imported = runtime.session.import_file_sessions(storage, base_path)
+    if isinstance(storage, runtime.session.SqliteSessionStorage):
+        storage.close()
+    print(f"imported {imported} sessions from {base_path} into {target_path}")
@@ -0,0 +1,18 @@
+import json
+import sys
+
+import runtime.replay
+import startup
+
+if __name__ == "__main__":
+    # python replay.py updates.jsonl | python replay.py --users 100
+    if len(sys.argv) > 2 and sys.argv[1] == "--users":
+        updates = runtime.replay.wizard_updates(int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        updates = runtime.replay.load_updates(sys.argv[1])
+    else:
+        updates = runtime.replay.wizard_updates(100)
+
+    runner = runtime.replay.ReplayRunner(startup.Startup(), updates)
+    report = runner.run()
+    print(json.dumps(report.snapshot(), indent=2))
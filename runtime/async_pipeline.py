@@ -0,0 +1,352 @@
+import asyncio
+import concurrent.futures
+import time
+import typing
+
+import telegram
+
+from runtime.builder import ApplicationBuilder
+from runtime.commands import AsyncCommandResult, RedirectToCommandResult
+from runtime.context import Context
+from runtime.dependency_injection import LifeSpan, ServiceCollection, ServiceProvider
+from runtime.dispatcher import OffsetTracker
+from runtime.expiry import SessionSweeper
+from runtime.journal import UpdateJournal
+from runtime.logging import Logger
+from runtime.metrics import MetricsRegistry, MetricsServer, PipelineMetrics
+from runtime.middleware import AsyncMiddleware
+from runtime.options import Options
+from runtime.outbound import OutboundDispatcher
+from runtime.pipeline import ContextFactory, OffsetCommitter, ScopedMiddlewareInvoker
+from runtime.polling import AdaptivePoller, PollingStatistics
+from runtime.session import IBufferedSessionStorage, IExpiringSessionStorage, ISessionStorage
+from runtime.tracing import NULL_SPAN, Tracer
+
+AsyncInvoker = typing.Callable[[Context], typing.Awaitable[None]]
+SyncInvoker = typing.Callable[[Context], None]
+
+
+class AsyncCompiledPipeline:
+
+    def __init__(self, components: typing.Tuple[typing.Tuple[typing.Type, typing.Callable[[], Options]], ...],
+                 services: ServiceCollection, service_provider: ServiceProvider, loop: asyncio.AbstractEventLoop,
+                 tracer: typing.Optional[Tracer] = None):
+        next_invoker: typing.Optional[typing.Callable] = None
+        next_is_async = True
+        sync_segments = 0
+
+        for middleware_type, configurator in reversed(components):
+            definition = services.get_service(middleware_type)
+            if definition is None:
+                raise RuntimeError(f"Middleware {middleware_type} is not registered")
+            options = None
+            if configurator is not None:
+                options = configurator()
+
+            is_async = issubclass(middleware_type, AsyncMiddleware)
+            link = next_invoker
+            if next_invoker is not None and is_async and not next_is_async:
+                link = self.__to_async(next_invoker)
+            elif next_invoker is not None and not is_async and next_is_async:
+                link = self.__to_sync(next_invoker, loop)
+            if not is_async and (next_invoker is None or next_is_async):
+                sync_segments += 1
+
+            if definition.lifespan == LifeSpan.SINGLETON:
+                instance = service_provider.get_instance(middleware_type)
+                if options is not None:
+                    instance.configure(options)
+                instance.set_next(link)
+                next_invoker = instance.invoke
+            else:
+                scoped = ScopedMiddlewareInvoker(middleware_type, options, link, service_provider)
+                next_invoker = scoped.invoke_async if is_async else scoped.invoke
+            if tracer is not None and is_async:
+                next_invoker = tracer.wrap_async(middleware_type.__name__, "middleware", next_invoker)
+            elif tracer is not None:
+                next_invoker = tracer.wrap(middleware_type.__name__, "middleware", next_invoker)
+            next_is_async = is_async
+
+        if next_invoker is not None and not next_is_async:
+            next_invoker = self.__to_async(next_invoker)
+        self.__entry: typing.Optional[AsyncInvoker] = next_invoker
+        self.__sync_segments = sync_segments
+
+    @property
+    def empty(self) -> bool:
+        return self.__entry is None
+
+    @property
+    def sync_segments(self) -> int:
+        return self.__sync_segments
+
+    async def invoke(self, context: Context):
+        if self.__entry is not None:
+            await self.__entry(context)
+
+    @staticmethod
+    def __to_async(invoker: SyncInvoker) -> AsyncInvoker:
+        # a run of sync middleware executes on one executor thread, calling each other directly
+        async def invoke(context: Context):
+            await asyncio.get_running_loop().run_in_executor(None, invoker, context)
+        return invoke
+
+    @staticmethod
+    def __to_sync(invoker: AsyncInvoker, loop: asyncio.AbstractEventLoop) -> SyncInvoker:
+        def invoke(context: Context):
+            asyncio.run_coroutine_threadsafe(invoker(context), loop).result()
+        return invoke
+
+
+class AsyncPipeline:
+
+    def __init__(self):
+        self.__app_builder: typing.Optional[ApplicationBuilder] = None
+        self.__services: typing.Optional[ServiceCollection] = None
+        self.__service_provider: typing.Optional[ServiceProvider] = None
+        self.__compiled: typing.Optional[AsyncCompiledPipeline] = None
+        self.__context_factory: typing.Optional[ContextFactory] = None
+        self.__tracker: typing.Optional[OffsetTracker] = None
+        self.__semaphore: typing.Optional[asyncio.Semaphore] = None
+        self.__user_locks: typing.Dict[int, typing.List] = dict()
+        self.__poller: typing.Optional[AdaptivePoller] = None
+        self.__outbound: typing.Optional[OutboundDispatcher] = None
+        self.__tracer: typing.Optional[Tracer] = None
+        self.__metrics: typing.Optional[PipelineMetrics] = None
+        self.__metrics_server: typing.Optional[MetricsServer] = None
+        self.__journal: typing.Optional[UpdateJournal] = None
+        self.__sweeper: typing.Optional[SessionSweeper] = None
+        self.__progress_timeout = 1.0
+
+    def configure(self, app_builder: ApplicationBuilder, services: ServiceCollection):
+        self.__app_builder = app_builder
+        self.__services = services
+        self.__service_provider = ServiceProvider()
+        self.__service_provider.populate(services.services, services.scope_policy)
+        self.__context_factory = ContextFactory(self.__service_provider)
+        self.__poller = AdaptivePoller(app_builder.bot, app_builder.updates_limit, app_builder.max_updates_limit,
+                                       app_builder.timeout)
+        if app_builder.tracing_capacity is not None:
+            self.__tracer = Tracer(app_builder.tracing_capacity)
+        registry = typing.cast(MetricsRegistry, self.__service_provider.get_instance(MetricsRegistry))
+        if registry is not None:
+            self.__metrics = PipelineMetrics(registry)
+        elif app_builder.metrics_endpoint is not None:
+            raise RuntimeError(f"Metrics endpoint requires {MetricsRegistry} to be registered")
+        if app_builder.outbound_configurator is not None:
+            logger = typing.cast(Logger, self.__service_provider.get_instance(Logger))
+            self.__outbound = OutboundDispatcher(app_builder.bot, app_builder.outbound_configurator(), logger,
+                                                 self.__tracer, self.__metrics)
+        if app_builder.journal_path is not None:
+            self.__journal = UpdateJournal(app_builder.journal_path)
+        # after a restart polling resumes from the last durable checkpoint
+        self.__tracker = OffsetTracker(self.__journal.offset if self.__journal is not None else 0)
+        if app_builder.session_expiry_configurator is not None:
+            storage = self.__service_provider.get_instance(ISessionStorage)
+            if not isinstance(storage, IExpiringSessionStorage):
+                raise RuntimeError(f"Session expiry requires {ISessionStorage} to be an {IExpiringSessionStorage}")
+            self.__sweeper = SessionSweeper(storage, self.__service_provider, app_builder.session_expiry_configurator(),
+                                            app_builder.bot, self.__outbound, self.__metrics)
+
+    @property
+    def outbound(self) -> typing.Optional[OutboundDispatcher]:
+        return self.__outbound
+
+    @property
+    def tracer(self) -> typing.Optional[Tracer]:
+        return self.__tracer
+
+    @property
+    def metrics(self) -> typing.Optional[PipelineMetrics]:
+        return self.__metrics
+
+    @property
+    def journal(self) -> typing.Optional[UpdateJournal]:
+        return self.__journal
+
+    @property
+    def sweeper(self) -> typing.Optional[SessionSweeper]:
+        return self.__sweeper
+
+    @property
+    def metrics_server(self) -> typing.Optional[MetricsServer]:
+        return self.__metrics_server
+
+    @property
+    def polling_statistics(self) -> typing.Optional[PollingStatistics]:
+        if self.__poller is None:
+            return None
+        return self.__poller.statistics
+
+    def start_polling(self):
+        if self.__app_builder is None:
+            raise RuntimeError("Cannot start the bot")
+
+        asyncio.run(self.run_polling())
+
+    async def run_polling(self):
+        loop = asyncio.get_running_loop()
+        self.__compiled = AsyncCompiledPipeline(self.__app_builder.build(), self.__services,
+                                                self.__service_provider, loop, self.__tracer)
+        # every in-flight update holds at most one thread per sync segment and one for its results
+        concurrency = max(1, self.__app_builder.workers)
+        executor = concurrent.futures.ThreadPoolExecutor(concurrency * (self.__compiled.sync_segments + 1),
+                                                         thread_name_prefix="AsyncPipelineWorker")
+        poll_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="AsyncPipelinePoller")
+        loop.set_default_executor(executor)
+        self.__semaphore = asyncio.Semaphore(concurrency)
+        if self.__outbound is not None:
+            self.__outbound.start()
+        if self.__sweeper is not None:
+            self.__sweeper.start()
+        self.__start_metrics_server()
+
+        poller = self.__poller
+        tracker = self.__tracker
+        journal = self.__journal
+        storage = self.__service_provider.get_instance(ISessionStorage)
+        committer = OffsetCommitter(tracker.offset, journal,
+                                    storage if isinstance(storage, IBufferedSessionStorage) else None,
+                                    typing.cast(Logger, self.__service_provider.get_instance(Logger)))
+        tasks: typing.Set[asyncio.Task] = set()
+
+        while True:
+            # sessions are written behind, neither telegram nor the checkpoint may pass an update before its session
+            offset = tracker.offset
+            committed = await loop.run_in_executor(poll_executor, committer.commit, offset, tracker.pending_count == 0)
+            if committed != offset:
+                offset = committed
+                await asyncio.sleep(self.__progress_timeout)
+            updates_list = await loop.run_in_executor(poll_executor, poller.poll, offset, tracker.pending_count,
+                                                      tracker.received)
+
+            dispatched_count = 0
+            for update in updates_list:
+                if journal is not None and journal.is_finished(update.update_id):
+                    # handled before a crash, but the checkpoint covering it was not written yet
+                    if tracker.begin(update.update_id):
+                        tracker.complete(update.update_id)
+                    continue
+                if tracker.begin(update.update_id):
+                    task = loop.create_task(self.__process_update(update))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    dispatched_count += 1
+
+            # every received update is still in progress, so wait for the offset to move instead of re-polling
+            if dispatched_count == 0 and len(updates_list) != 0:
+                await loop.run_in_executor(poll_executor, tracker.wait_for_progress, offset, self.__progress_timeout)
+
+    async def __process_update(self, update: telegram.Update):
+        user_id = update.effective_user.id if update.effective_user is not None else 0
+        user_lock = self.__acquire_user_lock(user_id)
+        started = time.perf_counter()
+        if self.__metrics is not None:
+            self.__metrics.update_received()
+        loop = asyncio.get_running_loop()
+        journal = self.__journal
+        succeeded = False
+        try:
+            if journal is not None:
+                await loop.run_in_executor(None, journal.received, update)
+            # the user lock is taken first, so updates of one user keep their order
+            async with user_lock:
+                async with self.__semaphore:
+                    while await self.__handle_update(update):
+                        pass
+            if self.__metrics is not None:
+                self.__metrics.update_finished(time.perf_counter() - started)
+            succeeded = True
+        except Exception as exception:
+            if self.__metrics is not None:
+                self.__metrics.update_finished(time.perf_counter() - started, True)
+            if journal is not None:
+                journal.failed(update, exception)
+            self.__on_error(update, exception)
+        finally:
+            self.__release_user_lock(user_id)
+            if self.__outbound is not None:
+                # the offset stays at the update until its replies are sent, so it is polled again after a crash
+                self.__outbound.when_delivered(update.update_id, lambda: self.__done(update, succeeded))
+        if self.__outbound is None:
+            await loop.run_in_executor(None, self.__done, update, succeeded)
+
+    def __done(self, update: telegram.Update, succeeded: bool):
+        if succeeded and self.__journal is not None:
+            self.__journal.done(update)
+        self.__tracker.complete(update.update_id)
+
+    async def __handle_update(self, update: telegram.Update) -> bool:
+        loop = asyncio.get_running_loop()
+        bot = self.__app_builder.bot
+        context = self.__context_factory.create_context(update)
+        session = context.session
+        started = time.perf_counter()
+        with self.__span("session.load", "session", context):
+            await loop.run_in_executor(None, session.load)
+        if self.__metrics is not None:
+            self.__metrics.session_loaded(time.perf_counter() - started)
+
+        if self.__compiled.empty:
+            return False
+
+        await self.__compiled.invoke(context)
+        started = time.perf_counter()
+        with self.__span("session.commit", "session", context):
+            await loop.run_in_executor(None, session.commit)
+        if self.__metrics is not None:
+            self.__metrics.session_committed(time.perf_counter() - started)
+        context.bot_response.coalesce()
+        while len(context.bot_response.actions_queue) > 0:
+            result = context.bot_response.pop_action_at(0)
+            if isinstance(result, RedirectToCommandResult):
+                return True
+            if self.__outbound is not None and not isinstance(result, AsyncCommandResult):
+                self.__outbound.submit(result, update.update_id)
+                continue
+            started = time.perf_counter()
+            try:
+                with self.__span(result.__class__.__name__ + ".execute", "result", context):
+                    if isinstance(result, AsyncCommandResult):
+                        await result.execute_async(bot)
+                    else:
+                        await loop.run_in_executor(None, result.execute, bot)
+                if self.__metrics is not None:
+                    self.__metrics.api_call(result.__class__.__name__, time.perf_counter() - started)
+            except Exception as exception:
+                # a failed action does not fail the update, the remaining actions are still sent
+                if self.__metrics is not None:
+                    self.__metrics.api_call(result.__class__.__name__, time.perf_counter() - started, exception)
+                self.__on_error(update, exception)
+        return False
+
+    def __start_metrics_server(self):
+        endpoint = self.__app_builder.metrics_endpoint
+        if endpoint is None or self.__metrics_server is not None:
+            return
+        host, port, path = endpoint
+        self.__metrics_server = MetricsServer(host, port, path, self.__metrics.registry)
+        self.__metrics_server.start()
+
+    def __on_error(self, update: telegram.Update, exception: Exception):
+        logger = typing.cast(Logger, self.__service_provider.get_instance(Logger))
+        if logger is not None:
+            logger.error("update " + str(update.update_id) + " failed: " + str(exception.__class__) + " " + str(exception))
+
+    def __span(self, name: str, category: str, context: Context):
+        if self.__tracer is None:
+            return NULL_SPAN
+        return self.__tracer.span(name, category, context.bot_request.update_id, context.user.id)
+
+    def __acquire_user_lock(self, user_id: int) -> asyncio.Lock:
+        if user_id not in self.__user_locks:
+            self.__user_locks[user_id] = [asyncio.Lock(), 0]
+        entry = self.__user_locks[user_id]
+        entry[1] += 1
+        return entry[0]
+
+    def __release_user_lock(self, user_id: int):
+        entry = self.__user_locks[user_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.__user_locks.pop(user_id)
@@ -9,6 +9,15 @@ class BotRequest:
         self.__message_id: int = 0
         self.__message_text: typing.Optional[str] = None
         self.__is_callback = False
+        self.__update_id: typing.Optional[int] = None
+
+    @property
+    def update_id(self) -> typing.Optional[int]:
+        return self.__update_id
+
+    @update_id.setter
+    def update_id(self, value: typing.Optional[int]):
+        self.__update_id = value
 
     @property
     def is_callback(self) -> bool:
@@ -65,3 +74,14 @@ class BotResponse:
 
     def pop_action_at(self, index: int):
         return self.__actions.pop(index)
+
+    def coalesce(self):
+        actions: typing.List = list()
+        for action in self.__actions:
+            if len(actions) != 0:
+                merged = actions[-1].merge(action)
+                if merged is not None:
+                    actions[-1] = merged
+                    continue
+            actions.append(action)
+        self.__actions = actions
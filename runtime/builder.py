@@ -3,7 +3,7 @@ import typing
 import telegram
 
 from runtime.middleware import Middleware, CommandsMiddleware
-from runtime.options import Options
+from runtime.options import Options, OutboundOptions, SessionExpiryOptions
 
 
 class ApplicationBuilder:
@@ -12,11 +12,22 @@ class ApplicationBuilder:
         self.__bot = None
         self.__timeout = 0
         self.__updates_limit = 0
+        self.__max_updates_limit = 0
+        self.__workers = 0
+        self.__outbound_configurator: typing.Optional[typing.Callable[[], OutboundOptions]] = None
+        self.__journal_path: typing.Optional[str] = None
+        self.__tracing_capacity: typing.Optional[int] = None
+        self.__metrics_endpoint: typing.Optional[typing.Tuple[str, int, str]] = None
+        self.__session_expiry_configurator: typing.Optional[typing.Callable[[], SessionExpiryOptions]] = None
         self.__components: typing.List[typing.Tuple[typing.Type[Middleware], typing.Callable[[], Options]]] = list()
 
     def use_bot_token(self, token: str):
         self.__bot = telegram.Bot(token)
 
+    def use_bot(self, bot: telegram.Bot):
+        # anything with the telegram.Bot methods the runtime calls, e.g. runtime.replay.FakeBot
+        self.__bot = bot
+
     @property
     def timeout(self) -> int:
         return self.__timeout
@@ -37,11 +48,82 @@ class ApplicationBuilder:
     def updates_limit(self, limit: int):
         self.__updates_limit = limit
 
+    @property
+    def max_updates_limit(self) -> int:
+        if self.__max_updates_limit < self.__updates_limit:
+            return self.__updates_limit
+        return self.__max_updates_limit
+
+    @max_updates_limit.setter
+    def max_updates_limit(self, limit: int):
+        self.__max_updates_limit = limit
+
+    @property
+    def workers(self) -> int:
+        return self.__workers
+
+    @workers.setter
+    def workers(self, count: int):
+        if count < 0:
+            raise ValueError("Workers count cannot be negative")
+        self.__workers = count
+
     def use_middleware(self, middleware: typing.Type[Middleware], configurator: typing.Callable[[], Options] = None):
         self.__components.append((middleware, configurator))
 
     def use_commands(self, configurator: typing.Callable[[], Options]):
         self.__components.append((CommandsMiddleware, configurator))
 
+    def use_outbound_dispatcher(self, configurator: typing.Callable[[], OutboundOptions] = None):
+        if configurator is None:
+            configurator = OutboundOptions
+        self.__outbound_configurator = configurator
+
+    @property
+    def outbound_configurator(self) -> typing.Optional[typing.Callable[[], OutboundOptions]]:
+        return self.__outbound_configurator
+
+    @outbound_configurator.setter
+    def outbound_configurator(self, configurator: typing.Optional[typing.Callable[[], OutboundOptions]]):
+        self.__outbound_configurator = configurator
+
+    def use_update_journal(self, base_path: str = "journal/"):
+        self.__journal_path = base_path
+
+    @property
+    def journal_path(self) -> typing.Optional[str]:
+        return self.__journal_path
+
+    @journal_path.setter
+    def journal_path(self, base_path: typing.Optional[str]):
+        self.__journal_path = base_path
+
+    def use_tracing(self, capacity: int = 100000):
+        self.__tracing_capacity = capacity
+
+    @property
+    def tracing_capacity(self) -> typing.Optional[int]:
+        return self.__tracing_capacity
+
+    def use_metrics_endpoint(self, host: str = "127.0.0.1", port: int = 9100, path: str = "/metrics"):
+        self.__metrics_endpoint = (host, port, path)
+
+    @property
+    def metrics_endpoint(self) -> typing.Optional[typing.Tuple[str, int, str]]:
+        return self.__metrics_endpoint
+
+    def use_session_expiry(self, configurator: typing.Callable[[], SessionExpiryOptions] = None):
+        if configurator is None:
+            configurator = SessionExpiryOptions
+        self.__session_expiry_configurator = configurator
+
+    @property
+    def session_expiry_configurator(self) -> typing.Optional[typing.Callable[[], SessionExpiryOptions]]:
+        return self.__session_expiry_configurator
+
+    @session_expiry_configurator.setter
+    def session_expiry_configurator(self, configurator: typing.Optional[typing.Callable[[], SessionExpiryOptions]]):
+        self.__session_expiry_configurator = configurator
+
     def build(self) -> typing.Tuple[typing.Tuple[typing.Type[Middleware], typing.Callable[[], Options]], ...]:
         return tuple(self.__components)
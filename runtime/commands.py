@@ -1,3 +1,6 @@
+import asyncio
+import collections
+import threading
 import typing
 
 import telegram
@@ -10,14 +13,90 @@ from runtime.session import ISession
 from runtime.user import User
 
 
+class RenderCache:
+    DEFAULT_CAPACITY = 10000
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.__capacity = capacity
+        self.__rendered: typing.OrderedDict[typing.Tuple[int, int], typing.Tuple[typing.Optional[int], int]] = \
+            collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def text_fingerprint(text: str, parse_mode: typing.Optional[str]) -> int:
+        return hash((text, parse_mode))
+
+    @staticmethod
+    def markup_fingerprint(markup: typing.Optional[telegram.ReplyMarkup]) -> int:
+        if markup is None:
+            return hash(None)
+        if isinstance(markup, telegram.TelegramObject):
+            return hash(markup.to_json())
+        return hash(str(markup))
+
+    @staticmethod
+    def is_not_modified(error: telegram.error.BadRequest) -> bool:
+        return "message is not modified" in str(error).lower()
+
+    def __len__(self) -> int:
+        return len(self.__rendered)
+
+    def is_rendered(self, chat_id: int, message_id: int, text: typing.Optional[int], markup: int) -> bool:
+        # text is None for markup-only edits, which leave the rendered text as it is
+        with self.__lock:
+            rendered = self.__rendered.get((chat_id, message_id))
+            if rendered is None:
+                return False
+            self.__rendered.move_to_end((chat_id, message_id))
+            return (text is None or rendered[0] == text) and rendered[1] == markup
+
+    def remember(self, chat_id: int, message_id: int, text: typing.Optional[int], markup: int):
+        with self.__lock:
+            key = (chat_id, message_id)
+            if text is None and key in self.__rendered:
+                text = self.__rendered[key][0]
+            self.__rendered[key] = (text, markup)
+            self.__rendered.move_to_end(key)
+            if len(self.__rendered) > self.__capacity:
+                self.__rendered.popitem(last=False)
+
+    def forget(self, chat_id: int, message_id: int):
+        with self.__lock:
+            self.__rendered.pop((chat_id, message_id), None)
+
+
+rendered_messages = RenderCache()
+
+
 class CommandResult:
 
+    @property
+    def chat_id(self) -> typing.Optional[int]:
+        return None
+
     def attach_to(self, response: BotResponse):
         pass
 
     def execute(self, bot: telegram.Bot):
         pass
 
+    def merge(self, result: "CommandResult") -> typing.Optional["CommandResult"]:
+        if isinstance(result, EmptyResult):
+            return self
+        return None
+
+
+class AsyncCommandResult(CommandResult):
+
+    def attach_to(self, response: BotResponse):
+        response.add_action(self)
+
+    async def execute_async(self, bot: telegram.Bot):
+        pass
+
+    def execute(self, bot: telegram.Bot):
+        asyncio.run(self.execute_async(bot))
+
 
 class CommandsBase:
 
@@ -172,8 +251,16 @@ class MessageResult(CommandResult):
         self.__markup = reply_markup
         self.__parse_mode = parse_mode
 
+    @property
+    def chat_id(self) -> int:
+        return self.__chat_id
+
     def execute(self, bot: telegram.Bot):
-        bot.send_message(self.__chat_id, self.__message, reply_markup=self.__markup, parse_mode=self.__parse_mode)
+        message = bot.send_message(self.__chat_id, self.__message, reply_markup=self.__markup, parse_mode=self.__parse_mode)
+        if isinstance(message, telegram.Message):
+            rendered_messages.remember(self.__chat_id, message.message_id,
+                                       RenderCache.text_fingerprint(self.__message, self.__parse_mode),
+                                       RenderCache.markup_fingerprint(self.__markup))
 
     def attach_to(self, response: BotResponse):
         response.add_action(self)
@@ -184,6 +271,9 @@ class EmptyResult(CommandResult):
     def execute(self, bot: telegram.Bot):
         pass
 
+    def merge(self, result: CommandResult) -> typing.Optional[CommandResult]:
+        return result
+
 
 class RedirectToCommandResult(CommandResult):
 
@@ -199,6 +289,10 @@ class ReplyToMessageResult(CommandResult):
         self.__markup = reply_markup
         self.__parse_mode = parse_mode
 
+    @property
+    def chat_id(self) -> int:
+        return self.__chat_id
+
     def execute(self, bot: telegram.Bot):
         bot.send_message(self.__chat_id, self.__text, reply_to_message_id=self.__message_id, reply_markup=self.__markup, parse_mode=self.__parse_mode)
 
@@ -212,6 +306,10 @@ class MessageListResult(CommandResult):
         self.__messages = messages
         self.__parse_mode = parse_mode
 
+    @property
+    def chat_id(self) -> int:
+        return self.__chat_id
+
     def execute(self, bot: telegram.Bot):
         for message in self.__messages:
             bot.send_message(self.__chat_id, message, parse_mode=self.__parse_mode)
@@ -229,12 +327,54 @@ class EditMessageResult(CommandResult):
         self.__new_markup = new_markup
         self.__parse_mode = parse_mode
 
+    @property
+    def chat_id(self) -> int:
+        return self.__chat_id
+
+    @property
+    def message_id(self) -> int:
+        return self.__message_id
+
+    @property
+    def text(self) -> typing.Optional[str]:
+        return self.__new_text
+
+    @property
+    def parse_mode(self) -> typing.Optional[telegram.ParseMode]:
+        return self.__parse_mode
+
+    @property
+    def reply_markup(self) -> typing.Optional[telegram.ReplyMarkup]:
+        return self.__new_markup
+
     def execute(self, bot: telegram.Bot):
+        if self.__new_text is None and self.__new_markup is None:
+            return
+        text = None
         if self.__new_text is not None:
-            bot.edit_message_text(self.__new_text, chat_id=self.__chat_id, message_id=self.__message_id,
-                                  parse_mode=self.__parse_mode)
-        if self.__new_markup is not None:
-            bot.edit_message_reply_markup(self.__chat_id, self.__message_id, reply_markup=self.__new_markup)
+            text = RenderCache.text_fingerprint(self.__new_text, self.__parse_mode)
+        markup = RenderCache.markup_fingerprint(self.__new_markup)
+        if rendered_messages.is_rendered(self.__chat_id, self.__message_id, text, markup):
+            return
+
+        try:
+            # text and markup go in one call, editing only the markup is a separate endpoint
+            if self.__new_text is not None:
+                bot.edit_message_text(self.__new_text, chat_id=self.__chat_id, message_id=self.__message_id,
+                                      parse_mode=self.__parse_mode, reply_markup=self.__new_markup)
+            else:
+                bot.edit_message_reply_markup(self.__chat_id, self.__message_id, reply_markup=self.__new_markup)
+        except telegram.error.BadRequest as error:
+            if not RenderCache.is_not_modified(error):
+                rendered_messages.forget(self.__chat_id, self.__message_id)
+                raise
+        rendered_messages.remember(self.__chat_id, self.__message_id, text, markup)
+
+    def merge(self, result: CommandResult) -> typing.Optional[CommandResult]:
+        merged = merge_message_edits(self, result)
+        if merged is None:
+            return super().merge(result)
+        return merged
 
     def attach_to(self, response: BotResponse):
         response.add_action(self)
@@ -246,8 +386,44 @@ class EditMessageMarkupResult(CommandResult):
         self.__new_markup = new_markup
         self.__message_id = message_id
 
+    @property
+    def chat_id(self) -> int:
+        return self.__chat_id
+
+    @property
+    def message_id(self) -> int:
+        return self.__message_id
+
+    @property
+    def text(self) -> typing.Optional[str]:
+        return None
+
+    @property
+    def parse_mode(self) -> typing.Optional[telegram.ParseMode]:
+        return None
+
+    @property
+    def reply_markup(self) -> typing.Optional[telegram.ReplyMarkup]:
+        return self.__new_markup
+
     def execute(self, bot: telegram.Bot):
-        bot.edit_message_reply_markup(chat_id=self.__chat_id, message_id=self.__message_id, reply_markup=self.__new_markup)
+        markup = RenderCache.markup_fingerprint(self.__new_markup)
+        if rendered_messages.is_rendered(self.__chat_id, self.__message_id, None, markup):
+            return
+
+        try:
+            bot.edit_message_reply_markup(chat_id=self.__chat_id, message_id=self.__message_id, reply_markup=self.__new_markup)
+        except telegram.error.BadRequest as error:
+            if not RenderCache.is_not_modified(error):
+                rendered_messages.forget(self.__chat_id, self.__message_id)
+                raise
+        rendered_messages.remember(self.__chat_id, self.__message_id, None, markup)
+
+    def merge(self, result: CommandResult) -> typing.Optional[CommandResult]:
+        merged = merge_message_edits(self, result)
+        if merged is None:
+            return super().merge(result)
+        return merged
 
     def attach_to(self, response: BotResponse):
         response.add_action(self)
@@ -281,6 +457,10 @@ class ModelCommandBase(CommandsBase):
     def on_cancel(self, model) -> CommandResult:
         return self.send_message(text="You canceled")
 
+    def on_expired(self, model) -> CommandResult:
+        # called by the session sweeper once an unfinished draft was idle for too long, session is None here
+        return self.no_message()
+
 
 class SendOrEditMessage(CommandResult):
 
@@ -293,6 +473,26 @@ class SendOrEditMessage(CommandResult):
         self.__chat = chat_id
         self.__parse_mode = parse_mode
 
+    @property
+    def chat_id(self) -> int:
+        return self.__chat
+
+    @property
+    def message_id(self) -> int:
+        return self.__message_id
+
+    @property
+    def text(self) -> typing.Optional[str]:
+        return self.__text
+
+    @property
+    def parse_mode(self) -> typing.Optional[telegram.ParseMode]:
+        return self.__parse_mode
+
+    @property
+    def reply_markup(self) -> typing.Optional[telegram.ReplyMarkup]:
+        return self.__markup
+
     def execute(self, bot: telegram.Bot):
         try:
             EditMessageResult(self.__chat, self.__message_id, self.__text, self.__parse_mode, self.__markup).execute(
@@ -300,5 +500,33 @@ class SendOrEditMessage(CommandResult):
         except telegram.error.BadRequest:
             MessageResult(self.__text, self.__chat, self.__parse_mode, self.__markup).execute(bot)
 
+    def merge(self, result: CommandResult) -> typing.Optional[CommandResult]:
+        merged = merge_message_edits(self, result)
+        if merged is None:
+            return super().merge(result)
+        return merged
+
     def attach_to(self, response: BotResponse):
         response.add_action(self)
+
+
+def merge_message_edits(first: CommandResult, second: CommandResult) -> typing.Optional[CommandResult]:
+    edit_types = (SendOrEditMessage, EditMessageResult, EditMessageMarkupResult)
+    if not isinstance(first, edit_types) or not isinstance(second, edit_types):
+        return None
+    if first.chat_id != second.chat_id or first.message_id != second.message_id:
+        return None
+    if isinstance(second, EditMessageResult) and second.text is None and second.reply_markup is None:
+        return first
+
+    # a text edit replaces the markup as well, a markup edit keeps the text rendered before it
+    if second.text is not None:
+        text, parse_mode, markup = second.text, second.parse_mode, second.reply_markup
+    else:
+        text, parse_mode, markup = first.text, first.parse_mode, second.reply_markup
+
+    if isinstance(first, SendOrEditMessage) or isinstance(second, SendOrEditMessage):
+        return SendOrEditMessage(second.chat_id, second.message_id, text, parse_mode, markup)
+    if text is None:
+        return EditMessageMarkupResult(second.chat_id, second.message_id, markup)
+    return EditMessageResult(second.chat_id, second.message_id, text, parse_mode, markup)
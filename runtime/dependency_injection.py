@@ -1,7 +1,10 @@
+import collections
 import uuid
 import abc
 import enum
 import inspect
+import threading
+import time
 import typing
 
 
@@ -62,11 +65,90 @@ class ServiceDefinition:
         return self.__uuid
 
 
+class ScopePolicy:
+
+    def __init__(self, max_scopes: typing.Optional[int] = 10000, idle_timeout: typing.Optional[float] = 3600.0):
+        self.__max_scopes = max_scopes
+        self.__idle_timeout = idle_timeout
+
+    @property
+    def max_scopes(self) -> typing.Optional[int]:
+        return self.__max_scopes
+
+    @property
+    def idle_timeout(self) -> typing.Optional[float]:
+        return self.__idle_timeout
+
+
+class ServiceScope:
+
+    def __init__(self, scope_id: typing.Optional[int]):
+        self.__id = scope_id
+        self.__instances: typing.Dict[typing.Type, object] = dict()
+        self.__last_used = time.monotonic()
+        self.__disposed = False
+        self.__stale = False
+        # reentrant, a scoped service may depend on other services of the same scope
+        self.__lock = threading.RLock()
+
+    @property
+    def id(self) -> typing.Optional[int]:
+        return self.__id
+
+    @property
+    def instances(self) -> typing.Dict[typing.Type, object]:
+        return self.__instances
+
+    @property
+    def last_used(self) -> float:
+        return self.__last_used
+
+    @property
+    def disposed(self) -> bool:
+        return self.__disposed
+
+    @property
+    def stale(self) -> bool:
+        return self.__stale
+
+    @property
+    def lock(self) -> threading.RLock:
+        return self.__lock
+
+    def touch(self):
+        self.__last_used = time.monotonic()
+
+    def invalidate(self):
+        self.__stale = True
+
+    def dispose(self):
+        with self.__lock:
+            if self.__disposed:
+                return
+            self.__disposed = True
+            instances = list(self.__instances.values())
+            self.__instances.clear()
+        # scoped services may release what they hold by defining dispose()
+        for instance in instances:
+            dispose = getattr(instance, "dispose", None)
+            if callable(dispose):
+                dispose()
+
+
 class ServiceCollection:
     __t = typing.TypeVar("__t")
 
     def __init__(self):
         self.__services: typing.List[ServiceDefinition] = list()
+        self.__scope_policy = ScopePolicy()
+
+    @property
+    def scope_policy(self) -> ScopePolicy:
+        return self.__scope_policy
+
+    @scope_policy.setter
+    def scope_policy(self, value: ScopePolicy):
+        self.__scope_policy = value
 
     def add_singleton(self, obj_type: typing.Type[__t], imp_type: typing.Optional[typing.Type[__t]] = None):
         self.__add_service(obj_type, imp_type, LifeSpan.SINGLETON)
@@ -120,65 +202,315 @@ class ServiceCollection:
                     self.add_scoped(val)
 
 
+class ConstructorPlan:
+
+    def __init__(self, definition: ServiceDefinition, target_type: typing.Type,
+                 dependencies: typing.Tuple[typing.Tuple[str, typing.Optional[typing.Type]], ...]):
+        self.__definition = definition
+        self.__target_type = target_type
+        self.__dependencies = dependencies
+
+    @property
+    def definition(self) -> ServiceDefinition:
+        return self.__definition
+
+    @property
+    def target_type(self) -> typing.Type:
+        return self.__target_type
+
+    @property
+    def dependencies(self) -> typing.Tuple[typing.Tuple[str, typing.Optional[typing.Type]], ...]:
+        # parameter name and the registered type to inject, None for an optional dependency that is not registered
+        return self.__dependencies
+
+
 class ServiceEngine(IServiceEngine):
 
-    def __init__(self, services: typing.Tuple[ServiceDefinition]):
+    def __init__(self, services: typing.Tuple[ServiceDefinition], scope_policy: typing.Optional[ScopePolicy] = None):
         self.__services = services
-        self.__realized: typing.Dict[typing.Tuple[typing.Type, typing.Optional[int]], object] = dict()
+        if scope_policy is None:
+            scope_policy = ScopePolicy()
+        self.__max_scopes = scope_policy.max_scopes
+        self.__idle_timeout = scope_policy.idle_timeout
+        self.__singletons: typing.Dict[typing.Type, object] = dict()
+        self.__singletons_lock = threading.RLock()
+        self.__scopes_lock = threading.Lock()
+        # ordered by last use, the least recently used scope is evicted first
+        self.__scopes: typing.OrderedDict[typing.Optional[int], ServiceScope] = collections.OrderedDict()
+        self.__last_sweep = time.monotonic()
+        self.__created_scopes = 0
+        self.__evicted_scopes = 0
+        # both the registered type and its implementation resolve to the first definition that mentions them
+        self.__definitions: typing.Dict[typing.Type, ServiceDefinition] = dict()
+        for service in services:
+            self.__definitions.setdefault(service.source_type, service)
+            if service.implementation_type is not None and service.implementation_type is not object:
+                self.__definitions.setdefault(service.implementation_type, service)
+        self.__plans: typing.Dict[typing.Type, ConstructorPlan] = dict()
+        for service in services:
+            if service.source_type not in self.__plans:
+                self.__plans[service.source_type] = self.__compile(service)
+        self.__validate()
 
-    def get_or_create_instance(self, obj_type: typing.Type, session_id: typing.Optional[int] = None) -> object:
-        return self.__get_or_create_instance(obj_type, session_id, list())
+    @property
+    def live_scopes(self) -> int:
+        return len(self.__scopes)
 
-    def __get_or_create_instance(self, obj_type: typing.Type, session_id: typing.Optional[int] = None,
-                                 created: typing.List[typing.Type] = None):
-        definition: typing.Optional[ServiceDefinition] = None
-        for service in self.__services:
-            if service.implementation_type == obj_type or service.source_type == obj_type:
-                definition = service
-                break
+    @property
+    def live_instances(self) -> int:
+        with self.__scopes_lock:
+            scopes = list(self.__scopes.values())
+        return len(self.__singletons) + sum(len(scope.instances) for scope in scopes)
+
+    @property
+    def created_scopes(self) -> int:
+        return self.__created_scopes
+
+    @property
+    def evicted_scopes(self) -> int:
+        return self.__evicted_scopes
+
+    def snapshot(self) -> typing.Dict[str, int]:
+        return {
+            "live_scopes": self.live_scopes,
+            "live_instances": self.live_instances,
+            "created_scopes": self.__created_scopes,
+            "evicted_scopes": self.__evicted_scopes,
+        }
+
+    def get_or_create_instance(self, obj_type: typing.Type, session_id: typing.Optional[int] = None,
+                               scope: typing.Optional[ServiceScope] = None) -> object:
+        definition = self.__definitions.get(obj_type)
         if definition is None:
             return None
-
+        return self.__resolve(self.__plans[definition.source_type], session_id, scope)
+
+    def get_scope(self, session_id: typing.Optional[int]) -> ServiceScope:
+        evicted: typing.List[ServiceScope] = list()
+        with self.__scopes_lock:
+            scope = self.__scopes.get(session_id)
+            if scope is not None:
+                self.__scopes.move_to_end(session_id)
+                scope.touch()
+                return scope
+
+            scope = ServiceScope(session_id)
+            self.__scopes[session_id] = scope
+            self.__created_scopes += 1
+            if self.__max_scopes is not None and len(self.__scopes) > self.__max_scopes:
+                evicted.append(self.__evict(next(iter(self.__scopes))))
+            if self.__idle_timeout is not None and time.monotonic() - self.__last_sweep >= self.__idle_timeout / 10:
+                # sweeping looks at the oldest scopes only, but there is no reason to do it on every request
+                evicted.extend(self.__evict_idle())
+        # dispose hooks run outside of the lock, they may be slow
+        for evicted_scope in evicted:
+            evicted_scope.dispose()
+        return scope
+
+    def renew_scope(self, session_id: typing.Optional[int]) -> ServiceScope:
+        # called when a request starts, requests of one user never run side by side, so nobody holds a stale scope
+        with self.__scopes_lock:
+            scope = self.__scopes.get(session_id)
+            if scope is not None and scope.stale:
+                self.__evict(session_id)
+            else:
+                scope = None
+        if scope is not None:
+            scope.dispose()
+        return self.get_scope(session_id)
+
+    def create_scope(self, session_id: typing.Optional[int]) -> ServiceScope:
+        # a scope of its own, not shared with the requests of the user, the caller disposes it
+        return ServiceScope(session_id)
+
+    def invalidate_scope(self, session_id: typing.Optional[int]) -> bool:
+        # unlike dispose_scope, a request that holds the scope right now keeps working with it,
+        # the next request of the user starts with a new one
+        with self.__scopes_lock:
+            scope = self.__scopes.get(session_id)
+        if scope is None:
+            return False
+        scope.invalidate()
+        return True
+
+    def dispose_scope(self, session_id: typing.Optional[int]) -> bool:
+        with self.__scopes_lock:
+            scope = self.__scopes.pop(session_id, None)
+        if scope is None:
+            return False
+        scope.dispose()
+        return True
+
+    def evict_idle(self) -> int:
+        with self.__scopes_lock:
+            evicted = self.__evict_idle()
+        for scope in evicted:
+            scope.dispose()
+        return len(evicted)
+
+    def __evict_idle(self) -> typing.List[ServiceScope]:
+        if self.__idle_timeout is None:
+            return list()
+        self.__last_sweep = time.monotonic()
+        deadline = self.__last_sweep - self.__idle_timeout
+        evicted = list()
+        while len(self.__scopes) != 0:
+            session_id, scope = next(iter(self.__scopes.items()))
+            if scope.last_used > deadline:
+                break
+            evicted.append(self.__evict(session_id))
+        return evicted
+
+    def __evict(self, session_id: typing.Optional[int]) -> ServiceScope:
+        self.__evicted_scopes += 1
+        return self.__scopes.pop(session_id)
+
+    def __resolve(self, plan: ConstructorPlan, session_id: typing.Optional[int],
+                  scope: typing.Optional[ServiceScope]) -> object:
+        lifespan = plan.definition.lifespan
+        source_type = plan.definition.source_type
+        if lifespan == LifeSpan.SINGLETON:
+            # realized singletons are read without locking, dict lookups are atomic
+            instance = self.__singletons.get(source_type)
+            if instance is not None:
+                return instance
+            with self.__singletons_lock:
+                instance = self.__singletons.get(source_type)
+                if instance is None:
+                    instance = self.__create(plan, session_id, scope)
+                    self.__singletons[source_type] = instance
+                return instance
+
+        if lifespan == LifeSpan.SCOPED:
+            if scope is None:
+                scope = self.get_scope(session_id)
+            instance = scope.instances.get(source_type)
+            if instance is not None:
+                return instance
+            with scope.lock:
+                instance = scope.instances.get(source_type)
+                if instance is None:
+                    instance = self.__create(plan, session_id, scope)
+                    scope.instances[source_type] = instance
+                return instance
+
+        return self.__create(plan, session_id, scope)
+
+    def __create(self, plan: ConstructorPlan, session_id: typing.Optional[int],
+                 scope: typing.Optional[ServiceScope]) -> object:
+        arguments = dict()
+        for param_name, dependency in plan.dependencies:
+            if dependency is None:
+                arguments[param_name] = None
+            else:
+                arguments[param_name] = self.__resolve(self.__plans[dependency], session_id, scope)
+        return plan.target_type(**arguments)
+
+    def __compile(self, definition: ServiceDefinition) -> ConstructorPlan:
         target_type: typing.Type = definition.source_type
         if definition.implementation_type is not None:
             target_type = definition.implementation_type
-        if definition.source_type in created:
-            raise RuntimeError(f"Recursive injection of type {target_type} is not allowed")
-
-        if definition.lifespan == LifeSpan.SINGLETON and (definition.source_type, 0) in self.__realized:
-            return self.__realized[(definition.source_type, 0)]
 
-        if definition.lifespan == LifeSpan.SCOPED and (definition.source_type, session_id) in self.__realized:
-            return self.__realized[(definition.source_type, session_id)]
-
-        created.append(definition.source_type)
+        try:
+            hints = typing.get_type_hints(target_type.__init__)
+        except Exception:
+            hints = dict()
+        dependencies = list()
         ctor_signature = inspect.signature(target_type.__init__)
-        param_dict = dict()
         for param_name, param_data in ctor_signature.parameters.items():
             if param_name == 'self' or param_data.kind == inspect.Parameter.VAR_POSITIONAL or param_data.kind == inspect.Parameter.VAR_KEYWORD:
                 continue
-            param_type = param_data.annotation
-            param_instance = self.__get_or_create_instance(param_type, session_id, created)
-
-            param_dict[param_name] = param_instance
-        obj_instance = target_type(**param_dict)
-
-        if definition.lifespan == LifeSpan.SCOPED:
-            self.__realized[(definition.source_type, session_id)] = obj_instance
-        elif definition.lifespan == LifeSpan.SINGLETON:
-            self.__realized[(definition.source_type, 0)] = obj_instance
-        return obj_instance
+            param_type = hints.get(param_name, param_data.annotation)
+            optional = False
+            # Optional[X] dependencies resolve X and stay None when it is not registered
+            if typing.get_origin(param_type) is typing.Union:
+                arguments = [argument for argument in typing.get_args(param_type) if argument is not type(None)]
+                if len(arguments) == 1:
+                    param_type = arguments[0]
+                    optional = True
+
+            dependency = self.__definitions.get(param_type) if param_type is not inspect.Parameter.empty else None
+            if dependency is not None:
+                dependencies.append((param_name, dependency.source_type))
+            elif param_data.default is not inspect.Parameter.empty:
+                continue
+            elif optional:
+                dependencies.append((param_name, None))
+            else:
+                raise RuntimeError(f"Cannot resolve parameter '{param_name}: {param_type}' of {target_type}, "
+                                   f"the type is not registered")
+        return ConstructorPlan(definition, target_type, tuple(dependencies))
+
+    def __validate(self):
+        # depth first search over the plans, a type met again on the current path closes a cycle
+        finished: typing.Set[typing.Type] = set()
+        for source_type in self.__plans:
+            self.__visit(source_type, list(), finished)
+        for plan in self.__plans.values():
+            if plan.definition.lifespan == LifeSpan.SINGLETON:
+                self.__check_captive(plan, plan)
+
+    def __check_captive(self, singleton: ConstructorPlan, plan: ConstructorPlan):
+        # a singleton would keep the scoped instance of whichever user created it first
+        for _, dependency in plan.dependencies:
+            if dependency is None:
+                continue
+            dependency_plan = self.__plans[dependency]
+            if dependency_plan.definition.lifespan == LifeSpan.SCOPED:
+                raise RuntimeError(f"Singleton {singleton.target_type} cannot depend on scoped "
+                                   f"{dependency_plan.target_type}")
+            if dependency_plan.definition.lifespan == LifeSpan.TRANSIENT:
+                self.__check_captive(singleton, dependency_plan)
+
+    def __visit(self, source_type: typing.Type, path: typing.List[typing.Type], finished: typing.Set[typing.Type]):
+        if source_type in finished:
+            return
+        if source_type in path:
+            cycle = path[path.index(source_type):] + [source_type]
+            raise RuntimeError("Recursive injection is not allowed: " +
+                               " -> ".join(str(self.__plans[item].target_type) for item in cycle))
+        path.append(source_type)
+        for _, dependency in self.__plans[source_type].dependencies:
+            if dependency is not None:
+                self.__visit(dependency, path, finished)
+        path.pop()
+        finished.add(source_type)
 
 
 class ServiceProvider(IServiceProvider):
 
-    def get_instance(self, obj_type: typing.Type, session_id: int = None) -> typing.Optional[object]:
+    def get_instance(self, obj_type: typing.Type, session_id: int = None,
+                     scope: typing.Optional[ServiceScope] = None) -> typing.Optional[object]:
         if self.__engine is None:
             return None
-        return self.__engine.get_or_create_instance(obj_type, session_id)
+        return self.__engine.get_or_create_instance(obj_type, session_id, scope)
 
     def __init__(self):
-        self.__engine: typing.Optional[IServiceEngine] = None
+        self.__engine: typing.Optional[ServiceEngine] = None
+
+    @property
+    def engine(self) -> typing.Optional[ServiceEngine]:
+        return self.__engine
+
+    def renew_scope(self, session_id: typing.Optional[int]) -> typing.Optional[ServiceScope]:
+        if self.__engine is None:
+            return None
+        return self.__engine.renew_scope(session_id)
+
+    def create_scope(self, session_id: typing.Optional[int]) -> typing.Optional[ServiceScope]:
+        if self.__engine is None:
+            return None
+        return self.__engine.create_scope(session_id)
+
+    def invalidate_scope(self, session_id: typing.Optional[int]) -> bool:
+        if self.__engine is None:
+            return False
+        return self.__engine.invalidate_scope(session_id)
+
+    def dispose_scope(self, session_id: typing.Optional[int]) -> bool:
+        if self.__engine is None:
+            return False
+        return self.__engine.dispose_scope(session_id)
 
-    def populate(self, services: typing.Tuple[ServiceDefinition]):
-        self.__engine = ServiceEngine(services)
+    def populate(self, services: typing.Tuple[ServiceDefinition], scope_policy: typing.Optional[ScopePolicy] = None):
+        self.__engine = ServiceEngine(services, scope_policy)
@@ -0,0 +1,139 @@
+import queue
+import threading
+import typing
+
+import telegram
+
+
+class OffsetTracker:
+
+    def __init__(self, offset: int = 0, ordered: bool = True):
+        self.__condition = threading.Condition()
+        # polled updates arrive in order, webhook ones come over parallel connections and may overtake each other
+        self.__ordered = ordered
+        # holds per update, an update is done once the handler and everything it waits for released it
+        self.__pending: typing.Dict[int, int] = dict()
+        self.__received = offset
+
+    @property
+    def offset(self) -> int:
+        # the offset may only move past an update once every update before it is done
+        with self.__condition:
+            return self.__current_offset()
+
+    @property
+    def pending_count(self) -> int:
+        with self.__condition:
+            return len(self.__pending)
+
+    @property
+    def received(self) -> int:
+        # every update below this id was handed out already, redelivered ones are not new work
+        with self.__condition:
+            return self.__received
+
+    def begin(self, update_id: int) -> bool:
+        with self.__condition:
+            if update_id in self.__pending or (self.__ordered and update_id < self.__received):
+                return False
+            self.__pending[update_id] = 1
+            self.__received = max(self.__received, update_id + 1)
+            return True
+
+    def retain(self, update_id: int):
+        # keeps the offset at the update until one more complete call, e.g. once its replies are delivered
+        with self.__condition:
+            if update_id in self.__pending:
+                self.__pending[update_id] += 1
+
+    def complete(self, update_id: int):
+        with self.__condition:
+            holds = self.__pending.get(update_id)
+            if holds is None:
+                return
+            if holds > 1:
+                self.__pending[update_id] = holds - 1
+                return
+            self.__pending.pop(update_id)
+            self.__condition.notify_all()
+
+    def wait_for_progress(self, offset: int, timeout: float = None) -> bool:
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__current_offset() != offset, timeout)
+
+    def __current_offset(self) -> int:
+        if len(self.__pending) != 0:
+            return min(self.__pending)
+        return self.__received
+
+
+class UpdateDispatcher:
+
+    def __init__(self, handler: typing.Callable[[telegram.Update], None], workers: int = 0,
+                 tracker: typing.Optional[OffsetTracker] = None,
+                 error_handler: typing.Callable[[telegram.Update, Exception], None] = None):
+        self.__handler = handler
+        self.__error_handler = error_handler
+        self.__tracker = tracker
+        self.__queues: typing.List[queue.Queue] = list()
+        self.__workers: typing.List[threading.Thread] = list()
+        for i in range(workers):
+            self.__queues.append(queue.Queue())
+            self.__workers.append(threading.Thread(target=self.__work, args=(self.__queues[i],),
+                                                   name="UpdateWorker-" + str(i), daemon=True))
+
+    @property
+    def tracker(self) -> typing.Optional[OffsetTracker]:
+        return self.__tracker
+
+    @property
+    def workers_count(self) -> int:
+        return len(self.__workers)
+
+    def start(self):
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self):
+        for worker_queue in self.__queues:
+            worker_queue.put(None)
+        for worker in self.__workers:
+            worker.join()
+
+    def dispatch(self, update: telegram.Update) -> bool:
+        if self.__tracker is not None and not self.__tracker.begin(update.update_id):
+            return False
+
+        if len(self.__workers) == 0:
+            self.__handle(update)
+            return True
+
+        self.__queues[self.__shard_of(update)].put(update)
+        return True
+
+    def __shard_of(self, update: telegram.Update) -> int:
+        # updates of the same user always land on the same worker, so they are handled in order
+        if update.effective_user is not None:
+            return update.effective_user.id % len(self.__queues)
+        return update.update_id % len(self.__queues)
+
+    def __work(self, worker_queue: queue.Queue):
+        while True:
+            update: typing.Optional[telegram.Update] = worker_queue.get()
+            if update is None:
+                return
+            self.__handle(update)
+
+    def __handle(self, update: telegram.Update):
+        # a failed update must not stop the worker or the polling loop, and still releases the offset
+        try:
+            self.__handler(update)
+        except Exception as exception:
+            if self.__error_handler is not None:
+                self.__error_handler(update, exception)
+        finally:
+            self.__complete(update)
+
+    def __complete(self, update: telegram.Update):
+        if self.__tracker is not None:
+            self.__tracker.complete(update.update_id)
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+import typing
+
+import telegram
+
+from runtime.bot import BotResponse
+from runtime.commands import ModelCommandBase
+from runtime.dependency_injection import ServiceProvider, ServiceScope
+from runtime.logging import Logger
+from runtime.metrics import PipelineMetrics
+from runtime.options import SessionExpiryOptions
+from runtime.outbound import OutboundDispatcher
+from runtime.resources import IResourceProvider
+from runtime.session import IExpiringSessionStorage
+from runtime.session_codec import ISessionCodec, PickleSessionCodec
+from runtime.user import User
+
+
+class SessionSweeper:
+    # removes sessions that were not committed for the idle timeout, a batch at a time from its own thread
+    DEFAULT_IDLE_TIMEOUT = 7 * 24 * 3600.0
+    DEFAULT_SWEEP_INTERVAL = 60.0
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_LANGUAGE = "en"
+
+    def __init__(self, storage: IExpiringSessionStorage, service_provider: ServiceProvider,
+                 options: SessionExpiryOptions, bot: typing.Optional[telegram.Bot] = None,
+                 outbound: typing.Optional[OutboundDispatcher] = None, metrics: typing.Optional[PipelineMetrics] = None):
+        self.__storage = storage
+        self.__service_provider = service_provider
+        self.__bot = bot
+        self.__outbound = outbound
+        self.__metrics = metrics
+        self.__idle_timeout = self.__option(options, "__idle_timeout__", self.DEFAULT_IDLE_TIMEOUT)
+        self.__sweep_interval = self.__option(options, "__sweep_interval__", self.DEFAULT_SWEEP_INTERVAL)
+        self.__batch_size = self.__option(options, "__batch_size__", self.DEFAULT_BATCH_SIZE)
+        self.__archive_path: typing.Optional[str] = options["__archive_path__"]
+        self.__language = self.__option(options, "__language__", self.DEFAULT_LANGUAGE)
+        self.__logger = typing.cast(Logger, service_provider.get_instance(Logger))
+        self.__codec: typing.Optional[ISessionCodec] = None
+        self.__expired = 0
+        self.__stopped = threading.Event()
+        self.__thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def idle_timeout(self) -> float:
+        return self.__idle_timeout
+
+    @property
+    def expired(self) -> int:
+        return self.__expired
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__sweep_loop, name="SessionSweeper", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def sweep(self, now: typing.Optional[float] = None) -> int:
+        # one batch, every session is checked again on removal, so users that came back in between are kept
+        if now is None:
+            now = time.time()
+        idle_since = now - self.__idle_timeout
+        expired = 0
+        for identifier in self.__storage.idle_sessions(idle_since, self.__batch_size):
+            object_inst = self.__storage.expire(identifier, idle_since)
+            if object_inst is None:
+                continue
+            expired += 1
+            try:
+                if self.__archive_path is not None:
+                    self.__archive(identifier, object_inst, now)
+                if isinstance(object_inst, dict) and "__current_command__" in object_inst:
+                    self.__notify(identifier, object_inst)
+            except Exception as exception:
+                if self.__logger is not None:
+                    self.__logger.error("session " + str(identifier) + " expiry failed: " +
+                                        str(exception.__class__) + " " + str(exception))
+            finally:
+                # the scope still holds the loaded session, the next request of the user must not see the draft
+                self.__service_provider.invalidate_scope(identifier)
+        self.__expired += expired
+        if self.__metrics is not None and expired != 0:
+            self.__metrics.sessions_expired(expired)
+        return expired
+
+    def __sweep_loop(self):
+        while not self.__stopped.wait(self.__sweep_interval):
+            try:
+                # full batches mean there is more to do, the next one follows without waiting
+                while self.sweep() >= self.__batch_size and not self.__stopped.is_set():
+                    pass
+            except Exception as exception:
+                if self.__logger is not None:
+                    self.__logger.error("session sweep failed: " + str(exception.__class__) + " " + str(exception))
+
+    def __archive(self, identifier: int, object_inst, now: float):
+        if self.__codec is None:
+            codec = typing.cast(ISessionCodec, self.__service_provider.get_instance(ISessionCodec))
+            self.__codec = codec if codec is not None else PickleSessionCodec()
+        if not os.path.exists(self.__archive_path):
+            os.makedirs(self.__archive_path)
+        out_stream = open(f"{self.__archive_path}{identifier}.{int(now)}.session", "wb")
+        out_stream.write(self.__codec.encode(object_inst))
+        out_stream.close()
+
+    def __notify(self, identifier: int, object_inst: typing.Dict[str, typing.Any]):
+        # a worker may be handling an update of the user right now, so the live scope is left alone
+        scope = self.__service_provider.create_scope(identifier)
+        try:
+            self.__notify_in(identifier, object_inst, scope)
+        finally:
+            scope.dispose()
+
+    def __notify_in(self, identifier: int, object_inst: typing.Dict[str, typing.Any], scope: ServiceScope):
+        resources = typing.cast(IResourceProvider,
+                                self.__service_provider.get_instance(IResourceProvider, identifier, scope))
+        resources.configuration = self.__language
+        model_definition = resources.get_model(object_inst["__current_command__"])
+        handler_class = ModelCommandBase
+        if model_definition.handler_class is not None:
+            handler_class = model_definition.handler_class
+        handler = typing.cast(ModelCommandBase, self.__service_provider.get_instance(handler_class, identifier, scope))
+        if handler is None:
+            return
+
+        user = User()
+        user.id = identifier
+        handler.services = self.__service_provider
+        handler.resources = resources
+        handler.user = user
+        handler.session = None
+        handler.bot_request = None
+        handler.bot_response = BotResponse()
+
+        model = None
+        if model_definition.command_class is not None:
+            model = model_definition.command_class()
+            for key, value in object_inst.items():
+                if key.startswith("__property_") and hasattr(model, key[len("__property_"):]):
+                    setattr(model, key[len("__property_"):], value)
+        handler.on_expired(model).attach_to(handler.bot_response)
+
+        for action in handler.bot_response.actions_queue:
+            if self.__outbound is not None:
+                self.__outbound.submit(action)
+            elif self.__bot is not None:
+                action.execute(self.__bot)
+
+    @staticmethod
+    def __option(options: SessionExpiryOptions, key: str, default):
+        value = options[key]
+        if value is None:
+            return default
+        return value
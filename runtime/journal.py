@@ -0,0 +1,197 @@
+import atexit
+import json
+import os
+import threading
+import time
+import typing
+
+import telegram
+
+
+class UpdateJournal:
+    RECEIVED = "received"
+    DONE = "done"
+    FAILED = "failed"
+    DEFAULT_COMPACT_RECORDS = 10000
+
+    def __init__(self, base_path: str = "journal/", sync_interval: float = 0.2, sync_batch: int = 64,
+                 compact_records: int = DEFAULT_COMPACT_RECORDS):
+        self.__base_path = base_path
+        self.__log_path = base_path + "updates.log"
+        self.__checkpoint_path = base_path + "checkpoint"
+        self.__sync_interval = sync_interval
+        self.__sync_batch = sync_batch
+        self.__compact_records = compact_records
+        self.__lock = threading.Lock()
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+        self.__offset = 0
+        self.__synced_offset = 0
+        self.__finished: typing.Set[int] = set()
+        # records in the log, and how many of them survived the last compaction
+        self.__records_count = 0
+        self.__kept_count = 0
+
+        if not os.path.exists(self.__base_path):
+            os.mkdir(self.__base_path)
+        if os.path.exists(self.__checkpoint_path):
+            checkpoint_file = open(self.__checkpoint_path, "r", encoding="utf-8")
+            content = checkpoint_file.read().strip()
+            checkpoint_file.close()
+            if len(content) != 0:
+                self.__offset = int(content)
+                self.__synced_offset = self.__offset
+        self.__cut_torn_tail()
+        for record in self.__records():
+            self.__records_count += 1
+            if record["id"] >= self.__offset and record["status"] != self.RECEIVED:
+                self.__finished.add(record["id"])
+        self.__log = open(self.__log_path, "a", encoding="utf-8")
+        atexit.register(self.close)
+
+    @property
+    def offset(self) -> int:
+        return self.__synced_offset
+
+    @property
+    def compact_due(self) -> bool:
+        # records kept by the last compaction are still in progress, only the ones appended since count
+        with self.__lock:
+            return self.__records_count - self.__kept_count >= self.__compact_records
+
+    def is_finished(self, update_id: int) -> bool:
+        # updates past the checkpoint may already be handled if the checkpoint was not synced before a crash
+        with self.__lock:
+            return update_id in self.__finished
+
+    def received(self, update: telegram.Update):
+        self.__append({"id": update.update_id, "status": self.RECEIVED, "update": update.to_dict()})
+
+    def done(self, update: telegram.Update):
+        self.__append({"id": update.update_id, "status": self.DONE})
+
+    def failed(self, update: telegram.Update, exception: Exception):
+        self.__append({"id": update.update_id, "status": self.FAILED, "error": str(exception.__class__) + " " + str(exception)})
+
+    def checkpoint(self, offset: int):
+        with self.__lock:
+            self.__offset = max(self.__offset, offset)
+            self.__sync_if_due()
+
+    def sync(self):
+        with self.__lock:
+            self.__sync()
+
+    def close(self):
+        with self.__lock:
+            self.__sync()
+            self.__log.close()
+
+    def read(self, bot: typing.Optional[telegram.Bot] = None, statuses: typing.Tuple[str, ...] = None,
+             from_update_id: int = 0) -> typing.Iterator[telegram.Update]:
+        # yields journaled updates in order, filtered by the last status recorded for them
+        with self.__lock:
+            self.__sync()
+        payloads: typing.Dict[int, dict] = dict()
+        last_status: typing.Dict[int, str] = dict()
+        for record in self.__records():
+            if record["id"] < from_update_id:
+                continue
+            if record["status"] == self.RECEIVED:
+                payloads[record["id"]] = record["update"]
+            last_status[record["id"]] = record["status"]
+
+        for update_id in sorted(payloads.keys()):
+            if statuses is not None and last_status[update_id] not in statuses:
+                continue
+            yield telegram.Update.de_json(payloads[update_id], bot)
+
+    def __append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.__lock:
+            if self.__log.closed:
+                return
+            self.__log.write(line)
+            self.__unsynced += 1
+            self.__records_count += 1
+            if record["status"] != self.RECEIVED:
+                self.__finished.add(record["id"])
+            self.__sync_if_due()
+
+    def __sync_if_due(self):
+        if self.__unsynced >= self.__sync_batch or time.monotonic() - self.__last_sync >= self.__sync_interval:
+            self.__sync()
+
+    def __sync(self):
+        if self.__log.closed:
+            return
+        # a single fsync covers every record appended since the previous one
+        self.__log.flush()
+        os.fsync(self.__log.fileno())
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+        if self.__offset != self.__synced_offset:
+            self.__write_checkpoint(self.__offset)
+            self.__synced_offset = self.__offset
+            self.__finished = set(update_id for update_id in self.__finished if update_id >= self.__offset)
+
+    def __write_checkpoint(self, offset: int):
+        temp_path = self.__checkpoint_path + ".tmp"
+        out_stream = open(temp_path, "w", encoding="utf-8")
+        out_stream.write(str(offset))
+        out_stream.flush()
+        os.fsync(out_stream.fileno())
+        out_stream.close()
+        os.replace(temp_path, self.__checkpoint_path)
+
+    def __cut_torn_tail(self):
+        # a crash in the middle of a write leaves a partial line, the next record must not be appended to it
+        if not os.path.exists(self.__log_path):
+            return
+        in_stream = open(self.__log_path, "rb")
+        end = in_stream.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - 4096)
+            in_stream.seek(start)
+            newline = in_stream.read(position - start).rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        in_stream.close()
+        if position != end:
+            os.truncate(self.__log_path, position)
+
+    def __records(self) -> typing.Iterator[dict]:
+        if not os.path.exists(self.__log_path):
+            return
+        in_stream = open(self.__log_path, "r", encoding="utf-8")
+        for line in in_stream:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the tail of the log may be torn by a crash in the middle of a write
+                continue
+        in_stream.close()
+
+    def compact(self):
+        # records below the checkpoint are settled, dropping them keeps only what a restart still needs
+        with self.__lock:
+            if self.__log.closed:
+                return
+            self.__sync()
+            self.__log.close()
+            kept = [record for record in self.__records() if record["id"] >= self.__synced_offset]
+
+            temp_path = self.__log_path + ".tmp"
+            out_stream = open(temp_path, "w", encoding="utf-8")
+            for record in kept:
+                out_stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out_stream.flush()
+            os.fsync(out_stream.fileno())
+            out_stream.close()
+            os.replace(temp_path, self.__log_path)
+            self.__log = open(self.__log_path, "a", encoding="utf-8")
+            self.__records_count = len(kept)
+            self.__kept_count = len(kept)
@@ -7,12 +7,16 @@ import os
 
 class Logger:
 
-    def __init__(self):
-        self.__base_path = "logs/"
+    def __init__(self, base_path: str = "logs/"):
+        self.__base_path = base_path
         if not os.path.exists(self.__base_path):
-            os.mkdir(self.__base_path)
+            os.makedirs(self.__base_path)
         self.__logfile = open(self.__base_path + "default log.txt", 'a', encoding='utf-8')
 
+    @property
+    def base_path(self) -> str:
+        return self.__base_path
+
     def info(self, message: str):
         self.__logfile.write(str(datetime.now()) + " info: " + message + "\n")
 
@@ -0,0 +1,336 @@
+import bisect
+import http.server
+import threading
+import typing
+
+
+class Counter:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__value = 0.0
+
+    @property
+    def value(self) -> float:
+        return self.__value
+
+    def inc(self, amount: float = 1.0):
+        with self.__lock:
+            self.__value += amount
+
+
+class Gauge:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__value = 0.0
+
+    @property
+    def value(self) -> float:
+        return self.__value
+
+    def set(self, value: float):
+        self.__value = value
+
+    def inc(self, amount: float = 1.0):
+        with self.__lock:
+            self.__value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self.__lock:
+            self.__value -= amount
+
+
+class Histogram:
+
+    def __init__(self, buckets: typing.Tuple[float, ...]):
+        self.__lock = threading.Lock()
+        self.__buckets = buckets
+        # the last slot counts observations above every bound, it becomes the +Inf bucket
+        self.__counts = [0] * (len(buckets) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+    @property
+    def buckets(self) -> typing.Tuple[float, ...]:
+        return self.__buckets
+
+    @property
+    def sum(self) -> float:
+        return self.__sum
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    def cumulative_counts(self) -> typing.List[int]:
+        with self.__lock:
+            counts = list(self.__counts)
+        total = 0
+        cumulative = list()
+        for count in counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.__buckets, value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value
+            self.__count += 1
+
+
+class Metric:
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+    def __init__(self, name: str, documentation: str, kind: str, label_names: typing.Tuple[str, ...] = (),
+                 buckets: typing.Optional[typing.Tuple[float, ...]] = None):
+        self.__name = name
+        self.__documentation = documentation
+        self.__kind = kind
+        self.__label_names = label_names
+        self.__buckets = buckets
+        self.__lock = threading.Lock()
+        self.__children: typing.Dict[typing.Tuple[str, ...], typing.Union[Counter, Gauge, Histogram]] = dict()
+        if len(label_names) == 0:
+            # unlabeled metrics are exported as zero before the first update
+            self.labels()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def documentation(self) -> str:
+        return self.__documentation
+
+    @property
+    def kind(self) -> str:
+        return self.__kind
+
+    @property
+    def label_names(self) -> typing.Tuple[str, ...]:
+        return self.__label_names
+
+    @property
+    def children(self) -> typing.List[typing.Tuple[typing.Tuple[str, ...], typing.Union[Counter, Gauge, Histogram]]]:
+        with self.__lock:
+            return list(self.__children.items())
+
+    def labels(self, *values) -> typing.Union[Counter, Gauge, Histogram]:
+        if len(values) != len(self.__label_names):
+            raise ValueError(f"Metric {self.__name} expects labels {self.__label_names}")
+        key = tuple(str(value) for value in values)
+        child = self.__children.get(key)
+        if child is None:
+            with self.__lock:
+                child = self.__children.get(key)
+                if child is None:
+                    child = self.__create_child()
+                    self.__children[key] = child
+        return child
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def __create_child(self) -> typing.Union[Counter, Gauge, Histogram]:
+        if self.__kind == self.COUNTER:
+            return Counter()
+        if self.__kind == self.GAUGE:
+            return Gauge()
+        return Histogram(self.__buckets)
+
+
+class MetricsRegistry:
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics: typing.Dict[str, Metric] = dict()
+        self.__callbacks: typing.Dict[str, typing.Tuple[str, typing.Callable[[], float]]] = dict()
+
+    def counter(self, name: str, documentation: str, label_names: typing.Tuple[str, ...] = ()) -> Metric:
+        return self.__metric(name, documentation, Metric.COUNTER, label_names, None)
+
+    def gauge(self, name: str, documentation: str, label_names: typing.Tuple[str, ...] = ()) -> Metric:
+        return self.__metric(name, documentation, Metric.GAUGE, label_names, None)
+
+    def histogram(self, name: str, documentation: str, label_names: typing.Tuple[str, ...] = (),
+                  buckets: typing.Tuple[float, ...] = DEFAULT_BUCKETS) -> Metric:
+        return self.__metric(name, documentation, Metric.HISTOGRAM, label_names, tuple(sorted(buckets)))
+
+    def gauge_callback(self, name: str, documentation: str, callback: typing.Callable[[], float]):
+        # evaluated on scrape, so values that are already tracked elsewhere cost nothing in between
+        with self.__lock:
+            self.__callbacks[name] = (documentation, callback)
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+            callbacks = list(self.__callbacks.items())
+
+        lines = list()
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for label_values, child in metric.children:
+                labels = self.__format_labels(metric.label_names, label_values)
+                if metric.kind == Metric.HISTOGRAM:
+                    cumulative = child.cumulative_counts()
+                    for bound, count in zip(child.buckets + (float("inf"),), cumulative):
+                        bucket_labels = self.__format_labels(metric.label_names + ("le",),
+                                                             label_values + (self.__format_value(bound),))
+                        lines.append(f"{metric.name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{metric.name}_sum{labels} {self.__format_value(child.sum)}")
+                    lines.append(f"{metric.name}_count{labels} {cumulative[-1]}")
+                else:
+                    lines.append(f"{metric.name}{labels} {self.__format_value(child.value)}")
+        for name, (documentation, callback) in callbacks:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {self.__format_value(callback())}")
+        return "\n".join(lines) + "\n"
+
+    def __metric(self, name: str, documentation: str, kind: str, label_names: typing.Tuple[str, ...],
+                 buckets: typing.Optional[typing.Tuple[float, ...]]) -> Metric:
+        with self.__lock:
+            if name in self.__metrics:
+                metric = self.__metrics[name]
+                if metric.kind != kind or metric.label_names != label_names:
+                    raise RuntimeError(f"Metric {name} is already registered as a different {metric.kind}")
+                return metric
+            metric = Metric(name, documentation, kind, label_names, buckets)
+            self.__metrics[name] = metric
+            return metric
+
+    @staticmethod
+    def __format_labels(names: typing.Tuple[str, ...], values: typing.Tuple[str, ...]) -> str:
+        if len(names) == 0:
+            return ""
+        pairs = list()
+        for name, value in zip(names, values):
+            escaped = value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            pairs.append(f"{name}=\"{escaped}\"")
+        return "{" + ",".join(pairs) + "}"
+
+    @staticmethod
+    def __format_value(value: float) -> str:
+        if value == float("inf"):
+            return "+Inf"
+        if float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    server: "MetricsServer"
+
+    def do_GET(self):
+        if self.path.split('?')[0] != self.server.path:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, path: str, registry: MetricsRegistry):
+        super().__init__((host, port), MetricsRequestHandler)
+        if not path.startswith('/'):
+            path = '/' + path
+        self.__path = path
+        self.__registry = registry
+        self.__thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def registry(self) -> MetricsRegistry:
+        return self.__registry
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, name="MetricsServer", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+
+class PipelineMetrics:
+    # the metric handles the runtime updates, created once so the hot path only does lookups by label
+
+    def __init__(self, registry: MetricsRegistry):
+        self.__registry = registry
+        self.__received = registry.counter("subot_updates_received_total", "Updates taken in by the pipeline")
+        self.__processed = registry.counter("subot_updates_processed_total", "Updates handled without an error")
+        self.__failed = registry.counter("subot_updates_failed_total", "Updates whose handling raised an error")
+        self.__update_latency = registry.histogram("subot_update_duration_seconds",
+                                                   "Time from taking an update to finishing it")
+        self.__session_load = registry.histogram("subot_session_load_seconds", "Session load time")
+        self.__session_commit = registry.histogram("subot_session_commit_seconds", "Session commit time")
+        self.__sessions_expired = registry.counter("subot_sessions_expired_total", "Idle sessions removed by the sweeper")
+        self.__api_latency = registry.histogram("subot_bot_api_duration_seconds",
+                                                "Time spent executing a command result against the bot api",
+                                                ("action",))
+        self.__api_errors = registry.counter("subot_bot_api_errors_total", "Failed command result executions",
+                                             ("action", "error"))
+
+    @property
+    def registry(self) -> MetricsRegistry:
+        return self.__registry
+
+    def update_received(self):
+        self.__received.inc()
+
+    def update_finished(self, duration: float, failed: bool = False):
+        if failed:
+            self.__failed.inc()
+        else:
+            self.__processed.inc()
+        self.__update_latency.observe(duration)
+
+    def session_loaded(self, duration: float):
+        self.__session_load.observe(duration)
+
+    def session_committed(self, duration: float):
+        self.__session_commit.observe(duration)
+
+    def sessions_expired(self, count: int):
+        self.__sessions_expired.inc(count)
+
+    def api_call(self, action: str, duration: float, error: typing.Optional[Exception] = None):
+        self.__api_latency.labels(action).observe(duration)
+        if error is not None:
+            self.__api_errors.labels(action, error.__class__.__name__).inc()
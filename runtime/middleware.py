@@ -1,14 +1,17 @@
+import asyncio
 import inspect
 import os
+import time
 import typing
 from datetime import datetime
 
 import telegram
 
 from runtime.command_model import PropertyDefinition, CommandModelDefinition
-from runtime.commands import ModelCommandBase, MessageResult
+from runtime.commands import CommandResult, CommandsBase, ModelCommandBase, MessageResult
 from runtime.context import Context
 from runtime.logging import Logger
+from runtime.metrics import MetricsRegistry
 from runtime.options import Options, CommandsOptions
 from runtime.resources import IResourceProvider
 from resources.designer import Resources
@@ -35,9 +38,13 @@ class Middleware:
 
 class CommandsMiddleware(Middleware):
 
-    def __init__(self, logger: Logger):
+    def __init__(self, logger: Logger, metrics: typing.Optional[MetricsRegistry] = None):
         super().__init__()
         self.__logger = logger
+        self.__command_latency = None
+        if metrics is not None:
+            self.__command_latency = metrics.histogram("subot_command_duration_seconds",
+                                                       "Time spent in command handlers", ("command",))
         self.__commands_modules = None
         self.__suppress_command = False
         self.__error_handler = None
@@ -56,7 +63,7 @@ class CommandsMiddleware(Middleware):
                         if func_name.endswith("_command"):
                             self.__functions_dict[func_name] = (module, class_name)
 
-    def invoke(self, context: Context):
+    def resolve_command(self, context: Context) -> typing.Optional[typing.Tuple[CommandsBase, str]]:
 
         if context.session is not None and context.session["__holding__"] is not None and context.session["__holding__"] != 0:
             context.session["__holding__"] -= 1
@@ -71,8 +78,7 @@ class CommandsMiddleware(Middleware):
         if command not in self.__functions_dict:
             command = "unknown_command"
         if command not in self.__functions_dict:
-            self.invoke_next(context)
-            return
+            return None
 
         controller = getattr(self.__functions_dict[command][0], self.__functions_dict[command][1])
         class_instance = context.services.get_instance(controller, context.user.id)
@@ -82,24 +88,23 @@ class CommandsMiddleware(Middleware):
         class_instance.user = context.user
         class_instance.bot_request = context.bot_request
         class_instance.bot_response = context.bot_response
+        return class_instance, command
+
+    def handle_error(self, context: Context, class_instance: CommandsBase, exception: Exception) -> typing.Optional[CommandResult]:
+        self.__logger.error(str(exception) + " " + str(exception))
+        if self.__error_handler is None:
+            self.__logger.warn("error handler not found")
+            if getattr(class_instance, "error_handler", None) is None:
+                raise exception
+            self.__logger.info("using error handler for class " + str(class_instance))
+            handler = getattr(class_instance, "error_handler")
+            return handler(exception)
+        else:
+            self.__logger.info("using common error handler")
+            self.__error_handler(exception, context)
+            return None
 
-        command_callable = getattr(class_instance, command)
-        try:
-            command_result = command_callable(context.bot_request.args)
-        except Exception as exception:
-            self.__logger.error(str(exception) + " " + str(exception))
-            if self.__error_handler is None:
-                self.__logger.warn("error handler not found")
-                if getattr(class_instance, "error_handler", None) is None:
-                    raise exception
-                self.__logger.info("using error handler for class " + str(class_instance))
-                handler = getattr(class_instance, "error_handler")
-                command_result = handler(exception)
-            else:
-                self.__logger.info("using common error handler")
-                self.__error_handler(exception, context)
-                return
-
+    def complete_command(self, context: Context, class_instance: CommandsBase, command: str, command_result: CommandResult):
         command_result.attach_to(context.bot_response)
 
         if class_instance.session is not None and class_instance.session["__redir__"] == 1:
@@ -109,9 +114,87 @@ class CommandsMiddleware(Middleware):
             self.__logger.info("redirected")
             class_instance.session["__command__"] = command
 
+    def observe_command(self, command: str, started: float):
+        if self.__command_latency is not None:
+            self.__command_latency.labels(command).observe(time.perf_counter() - started)
+
+    def invoke(self, context: Context):
+        resolved = self.resolve_command(context)
+        if resolved is None:
+            self.invoke_next(context)
+            return
+
+        class_instance, command = resolved
+        command_callable = getattr(class_instance, command)
+        started = time.perf_counter()
+        try:
+            command_result = command_callable(context.bot_request.args)
+        except Exception as exception:
+            command_result = self.handle_error(context, class_instance, exception)
+            if command_result is None:
+                return
+        finally:
+            self.observe_command(command, started)
+
+        self.complete_command(context, class_instance, command, command_result)
         self.invoke_next(context)
 
 
+class AsyncMiddleware:
+
+    def __init__(self):
+        self.__next: typing.Optional[typing.Callable[[Context], typing.Awaitable[None]]] = None
+
+    async def invoke(self, context: Context):
+        await self.invoke_next(context)
+
+    async def invoke_next(self, context: Context):
+        if self.__next is not None:
+            await self.__next(context)
+
+    def set_next(self, next_middleware_invoker: typing.Optional[typing.Callable[[Context], typing.Awaitable[None]]]):
+        self.__next = next_middleware_invoker
+
+    def configure(self, options: Options):
+        pass
+
+
+class AsyncCommandsMiddleware(AsyncMiddleware):
+
+    def __init__(self, logger: Logger, metrics: typing.Optional[MetricsRegistry] = None):
+        super().__init__()
+        self.__commands = CommandsMiddleware(logger, metrics)
+
+    def configure(self, options: CommandsOptions):
+        self.__commands.configure(options)
+
+    async def invoke(self, context: Context):
+        resolved = self.__commands.resolve_command(context)
+        if resolved is None:
+            await self.invoke_next(context)
+            return
+
+        class_instance, command = resolved
+        command_callable = getattr(class_instance, command)
+        started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(command_callable):
+                command_result = await command_callable(context.bot_request.args)
+            else:
+                # plain handlers are blocking, so they run on the loop's executor
+                loop = asyncio.get_running_loop()
+                command_result = await loop.run_in_executor(None, command_callable, context.bot_request.args)
+        except Exception as exception:
+            command_result = self.__commands.handle_error(context, class_instance, exception)
+            if command_result is None:
+                return
+        finally:
+            self.__commands.observe_command(command, started)
+
+        self.__commands.complete_command(context, class_instance, command, command_result)
+        await self.invoke_next(context)
+
+
 class CommandsModelMiddleware(Middleware):
 
     def __init__(self):
@@ -159,9 +242,9 @@ class CommandsModelMiddleware(Middleware):
                 context.session["__current_state__"] = "init"
 
         model_definition = context.resources.get_model(context.session["__current_command__"])
-        handler: ModelCommandBase = context.services.get_instance(ModelCommandBase)
+        handler: ModelCommandBase = context.services.get_instance(ModelCommandBase, context.user.id)
         if model_definition.handler_class is not None:
-            handler = context.services.get_instance(model_definition.handler_class)
+            handler = context.services.get_instance(model_definition.handler_class, context.user.id)
 
         handler.services = context.services
         handler.session = context.session
@@ -437,9 +520,10 @@ class CommandsModelMiddleware(Middleware):
 
 class LoggingMiddleware(Middleware):
 
-    def __init__(self):
+    def __init__(self, logger: typing.Optional[Logger] = None):
         super().__init__()
-        self.__log_path = "logs/"
+        # request logs go next to the default log
+        self.__log_path = logger.base_path if logger is not None else "logs/"
 
     def invoke(self, context: Context):
         if not os.path.exists(self.__log_path):
@@ -24,3 +24,39 @@ class CommandsOptions(Options):
 
     def use_commands_modules(self, modules: typing.List):
         self["__modules__"] = modules
+
+
+class OutboundOptions(Options):
+
+    def use_workers(self, count: int):
+        self["__workers__"] = count
+
+    def use_global_rate(self, messages_per_second: float, burst: int = None):
+        self["__global_rate__"] = messages_per_second
+        self["__global_burst__"] = burst
+
+    def use_chat_rate(self, messages_per_second: float, burst: int = None):
+        self["__chat_rate__"] = messages_per_second
+        self["__chat_burst__"] = burst
+
+    def use_max_retries(self, count: int):
+        self["__max_retries__"] = count
+
+
+class SessionExpiryOptions(Options):
+
+    def use_idle_timeout(self, seconds: float):
+        self["__idle_timeout__"] = seconds
+
+    def use_sweep_interval(self, seconds: float):
+        self["__sweep_interval__"] = seconds
+
+    def use_batch_size(self, count: int):
+        self["__batch_size__"] = count
+
+    def use_archive(self, base_path: str):
+        self["__archive_path__"] = base_path
+
+    def use_language(self, language_code: str):
+        # expired drafts are reported without an update, so the user's language is not known
+        self["__language__"] = language_code
@@ -0,0 +1,286 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+import typing
+
+import telegram
+import telegram.error
+
+from runtime.commands import CommandResult, EmptyResult
+from runtime.logging import Logger
+from runtime.metrics import PipelineMetrics
+from runtime.options import OutboundOptions
+from runtime.tracing import Tracer
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: int):
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = float(capacity)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self.__lock:
+            self.__refill()
+            if self.__tokens >= 1:
+                return 0.0
+            return (1 - self.__tokens) / self.__rate
+
+    def try_acquire(self) -> float:
+        # returns 0 when a token was taken, otherwise the time to wait for the next one
+        with self.__lock:
+            self.__refill()
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0.0
+            return (1 - self.__tokens) / self.__rate
+
+    @property
+    def full(self) -> bool:
+        with self.__lock:
+            self.__refill()
+            return self.__tokens >= self.__capacity
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+
+class OutboundDispatcher:
+    DEFAULT_WORKERS = 4
+    DEFAULT_GLOBAL_RATE = 30.0
+    DEFAULT_CHAT_RATE = 1.0
+    DEFAULT_CHAT_BURST = 3
+    DEFAULT_MAX_RETRIES = 5
+    BACKOFF_BASE = 0.5
+    MAX_IDLE_BUCKETS = 4096
+
+    def __init__(self, bot: telegram.Bot, options: OutboundOptions, logger: typing.Optional[Logger] = None,
+                 tracer: typing.Optional[Tracer] = None, metrics: typing.Optional[PipelineMetrics] = None):
+        self.__bot = bot
+        self.__logger = logger
+        self.__tracer = tracer
+        self.__metrics = metrics
+        workers = self.__option(options, "__workers__", self.DEFAULT_WORKERS)
+        global_rate = self.__option(options, "__global_rate__", self.DEFAULT_GLOBAL_RATE)
+        self.__chat_rate = self.__option(options, "__chat_rate__", self.DEFAULT_CHAT_RATE)
+        self.__chat_burst = self.__option(options, "__chat_burst__", self.DEFAULT_CHAT_BURST)
+        self.__max_retries = self.__option(options, "__max_retries__", self.DEFAULT_MAX_RETRIES)
+        self.__global_bucket = TokenBucket(global_rate, self.__option(options, "__global_burst__", int(global_rate)))
+        self.__chat_buckets: typing.Dict[typing.Optional[int], TokenBucket] = dict()
+
+        self.__condition = threading.Condition()
+        self.__chats: typing.Dict[typing.Optional[int], typing.Deque[typing.List]] = dict()
+        self.__ready: typing.List[typing.Tuple[float, int, typing.Optional[int]]] = list()
+        # actions not sent or dropped yet per update, and what waits for them to be done with
+        self.__update_actions: typing.Dict[int, int] = dict()
+        self.__delivery_callbacks: typing.Dict[int, typing.List[typing.Callable[[], None]]] = dict()
+        self.__sequence = itertools.count()
+        self.__running = False
+        self.__queue_depth = 0
+        self.__sent = 0
+        self.__retried = 0
+        self.__dropped = 0
+        self.__workers = [threading.Thread(target=self.__work, name="OutboundWorker-" + str(i), daemon=True)
+                          for i in range(workers)]
+
+    @property
+    def queue_depth(self) -> int:
+        return self.__queue_depth
+
+    @property
+    def sent(self) -> int:
+        return self.__sent
+
+    @property
+    def retried(self) -> int:
+        return self.__retried
+
+    @property
+    def dropped(self) -> int:
+        return self.__dropped
+
+    @property
+    def running(self) -> bool:
+        return self.__running
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self, timeout: float = None):
+        with self.__condition:
+            if timeout is not None:
+                self.__condition.wait_for(lambda: self.__queue_depth == 0, timeout)
+            self.__running = False
+            self.__condition.notify_all()
+        for worker in self.__workers:
+            worker.join()
+
+    def submit(self, action: CommandResult, update_id: typing.Optional[int] = None):
+        if isinstance(action, EmptyResult):
+            return
+        chat_id = action.chat_id
+        with self.__condition:
+            self.__queue_depth += 1
+            if update_id is not None:
+                self.__update_actions[update_id] = self.__update_actions.get(update_id, 0) + 1
+            if chat_id in self.__chats:
+                # the chat is either scheduled or being sent, its queue is picked up afterwards
+                self.__chats[chat_id].append([action, 0, update_id])
+                return
+            self.__chats[chat_id] = collections.deque([[action, 0, update_id]])
+            self.__schedule(chat_id, 0.0)
+
+    def when_delivered(self, update_id: int, callback: typing.Callable[[], None]):
+        # runs the callback once every action submitted for the update so far was sent or dropped
+        with self.__condition:
+            if update_id in self.__update_actions:
+                self.__delivery_callbacks.setdefault(update_id, list()).append(callback)
+                return
+        callback()
+
+    def __schedule(self, chat_id: typing.Optional[int], delay: float):
+        heapq.heappush(self.__ready, (time.monotonic() + delay, next(self.__sequence), chat_id))
+        self.__condition.notify()
+
+    def __next_chat(self) -> typing.Tuple[bool, typing.Optional[int]]:
+        with self.__condition:
+            while self.__running:
+                if len(self.__ready) != 0:
+                    wait = self.__ready[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return True, heapq.heappop(self.__ready)[2]
+                    self.__condition.wait(wait)
+                else:
+                    self.__condition.wait()
+            return False, None
+
+    def __work(self):
+        while True:
+            running, chat_id = self.__next_chat()
+            if not running:
+                return
+            # a chat is only in the ready heap once, so a single worker owns its queue until it is rescheduled
+            entry = self.__chats[chat_id][0]
+            delay = self.__send(chat_id, entry)
+            callbacks = None
+            with self.__condition:
+                chat_queue = self.__chats[chat_id]
+                if delay is None:
+                    chat_queue.popleft()
+                    self.__queue_depth -= 1
+                    self.__condition.notify_all()
+                    delay = 0.0
+                    callbacks = self.__delivered(entry[2])
+                if len(chat_queue) == 0:
+                    self.__chats.pop(chat_id)
+                    if len(self.__chat_buckets) > self.MAX_IDLE_BUCKETS:
+                        self.__prune_buckets()
+                else:
+                    self.__schedule(chat_id, delay)
+            if callbacks is not None:
+                self.__notify_delivered(callbacks)
+
+    def __delivered(self, update_id: typing.Optional[int]) -> typing.Optional[typing.List[typing.Callable[[], None]]]:
+        if update_id is None:
+            return None
+        remaining = self.__update_actions[update_id] - 1
+        if remaining != 0:
+            self.__update_actions[update_id] = remaining
+            return None
+        self.__update_actions.pop(update_id)
+        return self.__delivery_callbacks.pop(update_id, None)
+
+    def __notify_delivered(self, callbacks: typing.List[typing.Callable[[], None]]):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as exception:
+                if self.__logger is not None:
+                    self.__logger.error("delivery callback failed: " + str(exception.__class__) + " " + str(exception))
+
+    def __send(self, chat_id: typing.Optional[int], entry: typing.List) -> typing.Optional[float]:
+        # returns None once the action is done with, otherwise the delay before the next attempt
+        chat_bucket = self.__chat_bucket(chat_id)
+        delay = chat_bucket.delay()
+        if delay > 0:
+            return delay
+        delay = self.__global_bucket.try_acquire()
+        if delay > 0:
+            return delay
+        chat_bucket.try_acquire()
+
+        action, attempts, update_id = entry
+        started = time.perf_counter()
+        try:
+            if self.__tracer is None:
+                action.execute(self.__bot)
+            else:
+                with self.__tracer.span(action.__class__.__name__ + ".execute", "outbound", update_id, chat_id):
+                    action.execute(self.__bot)
+            self.__observe(action, started)
+            with self.__condition:
+                self.__sent += 1
+            return None
+        except telegram.error.RetryAfter as error:
+            self.__observe(action, started, error)
+            return self.__retry(entry, float(error.retry_after), error)
+        except telegram.error.BadRequest as error:
+            self.__observe(action, started, error)
+            self.__drop(action, error)
+            return None
+        except telegram.error.NetworkError as error:
+            self.__observe(action, started, error)
+            return self.__retry(entry, self.BACKOFF_BASE * (2 ** attempts), error)
+        except Exception as error:
+            self.__observe(action, started, error)
+            self.__drop(action, error)
+            return None
+
+    def __observe(self, action: CommandResult, started: float, error: typing.Optional[Exception] = None):
+        if self.__metrics is not None:
+            self.__metrics.api_call(action.__class__.__name__, time.perf_counter() - started, error)
+
+    def __retry(self, entry: typing.List, delay: float, error: Exception) -> typing.Optional[float]:
+        if entry[1] >= self.__max_retries:
+            self.__drop(entry[0], error)
+            return None
+        entry[1] += 1
+        with self.__condition:
+            self.__retried += 1
+        return delay
+
+    def __drop(self, action: CommandResult, error: Exception):
+        with self.__condition:
+            self.__dropped += 1
+        if self.__logger is not None:
+            self.__logger.error("dropped " + action.__class__.__name__ + " for chat " + str(action.chat_id) + ": " +
+                                str(error.__class__) + " " + str(error))
+
+    def __chat_bucket(self, chat_id: typing.Optional[int]) -> TokenBucket:
+        with self.__condition:
+            if chat_id not in self.__chat_buckets:
+                self.__chat_buckets[chat_id] = TokenBucket(self.__chat_rate, self.__chat_burst)
+            return self.__chat_buckets[chat_id]
+
+    def __prune_buckets(self):
+        # a full bucket carries no rate history, so it can be recreated on the next message
+        for chat_id in list(self.__chat_buckets.keys()):
+            if chat_id not in self.__chats and self.__chat_buckets[chat_id].full:
+                self.__chat_buckets.pop(chat_id)
+
+    @staticmethod
+    def __option(options: OutboundOptions, key: str, default):
+        if options[key] is None:
+            return default
+        return options[key]
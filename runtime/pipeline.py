@@ -1,5 +1,7 @@
 import threading
+import time
 import typing
+import weakref
 
 import telegram
 
@@ -7,144 +9,557 @@ from runtime.bot import BotRequest, BotResponse
 from runtime.builder import ApplicationBuilder
 from runtime.commands import RedirectToCommandResult
 from runtime.context import Context
-from runtime.dependency_injection import ServiceCollection, ServiceProvider
+from runtime.dependency_injection import LifeSpan, ServiceCollection, ServiceProvider
+from runtime.dispatcher import OffsetTracker, UpdateDispatcher
+from runtime.expiry import SessionSweeper
+from runtime.journal import UpdateJournal
+from runtime.logging import Logger
+from runtime.metrics import MetricsRegistry, MetricsServer, PipelineMetrics
 from runtime.middleware import Middleware
+from runtime.options import Options
+from runtime.outbound import OutboundDispatcher
+from runtime.polling import AdaptivePoller, PollingStatistics
 from runtime.resources import IResourceProvider
-from runtime.session import ISession
+from runtime.session import IBufferedSessionStorage, IExpiringSessionStorage, ISession, ISessionStorage
+from runtime.tracing import NULL_SPAN, Tracer
 from runtime.user import User
+from runtime.webhook import WebhookServer
+
+
+class ScopedMiddlewareInvoker:
+
+    def __init__(self, middleware_type: typing.Type, options: typing.Optional[Options],
+                 next_invoker: typing.Optional[typing.Callable[[Context], None]], service_provider: ServiceProvider):
+        self.__middleware_type = middleware_type
+        self.__options = options
+        self.__next = next_invoker
+        self.__service_provider = service_provider
+        self.__configured: weakref.WeakSet = weakref.WeakSet()
+        self.__lock = threading.Lock()
+
+    def resolve(self, context: Context):
+        instance = self.__service_provider.get_instance(self.__middleware_type, context.user.id)
+        if instance not in self.__configured:
+            with self.__lock:
+                if instance not in self.__configured:
+                    if self.__options is not None:
+                        instance.configure(self.__options)
+                    instance.set_next(self.__next)
+                    self.__configured.add(instance)
+        return instance
+
+    def invoke(self, context: Context):
+        self.resolve(context).invoke(context)
+
+    async def invoke_async(self, context: Context):
+        await self.resolve(context).invoke(context)
+
+
+class CompiledPipeline:
+
+    def __init__(self, components: typing.Tuple[typing.Tuple[typing.Type[Middleware], typing.Callable[[], Options]], ...],
+                 services: ServiceCollection, service_provider: ServiceProvider, tracer: typing.Optional[Tracer] = None):
+        invokers: typing.List[typing.Callable[[Context], None]] = list()
+        next_invoker: typing.Optional[typing.Callable[[Context], None]] = None
+
+        for middleware_type, configurator in reversed(components):
+            definition = services.get_service(middleware_type)
+            if definition is None:
+                raise RuntimeError(f"Middleware {middleware_type} is not registered")
+            options = None
+            if configurator is not None:
+                options = configurator()
+
+            if definition.lifespan == LifeSpan.SINGLETON:
+                instance = typing.cast(Middleware, service_provider.get_instance(middleware_type))
+                if options is not None:
+                    instance.configure(options)
+                instance.set_next(next_invoker)
+                next_invoker = instance.invoke
+            else:
+                # scoped middleware is resolved per user and configured once per instance
+                next_invoker = ScopedMiddlewareInvoker(middleware_type, options, next_invoker, service_provider).invoke
+            if tracer is not None:
+                next_invoker = tracer.wrap(middleware_type.__name__, "middleware", next_invoker)
+            invokers.append(next_invoker)
+
+        invokers.reverse()
+        self.__invokers: typing.Tuple[typing.Callable[[Context], None], ...] = tuple(invokers)
+        self.__entry = next_invoker
+
+    @property
+    def invokers(self) -> typing.Tuple[typing.Callable[[Context], None], ...]:
+        return self.__invokers
+
+    @property
+    def empty(self) -> bool:
+        return self.__entry is None
+
+    def invoke(self, context: Context):
+        if self.__entry is not None:
+            self.__entry(context)
+
+
+class ContextFactory:
+
+    def __init__(self, service_provider: ServiceProvider):
+        self.__service_provider = service_provider
+
+    @staticmethod
+    def create_request(update: telegram.Update) -> BotRequest:
+        request = BotRequest()
+        request.update_id = update.update_id
+        if update.message is not None:
+            message: telegram.Message = update.message
+            if message.text is not None:
+                message_text: str = message.text
+                message_data = message_text.split()
+                request.message_text = message_text
+                if request.message_text.startswith('/'):
+                    request.command = message_data[0]
+                    if len(message_data) == 1:
+                        request.args = []
+                    else:
+                        request.args = message_data[1:]
+                else:
+                    request.command = None
+                    request.args = message_data
+                request.callback_text = None
+                request.message_id = message.message_id
+                request.is_callback = False
+        if update.callback_query is not None:
+            callback_query: telegram.CallbackQuery = update.callback_query
+            if callback_query.data is not None:
+                callback_text: str = callback_query.data
+                callback_data = callback_text.split()
+                request.message_text = callback_text
+                if callback_text.startswith('/'):
+                    request.command = callback_data[0]
+                    if len(callback_data) == 1:
+                        request.args = []
+                    else:
+                        request.args = callback_data[1:]
+                else:
+                    request.command = None
+                    request.args = callback_data
+                request.callback_text = callback_text
+                callback_message: telegram.Message = callback_query.message
+                request.message_id = callback_message.message_id
+                request.is_callback = True
+        return request
+
+    @staticmethod
+    def create_user(telegram_user: telegram.User) -> User:
+        user = User()
+        user.id = telegram_user.id
+        user.username = telegram_user.username
+        user.first_name = telegram_user.first_name
+        user.last_name = telegram_user.last_name
+        return user
+
+    def create_context(self, update: telegram.Update) -> Context:
+        context = Context()
+        telegram_user: telegram.User = update.effective_user
+        user = self.create_user(telegram_user)
+        # a scope invalidated since the previous request of the user, e.g. by session expiry, is replaced now
+        self.__service_provider.renew_scope(user.id)
+        # session and resources carry per-request state, so they come from the user's scope
+        session = typing.cast(ISession, self.__service_provider.get_instance(ISession, user.id))
+        resources = typing.cast(IResourceProvider, self.__service_provider.get_instance(IResourceProvider, user.id))
+
+        context.session = session
+        context.services = self.__service_provider
+        context.bot_request = self.create_request(update)
+        context.bot_response = BotResponse()
+        context.configuration = telegram_user.language_code
+        context.user = user
+        context.resources = resources
+        session.id = user.id
+        resources.configuration = context.configuration
+        return context
+
+
+class UpdateProcessor:
+
+    def __init__(self, bot: telegram.Bot, service_provider: ServiceProvider, pipeline: CompiledPipeline,
+                 outbound: typing.Optional[OutboundDispatcher] = None, journal: typing.Optional[UpdateJournal] = None,
+                 tracer: typing.Optional[Tracer] = None, metrics: typing.Optional[PipelineMetrics] = None):
+        self.__bot = bot
+        self.__service_provider = service_provider
+        self.__pipeline = pipeline
+        self.__outbound = outbound
+        self.__journal = journal
+        self.__tracer = tracer
+        self.__metrics = metrics
+        self.__context_factory = ContextFactory(service_provider)
+
+    def process(self, update: telegram.Update, finished: typing.Optional[typing.Callable[[telegram.Update], None]] = None):
+        # finished is called once the replies queued for the update were delivered, not when handling returns
+        if self.__journal is None and self.__metrics is None and finished is None:
+            while self.__handle_update(update):
+                pass
+            return
+
+        started = time.perf_counter()
+        if self.__metrics is not None:
+            self.__metrics.update_received()
+        try:
+            if self.__journal is not None:
+                self.__journal.received(update)
+            while self.__handle_update(update):
+                pass
+        except Exception as exception:
+            if self.__journal is not None:
+                self.__journal.failed(update, exception)
+            if self.__metrics is not None:
+                self.__metrics.update_finished(time.perf_counter() - started, True)
+            if finished is not None:
+                self.__when_delivered(update, lambda: finished(update))
+            raise
+        if self.__metrics is not None:
+            self.__metrics.update_finished(time.perf_counter() - started)
+        if self.__journal is not None or finished is not None:
+            self.__when_delivered(update, lambda: self.__done(update, finished))
+
+    def process_tracked(self, update: telegram.Update, tracker: OffsetTracker):
+        # the offset stays at the update until its replies are sent, so it is handled again after a crash
+        tracker.retain(update.update_id)
+        self.process(update, lambda finished: tracker.complete(finished.update_id))
+
+    def __when_delivered(self, update: telegram.Update, callback: typing.Callable[[], None]):
+        if self.__outbound is None:
+            callback()
+        else:
+            self.__outbound.when_delivered(update.update_id, callback)
+
+    def __done(self, update: telegram.Update, finished: typing.Optional[typing.Callable[[telegram.Update], None]]):
+        # a restart handles the update again unless its replies reached the user
+        if self.__journal is not None:
+            self.__journal.done(update)
+        if finished is not None:
+            finished(update)
+
+    def on_error(self, update: telegram.Update, exception: Exception):
+        logger = typing.cast(Logger, self.__service_provider.get_instance(Logger))
+        if logger is not None:
+            logger.error("update " + str(update.update_id) + " failed: " + str(exception.__class__) + " " + str(exception))
+
+    def __handle_update(self, update: telegram.Update) -> bool:
+        context = self.__context_factory.create_context(update)
+        session = context.session
+        started = time.perf_counter()
+        with self.__span("session.load", "session", context):
+            session.load()
+        if self.__metrics is not None:
+            self.__metrics.session_loaded(time.perf_counter() - started)
+
+        if not self.__pipeline.empty:
+            self.__pipeline.invoke(context)
+            started = time.perf_counter()
+            with self.__span("session.commit", "session", context):
+                session.commit()
+            if self.__metrics is not None:
+                self.__metrics.session_committed(time.perf_counter() - started)
+            context.bot_response.coalesce()
+            redirected = False
+            while len(context.bot_response.actions_queue) > 0:
+                result = context.bot_response.pop_action_at(0)
+                if isinstance(result, RedirectToCommandResult):
+                    redirected = True
+                    break
+                if self.__outbound is not None:
+                    self.__outbound.submit(result, update.update_id)
+                    continue
+                started = time.perf_counter()
+                try:
+                    with self.__span(result.__class__.__name__ + ".execute", "result", context):
+                        result.execute(self.__bot)
+                    if self.__metrics is not None:
+                        self.__metrics.api_call(result.__class__.__name__, time.perf_counter() - started)
+                except Exception as exception:
+                    if self.__metrics is not None:
+                        self.__metrics.api_call(result.__class__.__name__, time.perf_counter() - started, exception)
+            return redirected
+        return False
+
+    def __span(self, name: str, category: str, context: Context):
+        if self.__tracer is None:
+            return NULL_SPAN
+        return self.__tracer.span(name, category, context.bot_request.update_id, context.user.id)
 
 
 class Pipeline:
 
     def __init__(self):
         self.__app_builder: typing.Optional[ApplicationBuilder] = None
-        self.__polling_daemon: typing.Optional[threading.Thread] = None
-        self.__services: typing.Optional[ServiceCollection] = None
+        self.__polling_daemon: typing.Optional[MainDaemon] = None
+        self.__webhook_server: typing.Optional[WebhookServer] = None
+        self.__checkpoint_daemon: typing.Optional[CheckpointDaemon] = None
+        self.__service_provider: typing.Optional[ServiceProvider] = None
+        self.__compiled: typing.Optional[CompiledPipeline] = None
+        self.__outbound: typing.Optional[OutboundDispatcher] = None
+        self.__journal: typing.Optional[UpdateJournal] = None
+        self.__tracer: typing.Optional[Tracer] = None
+        self.__metrics: typing.Optional[PipelineMetrics] = None
+        self.__metrics_server: typing.Optional[MetricsServer] = None
+        self.__sweeper: typing.Optional[SessionSweeper] = None
 
     def configure(self, app_builder: ApplicationBuilder, services: ServiceCollection):
         self.__app_builder = app_builder
-        self.__services = services
+        self.__service_provider = ServiceProvider()
+        self.__service_provider.populate(services.services, services.scope_policy)
+        self.__tracer = None
+        if app_builder.tracing_capacity is not None:
+            self.__tracer = Tracer(app_builder.tracing_capacity)
+        self.__compiled = CompiledPipeline(app_builder.build(), services, self.__service_provider, self.__tracer)
+        self.__metrics = None
+        registry = typing.cast(MetricsRegistry, self.__service_provider.get_instance(MetricsRegistry))
+        if registry is not None:
+            self.__metrics = PipelineMetrics(registry)
+            engine = self.__service_provider.engine
+            registry.gauge_callback("subot_di_live_scopes", "Per-user service scopes held in memory",
+                                    lambda: engine.live_scopes)
+            registry.gauge_callback("subot_di_live_instances", "Singleton and scoped instances held in memory",
+                                    lambda: engine.live_instances)
+            registry.gauge_callback("subot_di_evicted_scopes", "Service scopes evicted since start",
+                                    lambda: engine.evicted_scopes)
+        elif app_builder.metrics_endpoint is not None:
+            raise RuntimeError(f"Metrics endpoint requires {MetricsRegistry} to be registered")
+        self.__outbound = None
+        if app_builder.outbound_configurator is not None:
+            logger = typing.cast(Logger, self.__service_provider.get_instance(Logger))
+            self.__outbound = OutboundDispatcher(app_builder.bot, app_builder.outbound_configurator(), logger,
+                                                 self.__tracer, self.__metrics)
+            if registry is not None:
+                outbound = self.__outbound
+                registry.gauge_callback("subot_outbound_queue_depth", "Actions waiting to be sent",
+                                        lambda: outbound.queue_depth)
+        self.__journal = None
+        if app_builder.journal_path is not None:
+            self.__journal = UpdateJournal(app_builder.journal_path)
+        self.__sweeper = None
+        if app_builder.session_expiry_configurator is not None:
+            storage = self.__service_provider.get_instance(ISessionStorage)
+            if not isinstance(storage, IExpiringSessionStorage):
+                raise RuntimeError(f"Session expiry requires {ISessionStorage} to be an {IExpiringSessionStorage}")
+            self.__sweeper = SessionSweeper(storage, self.__service_provider, app_builder.session_expiry_configurator(),
+                                            app_builder.bot, self.__outbound, self.__metrics)
+
+    @property
+    def outbound(self) -> typing.Optional[OutboundDispatcher]:
+        return self.__outbound
+
+    @property
+    def sweeper(self) -> typing.Optional[SessionSweeper]:
+        return self.__sweeper
 
     def start_polling(self):
         if self.__app_builder is None:
             raise RuntimeError("Cannot start the bot")
 
-        self.__polling_daemon = MainDaemon(self.__app_builder, self.__services)
+        if self.__outbound is not None:
+            self.__outbound.start()
+        if self.__sweeper is not None:
+            self.__sweeper.start()
+        self.__start_metrics_server()
+        processor = UpdateProcessor(self.__app_builder.bot, self.__service_provider, self.__compiled, self.__outbound,
+                                    self.__journal, self.__tracer, self.__metrics)
+        offset = self.__journal.offset if self.__journal is not None else 0
+        self.__polling_daemon = MainDaemon(self.__app_builder, processor, self.__journal, self.__metrics,
+                                           self.__offset_committer(offset))
         self.__polling_daemon.start()
         self.__polling_daemon.join()
 
+    def replay(self, updates: typing.Iterable[telegram.Update]):
+        if self.__app_builder is None:
+            raise RuntimeError("Cannot start the bot")
+
+        if self.__outbound is not None:
+            self.__outbound.start()
+        processor = UpdateProcessor(self.__app_builder.bot, self.__service_provider, self.__compiled, self.__outbound,
+                                    tracer=self.__tracer, metrics=self.__metrics)
+        for update in updates:
+            processor.process(update)
+
+    @property
+    def journal(self) -> typing.Optional[UpdateJournal]:
+        return self.__journal
+
+    @property
+    def tracer(self) -> typing.Optional[Tracer]:
+        return self.__tracer
+
+    @property
+    def metrics(self) -> typing.Optional[PipelineMetrics]:
+        return self.__metrics
+
+    @property
+    def metrics_server(self) -> typing.Optional[MetricsServer]:
+        return self.__metrics_server
+
+    def __offset_committer(self, offset: int) -> "OffsetCommitter":
+        storage = self.__service_provider.get_instance(ISessionStorage)
+        logger = typing.cast(Logger, self.__service_provider.get_instance(Logger))
+        return OffsetCommitter(offset, self.__journal, storage if isinstance(storage, IBufferedSessionStorage) else None,
+                               logger)
+
+    def __start_metrics_server(self):
+        endpoint = self.__app_builder.metrics_endpoint
+        if endpoint is None or self.__metrics_server is not None:
+            return
+        host, port, path = endpoint
+        self.__metrics_server = MetricsServer(host, port, path, self.__metrics.registry)
+        self.__metrics_server.start()
+
+    @property
+    def polling_statistics(self) -> typing.Optional[PollingStatistics]:
+        if self.__polling_daemon is None:
+            return None
+        return self.__polling_daemon.poller.statistics
+
+    def start_webhook(self, host: str, port: int, path: str = "/", webhook_url: typing.Optional[str] = None,
+                      secret_token: typing.Optional[str] = None):
+        if self.__app_builder is None:
+            raise RuntimeError("Cannot start the bot")
+
+        bot = self.__app_builder.bot
+        if self.__outbound is not None:
+            self.__outbound.start()
+        if self.__sweeper is not None:
+            self.__sweeper.start()
+        self.__start_metrics_server()
+        processor = UpdateProcessor(bot, self.__service_provider, self.__compiled, self.__outbound, self.__journal,
+                                    self.__tracer, self.__metrics)
+        workers = max(1, self.__app_builder.workers)
+        if self.__journal is None:
+            # updates are acknowledged before they are handled, so at least one worker is required
+            dispatcher = UpdateDispatcher(processor.process, workers, None, processor.on_error)
+        else:
+            # nothing polls in webhook mode, the checkpoint follows the handled updates from its own thread
+            tracker = OffsetTracker(self.__journal.offset, ordered=False)
+            dispatcher = UpdateDispatcher(lambda update: processor.process_tracked(update, tracker), workers, tracker,
+                                          processor.on_error)
+            self.__checkpoint_daemon = CheckpointDaemon(tracker, self.__offset_committer(tracker.offset))
+            self.__checkpoint_daemon.start()
+        dispatcher.start()
+        self.__webhook_server = WebhookServer(host, port, path, bot, dispatcher, secret_token)
+        if webhook_url is not None:
+            bot.set_webhook(webhook_url, secret_token=secret_token)
+        self.__webhook_server.serve_forever()
+
+
+class OffsetCommitter:
+    # moves the durable offset, sessions written behind are flushed before it passes their updates
+
+    def __init__(self, offset: int, journal: typing.Optional[UpdateJournal] = None,
+                 storage: typing.Optional[IBufferedSessionStorage] = None, logger: typing.Optional[Logger] = None):
+        self.__flushed_offset = offset
+        self.__journal = journal
+        self.__storage = storage
+        self.__logger = logger
+
+    def commit(self, offset: int, idle: bool = False) -> int:
+        # returns the offset that is safe to acknowledge, the previous one if the sessions could not be written
+        if self.__storage is not None and offset != self.__flushed_offset:
+            try:
+                self.__storage.flush()
+                self.__flushed_offset = offset
+            except Exception as exception:
+                if self.__logger is not None:
+                    self.__logger.error("session flush failed: " + str(exception.__class__) + " " + str(exception))
+                offset = self.__flushed_offset
+        if self.__journal is not None:
+            self.__journal.checkpoint(offset)
+            if idle:
+                self.__journal.sync()
+            if self.__journal.compact_due:
+                # records below the checkpoint are settled, dropping them keeps the log and restarts short
+                self.__journal.compact()
+        return offset
+
+
+class CheckpointDaemon(threading.Thread):
+
+    def __init__(self, tracker: OffsetTracker, committer: OffsetCommitter, interval: float = 1.0):
+        super().__init__(name="CheckpointDaemon", daemon=True)
+        self.__tracker = tracker
+        self.__committer = committer
+        self.__interval = interval
+        self.__stopped = threading.Event()
+
+    def run(self):
+        while not self.__stopped.wait(self.__interval):
+            self.__committer.commit(self.__tracker.offset, self.__tracker.pending_count == 0)
+
+    def stop(self):
+        self.__stopped.set()
+        self.join()
+        self.__committer.commit(self.__tracker.offset, self.__tracker.pending_count == 0)
+
 
 class MainDaemon(threading.Thread):
 
-    def __init__(self, app_builder: ApplicationBuilder, services: ServiceCollection):
+    def __init__(self, app_builder: ApplicationBuilder, processor: UpdateProcessor,
+                 journal: typing.Optional[UpdateJournal] = None, metrics: typing.Optional[PipelineMetrics] = None,
+                 committer: typing.Optional[OffsetCommitter] = None):
         super().__init__(name="MainPipelineDaemon", daemon=True)
         self.__app_builder = app_builder
-        self.__service_provider = ServiceProvider()
-        self.__service_provider.populate(services.services)
+        self.__processor = processor
+        self.__journal = journal
+        self.__metrics = metrics
+        self.__committer = committer
+        self.__poller = AdaptivePoller(app_builder.bot, app_builder.updates_limit, app_builder.max_updates_limit,
+                                       app_builder.timeout)
+        self.__progress_timeout = 1.0
+
+    @property
+    def poller(self) -> AdaptivePoller:
+        return self.__poller
 
     def run(self):
-        service_provider = self.__service_provider
-        limit = self.__app_builder.updates_limit
-        timeout = self.__app_builder.timeout
-        bot = self.__app_builder.bot
-        offset = 0
+        poller = self.__poller
+        journal = self.__journal
+        # after a restart polling resumes from the last durable checkpoint
+        tracker = OffsetTracker(journal.offset if journal is not None else 0)
+        processor = self.__processor
+        committer = self.__committer
+        if committer is None:
+            committer = OffsetCommitter(tracker.offset, journal)
+
+        dispatcher = UpdateDispatcher(lambda update: processor.process_tracked(update, tracker),
+                                      self.__app_builder.workers, tracker, processor.on_error)
+        dispatcher.start()
+        if self.__metrics is not None:
+            registry = self.__metrics.registry
+            statistics = poller.statistics
+            registry.gauge_callback("subot_poll_backlog", "Updates received or pending after the last poll",
+                                    lambda: statistics.last_backlog)
+            registry.gauge_callback("subot_poll_latency_seconds", "Moving average of the get_updates round trip",
+                                    lambda: statistics.average_latency)
+            registry.gauge_callback("subot_poll_limit", "Batch size requested by the last poll",
+                                    lambda: statistics.last_limit)
+            registry.gauge_callback("subot_updates_in_progress", "Dispatched updates not finished yet",
+                                    lambda: tracker.pending_count)
 
         while True:
-            # get available updates
-            updates_list = bot.get_updates(offset, limit, timeout)
-            current_update_index: int = 0
-
-            while current_update_index < len(updates_list):
-                update = updates_list[current_update_index]
-                context = Context()
-                request = BotRequest()
-                if update.message is not None:
-                    message: telegram.Message = update.message
-                    if message.text is not None:
-                        message_text: str = message.text
-                        message_data = message_text.split()
-                        request.message_text = message_text
-                        if request.message_text.startswith('/'):
-                            request.command = message_data[0]
-                            if len(message_data) == 1:
-                                request.args = []
-                            else:
-                                request.args = message_data[1:]
-                        else:
-                            request.command = None
-                            request.args = message_data
-                        request.callback_text = None
-                        request.message_id = message.message_id
-                        request.is_callback = False
-                if update.callback_query is not None:
-                    callback_query: telegram.CallbackQuery = update.callback_query
-                    if callback_query.data is not None:
-                        callback_text: str = callback_query.data
-                        callback_data = callback_text.split()
-                        request.message_text = callback_text
-                        if callback_text.startswith('/'):
-                            request.command = callback_data[0]
-                            if len(callback_data) == 1:
-                                request.args = []
-                            else:
-                                request.args = callback_data[1:]
-                        else:
-                            request.command = None
-                            request.args = callback_data
-                        request.callback_text = callback_text
-                        callback_message: telegram.Message = callback_query.message
-                        request.message_id = callback_message.message_id
-                        request.is_callback = True
-                session = typing.cast(ISession, self.__service_provider.get_instance(ISession))
-                resources = typing.cast(IResourceProvider, self.__service_provider.get_instance(IResourceProvider))
-                response = BotResponse()
-                telegram_user: telegram.User = update.effective_user
-                user = User()
-                user.id = telegram_user.id
-                user.username = telegram_user.username
-                user.first_name = telegram_user.first_name
-                user.last_name = telegram_user.last_name
-
-                context.session = session
-                context.services = service_provider
-                context.bot_request = request
-                context.bot_response = response
-                context.configuration = telegram_user.language_code
-                context.user = user
-                context.resources = resources
-                session.id = user.id
-                resources.configuration = context.configuration
-                session.load()
-
-                components = self.__app_builder.build()
-                pipeline: typing.List[Middleware] = list()
-
-                for i in range(len(components) - 1, -1, -1):
-                    instance: Middleware = typing.cast(Middleware, service_provider.get_instance(components[i][0], user.id))
-                    pipeline.append(instance)
-                    if components[i][1] is not None:
-                        instance.configure(components[i][1]())
-
-                    if i != len(components) - 1:
-                        instance.set_next(pipeline[len(components) - 2 - i].invoke)
-
-                pipeline.reverse()
-
-                if len(pipeline) != 0:
-                    pipeline[0].invoke(context)
-                    session.commit()
-                    redirected = False
-                    while len(context.bot_response.actions_queue) > 0:
-                        result = context.bot_response.pop_action_at(0)
-                        if isinstance(result, RedirectToCommandResult):
-                            redirected = True
-                            break
-                        try:
-                            result.execute(bot)
-                        except:
-                            pass
-                    if redirected:
-                        continue
-
-                offset = update.update_id + 1
-                current_update_index += 1
+            # get available updates, neither telegram nor the checkpoint may pass an update before its session
+            offset = tracker.offset
+            committed = committer.commit(offset, tracker.pending_count == 0)
+            if committed != offset:
+                offset = committed
+                time.sleep(self.__progress_timeout)
+            updates_list = poller.poll(offset, tracker.pending_count, tracker.received)
+
+            dispatched_count = 0
+            for update in updates_list:
+                if journal is not None and journal.is_finished(update.update_id):
+                    # handled before a crash, but the checkpoint covering it was not written yet
+                    if tracker.begin(update.update_id):
+                        tracker.complete(update.update_id)
+                    continue
+                if dispatcher.dispatch(update):
+                    dispatched_count += 1
+
+            # every received update is still in progress, so wait for the offset to move instead of re-polling
+            if dispatched_count == 0 and len(updates_list) != 0:
+                tracker.wait_for_progress(offset, self.__progress_timeout)
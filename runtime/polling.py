@@ -0,0 +1,146 @@
+import threading
+import time
+import typing
+
+import telegram
+
+
+class PollingStatistics:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__polls = 0
+        self.__received = 0
+        self.__last_batch_size = 0
+        self.__last_limit = 0
+        self.__last_timeout = 0
+        self.__last_latency = 0.0
+        self.__average_latency = 0.0
+        self.__max_latency = 0.0
+        self.__last_backlog = 0
+        self.__max_backlog = 0
+
+    def record(self, limit: int, timeout: int, batch_size: int, backlog: int, latency: float):
+        with self.__lock:
+            self.__polls += 1
+            self.__received += batch_size
+            self.__last_batch_size = batch_size
+            self.__last_limit = limit
+            self.__last_timeout = timeout
+            self.__last_latency = latency
+            self.__max_latency = max(self.__max_latency, latency)
+            # exponential moving average, so a single slow round trip does not dominate
+            if self.__polls == 1:
+                self.__average_latency = latency
+            else:
+                self.__average_latency += (latency - self.__average_latency) * 0.2
+            self.__last_backlog = backlog
+            self.__max_backlog = max(self.__max_backlog, backlog)
+
+    @property
+    def polls(self) -> int:
+        return self.__polls
+
+    @property
+    def received(self) -> int:
+        return self.__received
+
+    @property
+    def last_batch_size(self) -> int:
+        return self.__last_batch_size
+
+    @property
+    def last_limit(self) -> int:
+        return self.__last_limit
+
+    @property
+    def last_timeout(self) -> int:
+        return self.__last_timeout
+
+    @property
+    def last_latency(self) -> float:
+        return self.__last_latency
+
+    @property
+    def average_latency(self) -> float:
+        return self.__average_latency
+
+    @property
+    def max_latency(self) -> float:
+        return self.__max_latency
+
+    @property
+    def last_backlog(self) -> int:
+        return self.__last_backlog
+
+    @property
+    def max_backlog(self) -> int:
+        return self.__max_backlog
+
+    def snapshot(self) -> typing.Dict[str, typing.Union[int, float]]:
+        with self.__lock:
+            return {
+                "polls": self.__polls,
+                "received": self.__received,
+                "last_batch_size": self.__last_batch_size,
+                "last_limit": self.__last_limit,
+                "last_timeout": self.__last_timeout,
+                "last_latency": self.__last_latency,
+                "average_latency": self.__average_latency,
+                "max_latency": self.__max_latency,
+                "last_backlog": self.__last_backlog,
+                "max_backlog": self.__max_backlog,
+            }
+
+
+class AdaptivePoller:
+    MAX_LIMIT = 100
+
+    def __init__(self, bot: telegram.Bot, min_limit: int, max_limit: int, max_timeout: int):
+        self.__bot = bot
+        self.__min_limit = max(1, min(min_limit, self.MAX_LIMIT))
+        self.__max_limit = max(self.__min_limit, min(max_limit, self.MAX_LIMIT))
+        self.__max_timeout = max_timeout
+        self.__limit = self.__min_limit
+        self.__timeout = max_timeout
+        self.__statistics = PollingStatistics()
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
+    @property
+    def timeout(self) -> int:
+        return self.__timeout
+
+    @property
+    def statistics(self) -> PollingStatistics:
+        return self.__statistics
+
+    def poll(self, offset: int, pending: int = 0, received: typing.Optional[int] = None) -> typing.List[telegram.Update]:
+        limit = self.__limit
+        timeout = self.__timeout
+        started = time.perf_counter()
+        updates_list = self.__bot.get_updates(offset, limit, timeout)
+        latency = time.perf_counter() - started
+
+        # updates still in progress are delivered again until the offset passes them, they are already pending
+        new_count = len(updates_list)
+        if received is not None:
+            new_count = sum(1 for update in updates_list if update.update_id >= received)
+        self.__statistics.record(limit, timeout, len(updates_list), pending + new_count, latency)
+        self.__adapt(len(updates_list))
+        return updates_list
+
+    def __adapt(self, batch_size: int):
+        if batch_size >= self.__limit:
+            # a full batch means more updates are waiting on the server side
+            self.__limit = min(self.__limit * 2, self.__max_limit)
+        elif batch_size * 4 < self.__limit:
+            self.__limit = max(self.__limit // 2, self.__min_limit)
+
+        # when updates keep coming there is nothing to wait for, long polling only pays off when idle
+        if batch_size == 0:
+            self.__timeout = self.__max_timeout
+        else:
+            self.__timeout = 0
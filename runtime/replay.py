@@ -0,0 +1,331 @@
+import atexit
+import datetime
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import typing
+
+import telegram
+
+from runtime.builder import ApplicationBuilder
+from runtime.dependency_injection import ServiceCollection
+from runtime.logging import Logger
+from runtime.pipeline import Pipeline
+from runtime.session import IPersistentSessionStorage, MemorySessionStorage
+
+
+class RecordedCall:
+
+    def __init__(self, method: str, chat_id: typing.Optional[int], arguments: typing.Dict[str, typing.Any],
+                 started: float, duration: float):
+        self.__method = method
+        self.__chat_id = chat_id
+        self.__arguments = arguments
+        self.__started = started
+        self.__duration = duration
+
+    @property
+    def method(self) -> str:
+        return self.__method
+
+    @property
+    def chat_id(self) -> typing.Optional[int]:
+        return self.__chat_id
+
+    @property
+    def arguments(self) -> typing.Dict[str, typing.Any]:
+        return self.__arguments
+
+    @property
+    def started(self) -> float:
+        return self.__started
+
+    @property
+    def duration(self) -> float:
+        return self.__duration
+
+
+class FakeBot:
+    # stands in for telegram.Bot: updates come from memory and outbound calls are recorded instead of sent
+
+    def __init__(self, updates: typing.Iterable[telegram.Update] = (), latency: float = 0.0):
+        self.__updates = sorted(updates, key=lambda update: update.update_id)
+        self.__latency = latency
+        self.__lock = threading.Lock()
+        self.__calls: typing.List[RecordedCall] = list()
+        self.__message_ids = itertools.count(1)
+        self.__drained = threading.Event()
+
+    @property
+    def calls(self) -> typing.List[RecordedCall]:
+        with self.__lock:
+            return list(self.__calls)
+
+    @property
+    def drained(self) -> threading.Event:
+        # set once get_updates was asked for updates past the last one
+        return self.__drained
+
+    def calls_of(self, method: str) -> typing.List[RecordedCall]:
+        return [call for call in self.calls if call.method == method]
+
+    def feed(self, updates: typing.Iterable[telegram.Update]):
+        with self.__lock:
+            self.__updates = sorted(self.__updates + list(updates), key=lambda update: update.update_id)
+            self.__drained.clear()
+
+    def get_updates(self, offset: int = None, limit: int = 100, timeout: float = 0, *args,
+                    **kwargs) -> typing.List[telegram.Update]:
+        with self.__lock:
+            if offset is None:
+                offset = 0
+            updates_list = [update for update in self.__updates if update.update_id >= offset][:limit]
+            # updates below the offset are confirmed, telegram never returns them again
+            self.__updates = [update for update in self.__updates if update.update_id >= offset]
+        if len(updates_list) == 0:
+            self.__drained.set()
+            # a real long poll blocks, a short nap keeps an idle polling loop from spinning
+            time.sleep(min(timeout, 0.01))
+        return updates_list
+
+    def send_message(self, chat_id: int, text: str, *args, **kwargs) -> telegram.Message:
+        started = self.__call()
+        message = self.__message(chat_id, text)
+        self.__record("send_message", chat_id, dict(kwargs, text=text), started)
+        return message
+
+    def edit_message_text(self, text: str, chat_id: int = None, message_id: int = None, *args,
+                          **kwargs) -> telegram.Message:
+        started = self.__call()
+        self.__record("edit_message_text", chat_id, dict(kwargs, text=text, message_id=message_id), started)
+        return telegram.Message(message_id, datetime.datetime.now(), telegram.Chat(chat_id, telegram.Chat.PRIVATE),
+                                text=text)
+
+    def edit_message_reply_markup(self, chat_id: int = None, message_id: int = None, *args,
+                                  **kwargs) -> telegram.Message:
+        started = self.__call()
+        self.__record("edit_message_reply_markup", chat_id, dict(kwargs, message_id=message_id), started)
+        return telegram.Message(message_id, datetime.datetime.now(), telegram.Chat(chat_id, telegram.Chat.PRIVATE))
+
+    def answer_callback_query(self, callback_query_id: str, *args, **kwargs) -> bool:
+        started = self.__call()
+        self.__record("answer_callback_query", None, dict(kwargs, callback_query_id=callback_query_id), started)
+        return True
+
+    def set_webhook(self, url: str = None, *args, **kwargs) -> bool:
+        started = self.__call()
+        self.__record("set_webhook", None, dict(kwargs, url=url), started)
+        return True
+
+    def __call(self) -> float:
+        started = time.perf_counter()
+        if self.__latency > 0:
+            time.sleep(self.__latency)
+        return started
+
+    def __record(self, method: str, chat_id: typing.Optional[int], arguments: typing.Dict[str, typing.Any],
+                 started: float):
+        call = RecordedCall(method, chat_id, arguments, started, time.perf_counter() - started)
+        with self.__lock:
+            self.__calls.append(call)
+
+    def __message(self, chat_id: int, text: str) -> telegram.Message:
+        return telegram.Message(next(self.__message_ids), datetime.datetime.now(),
+                                telegram.Chat(chat_id, telegram.Chat.PRIVATE), text=text)
+
+
+class ReplayReport:
+
+    def __init__(self, latencies: typing.List[float], elapsed: float, calls: typing.List[RecordedCall]):
+        self.__latencies = sorted(latencies)
+        self.__elapsed = elapsed
+        self.__calls = calls
+
+    @property
+    def count(self) -> int:
+        return len(self.__latencies)
+
+    @property
+    def elapsed(self) -> float:
+        return self.__elapsed
+
+    @property
+    def throughput(self) -> float:
+        if self.__elapsed == 0:
+            return 0.0
+        return len(self.__latencies) / self.__elapsed
+
+    @property
+    def calls(self) -> typing.List[RecordedCall]:
+        return self.__calls
+
+    def percentile(self, percent: float) -> float:
+        if len(self.__latencies) == 0:
+            return 0.0
+        index = min(len(self.__latencies) - 1, int(round(percent / 100 * (len(self.__latencies) - 1))))
+        return self.__latencies[index]
+
+    def snapshot(self) -> typing.Dict[str, typing.Union[int, float]]:
+        return {
+            "updates": self.count,
+            "elapsed": self.__elapsed,
+            "updates_per_second": self.throughput,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.percentile(100),
+            "bot_calls": len(self.__calls),
+        }
+
+
+class ReplayWorkspace:
+    # a temporary directory for whatever a replay writes, removed when the process exits
+
+    def __init__(self):
+        self.__path = tempfile.mkdtemp(prefix="subot-replay-") + os.sep
+        atexit.register(self.remove)
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def remove(self):
+        shutil.rmtree(self.__path, ignore_errors=True)
+
+
+class ReplayLogger(Logger):
+
+    def __init__(self, workspace: ReplayWorkspace):
+        super().__init__(workspace.path + "logs/")
+
+
+class ReplayRunner:
+    # drives the configured pipeline with a FakeBot, one update after another and without waiting on the network
+
+    def __init__(self, startup, updates: typing.Iterable[telegram.Update], latency: float = 0.0):
+        self.__startup = startup
+        self.__updates = list(updates)
+        self.__bot = FakeBot(latency=latency)
+        self.__pipeline: typing.Optional[Pipeline] = None
+
+    @property
+    def bot(self) -> FakeBot:
+        return self.__bot
+
+    @property
+    def pipeline(self) -> typing.Optional[Pipeline]:
+        return self.__pipeline
+
+    def build(self) -> Pipeline:
+        app_builder = ApplicationBuilder()
+        services = ServiceCollection()
+        # the first registration wins, so a replay keeps sessions in memory and logs in a temporary directory
+        services.add_singleton(ReplayWorkspace)
+        services.add_singleton(Logger, ReplayLogger)
+        services.add_singleton(IPersistentSessionStorage, MemorySessionStorage)
+        self.__startup.configure_services(services)
+        # set before the startup runs, so it does not ask for a bot token, and after it, in case it set one anyway
+        app_builder.use_bot(self.__bot)
+        self.__startup.configure(app_builder)
+        app_builder.use_bot(self.__bot)
+        # rate limits and the journal would measure telegram and the disk, not the pipeline
+        app_builder.outbound_configurator = None
+        app_builder.journal_path = None
+
+        self.__pipeline = Pipeline()
+        self.__pipeline.configure(app_builder, services)
+        return self.__pipeline
+
+    def run(self) -> ReplayReport:
+        pipeline = self.__pipeline
+        if pipeline is None:
+            pipeline = self.build()
+
+        latencies: typing.List[float] = list()
+        started = time.perf_counter()
+        for update in self.__updates:
+            update_started = time.perf_counter()
+            pipeline.replay((update,))
+            latencies.append(time.perf_counter() - update_started)
+        elapsed = time.perf_counter() - started
+        return ReplayReport(latencies, elapsed, self.__bot.calls)
+
+
+def load_updates(path: str, bot: typing.Optional[telegram.Bot] = None) -> typing.List[telegram.Update]:
+    # one update per line, either raw telegram json or an update journal record
+    updates_list = list()
+    in_stream = open(path, "r", encoding="utf-8")
+    for line in in_stream:
+        if len(line.strip()) == 0:
+            continue
+        data = json.loads(line)
+        if "update_id" not in data:
+            if "update" not in data:
+                continue
+            data = data["update"]
+        updates_list.append(telegram.Update.de_json(data, bot))
+    in_stream.close()
+    return updates_list
+
+
+def save_updates(path: str, updates: typing.Iterable[telegram.Update]):
+    out_stream = open(path, "w", encoding="utf-8")
+    for update in updates:
+        out_stream.write(json.dumps(update.to_dict(), ensure_ascii=False) + "\n")
+    out_stream.close()
+
+
+def message_update(update_id: int, user_id: int, text: str, language_code: str = "en") -> telegram.Update:
+    return telegram.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user", "language_code": language_code},
+            "text": text,
+        },
+    }, None)
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int,
+                    language_code: str = "en") -> telegram.Update:
+    user = {"id": user_id, "is_bot": False, "first_name": "user", "language_code": language_code}
+    return telegram.Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {"message_id": message_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": user},
+        },
+    }, None)
+
+
+WIZARD_STEPS = (
+    ("message", "/start"),
+    ("message", "/new_request"),
+    ("message", "Title"),
+    ("message", "Description"),
+    ("callback", "Category 1"),
+    ("callback", "/send"),
+    ("callback", "/send yes"),
+)
+
+
+def wizard_updates(users: int, first_update_id: int = 1) -> typing.List[telegram.Update]:
+    # the new_request wizard of every user, interleaved the way concurrent chats arrive
+    updates_list = list()
+    update_id = first_update_id
+    for kind, text in WIZARD_STEPS:
+        for user_id in range(1, users + 1):
+            if kind == "message":
+                updates_list.append(message_update(update_id, user_id, text))
+            else:
+                updates_list.append(callback_update(update_id, user_id, text, update_id))
+            update_id += 1
+    return updates_list
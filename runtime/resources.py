@@ -2,7 +2,9 @@ import abc
 import importlib
 import inspect
 import os
+import threading
 import typing
+import weakref
 from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 
@@ -58,33 +60,120 @@ class IResourceParser(abc.ABC):
         pass
 
 
-class Resources(IResourceProvider):
+class ResourceTables:
+    # everything one configuration can see, already merged along its fallback chain
 
-    def __init__(self, parser: IResourceParser):
-        self.__parser = parser
-        self.__configuration = None
-        self.__strings = None
-        self.__models = None
+    def __init__(self, strings: typing.Dict[str, str], string_arrays: typing.Dict[str, typing.Tuple[str, ...]],
+                 models: typing.Dict[str, CommandModelDefinition]):
+        self.__strings = strings
+        self.__string_arrays = string_arrays
+        self.__models = models
 
     @property
-    def __models_resources(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
-        if self.__models is None:
-            self.__load_models()
-        return self.__models
+    def strings(self) -> typing.Dict[str, str]:
+        return self.__strings
 
-    @__models_resources.setter
-    def __models_resources(self, value: typing.Dict[str, typing.List[IResourceEntry]]):
-        self.__models = value
+    @property
+    def string_arrays(self) -> typing.Dict[str, typing.Tuple[str, ...]]:
+        return self.__string_arrays
 
     @property
-    def __strings_resources(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
-        if self.__strings is None:
-            self.__load_strings()
-        return self.__strings
+    def models(self) -> typing.Dict[str, CommandModelDefinition]:
+        return self.__models
+
 
-    @__strings_resources.setter
-    def __strings_resources(self, value: typing.Dict[str, typing.List[IResourceEntry]]):
-        self.__strings = value
+class ResourceIndex:
+    # parsed resources by locale, shared by the Resources of every user scope that uses the same parser
+    __indexes: "weakref.WeakKeyDictionary[IResourceParser, ResourceIndex]" = weakref.WeakKeyDictionary()
+    __indexes_lock = threading.Lock()
+
+    def __init__(self, parser: IResourceParser):
+        self.__parser = parser
+        self.__lock = threading.Lock()
+        self.__locales: typing.Optional[typing.Dict[str, ResourceTables]] = None
+        # tables of every configuration asked for so far, unknown ones included, so no lookup repeats the merge
+        self.__tables: typing.Dict[typing.Optional[str], ResourceTables] = dict()
+
+    @staticmethod
+    def of(parser: IResourceParser) -> "ResourceIndex":
+        index = ResourceIndex.__indexes.get(parser)
+        if index is None:
+            with ResourceIndex.__indexes_lock:
+                index = ResourceIndex.__indexes.get(parser)
+                if index is None:
+                    index = ResourceIndex(parser)
+                    ResourceIndex.__indexes[parser] = index
+        return index
+
+    @staticmethod
+    def fallback_chain(configuration: typing.Optional[str]) -> typing.Tuple[str, ...]:
+        # ru-RU -> ru-ru, ru, default
+        if configuration is None:
+            return ("",)
+        parts = [part for part in configuration.strip().lower().replace('_', '-').split('-') if len(part) != 0]
+        chain = ['-'.join(parts[:length]) for length in range(len(parts), 0, -1)]
+        chain.append("")
+        return tuple(chain)
+
+    def tables(self, configuration: typing.Optional[str]) -> ResourceTables:
+        tables = self.__tables.get(configuration)
+        if tables is not None:
+            return tables
+        with self.__lock:
+            tables = self.__tables.get(configuration)
+            if tables is None:
+                tables = self.__merge(self.fallback_chain(configuration))
+                self.__tables[configuration] = tables
+            return tables
+
+    def __merge(self, chain: typing.Tuple[str, ...]) -> ResourceTables:
+        locales = self.__compile()
+        strings = dict()
+        string_arrays = dict()
+        models = dict()
+        # the most specific locale is applied last, its entries win
+        for locale in reversed(chain):
+            tables = locales.get(locale)
+            if tables is not None:
+                strings.update(tables.strings)
+                string_arrays.update(tables.string_arrays)
+                models.update(tables.models)
+        return ResourceTables(strings, string_arrays, models)
+
+    def __compile(self) -> typing.Dict[str, ResourceTables]:
+        if self.__locales is not None:
+            return self.__locales
+        locales: typing.Dict[str, ResourceTables] = dict()
+        for configuration, entries in self.__parser.parse_strings().items():
+            tables = self.__locale(locales, configuration)
+            for entry in entries:
+                # the first entry of a name wins, as it did for the linear scan
+                if isinstance(entry, StringResourceEntry):
+                    tables.strings.setdefault(entry.name, entry.data)
+                elif isinstance(entry, StringArrayResourceEntry):
+                    tables.string_arrays.setdefault(entry.name, tuple(entry.data))
+        for configuration, entries in self.__parser.parse_models().items():
+            tables = self.__locale(locales, configuration)
+            for entry in entries:
+                tables.models.setdefault(entry.name, entry.data)
+        self.__locales = locales
+        return locales
+
+    @staticmethod
+    def __locale(locales: typing.Dict[str, ResourceTables], configuration: str) -> ResourceTables:
+        # resource files are named strings-<locale>.xml, the parser keys them by "-<locale>"
+        locale = ResourceIndex.fallback_chain(configuration.lstrip('-'))[0]
+        if locale not in locales:
+            locales[locale] = ResourceTables(dict(), dict(), dict())
+        return locales[locale]
+
+
+class Resources(IResourceProvider):
+
+    def __init__(self, parser: IResourceParser):
+        self.__index = ResourceIndex.of(parser)
+        self.__configuration = None
+        self.__tables: typing.Optional[ResourceTables] = None
 
     @property
     def configuration(self) -> str:
@@ -95,57 +184,31 @@ class Resources(IResourceProvider):
         if self.__configuration == value:
             return
         self.__configuration = value
+        self.__tables = None
+
+    @property
+    def __current_tables(self) -> ResourceTables:
+        if self.__tables is None:
+            self.__tables = self.__index.tables(self.__configuration)
+        return self.__tables
 
     def get_string(self, resource_id: str) -> typing.Optional[str]:
-        resource: IResourceEntry
-        for conf, resources in self.__strings_resources.items():
-            if '-' + self.configuration in conf:
-                for res in resources:
-                    if res.name == resource_id and isinstance(res, StringResourceEntry):
-                        return res.data
-        if "" in self.__strings_resources:
-            for res in self.__strings_resources[""]:
-                if res.name == resource_id and isinstance(res, StringResourceEntry):
-                    return res.data
-
-        raise RuntimeError(f"String array with given name {resource_id} not found")
+        try:
+            return self.__current_tables.strings[resource_id]
+        except KeyError:
+            raise RuntimeError(f"String array with given name {resource_id} not found")
 
     def get_string_array(self, resource_id: str) -> typing.Optional[typing.Tuple[str]]:
-        resource: IResourceEntry
-        for conf, resources in self.__strings_resources.items():
-            if '-' + self.configuration in conf:
-                for res in resources:
-                    if res.name == resource_id and isinstance(res, StringArrayResourceEntry):
-                        return tuple(res.data)
-        if "" in self.__strings_resources:
-            for res in self.__strings_resources[""]:
-                if res.name == resource_id and isinstance(res, StringArrayResourceEntry):
-                    return tuple(res.data)
-
-        raise RuntimeError(f"String array with given name {resource_id} not found")
+        try:
+            return self.__current_tables.string_arrays[resource_id]
+        except KeyError:
+            raise RuntimeError(f"String array with given name {resource_id} not found")
 
     def get_model(self, resource_id: str) -> typing.Optional[CommandModelDefinition]:
-        resource: IResourceEntry
-        for conf, resources in self.__models_resources.items():
-            if '-' + self.configuration in conf:
-                for res in resources:
-                    if res.name == resource_id:
-                        return res.data
-
-        if "" in self.__models_resources:
-            for res in self.__models_resources[""]:
-                if res.name == resource_id:
-                    return res.data
-
-        raise RuntimeError(f"Model with given name {resource_id} not found")
-
-    def __load_strings(self):
-        resources = self.__parser.parse_strings()
-        self.__strings_resources = resources
-
-    def __load_models(self):
-        resources = self.__parser.parse_models()
-        self.__models_resources = resources
+        try:
+            return self.__current_tables.models[resource_id]
+        except KeyError:
+            raise RuntimeError(f"Model with given name {resource_id} not found")
 
 
 class StringResourceEntry(IResourceEntry):
@@ -219,6 +282,26 @@ class ModelResourceEntry(IResourceEntry):
 
 class XmlResourceParser(IResourceParser):
 
+    def __init__(self):
+        # every user scope gets its own Resources, the parsed files are shared between them
+        self.__lock = threading.Lock()
+        self.__strings: typing.Optional[typing.Dict[str, typing.List[IResourceEntry]]] = None
+        self.__models: typing.Optional[typing.Dict[str, typing.List[IResourceEntry]]] = None
+
+    def parse_strings(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
+        if self.__strings is None:
+            with self.__lock:
+                if self.__strings is None:
+                    self.__strings = self.__read_strings()
+        return self.__strings
+
+    def parse_models(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
+        if self.__models is None:
+            with self.__lock:
+                if self.__models is None:
+                    self.__models = self.__read_models()
+        return self.__models
+
     def __parse_model_property(self, entry: Element) -> PropertyDefinition:
         property_definition = PropertyDefinition()
         if 'name' not in entry.attrib:
@@ -235,7 +318,7 @@ class XmlResourceParser(IResourceParser):
             property_definition.text = entry.attrib['text']
         return property_definition
 
-    def parse_models(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
+    def __read_models(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
 
         files = self.__get_files_by_type('models')
         if len(files) == 0:
@@ -330,7 +413,7 @@ class XmlResourceParser(IResourceParser):
                 files.append("resources/" + file_name)
         return files
 
-    def parse_strings(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
+    def __read_strings(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
 
         files = self.__get_files_by_type('strings')
         if len(files) == 0:
@@ -1,7 +1,16 @@
+import atexit
+import collections
+import mmap
+import struct
+import zlib
+import threading
+import time
 import typing
-import pickle
 import os
 import abc
+import sqlite3
+
+from runtime.session_codec import ISessionCodec, PickleSessionCodec, CompactSessionCodec
 
 
 class ISessionStorage(abc.ABC):
@@ -15,6 +24,45 @@ class ISessionStorage(abc.ABC):
         pass
 
 
+class IIncrementalSessionStorage(ISessionStorage):
+
+    @abc.abstractmethod
+    def commit_changes(self, identifier: int, changed: typing.Dict[str, typing.Any],
+                       removed: typing.Tuple[str, ...]) -> bool:
+        # returns False when the changes cannot be applied and the whole session has to be committed
+        pass
+
+
+class IExpiringSessionStorage(ISessionStorage):
+
+    @abc.abstractmethod
+    def idle_sessions(self, idle_since: float, limit: int) -> typing.List[int]:
+        # identifiers of sessions that were not committed since the given unix time
+        pass
+
+    @abc.abstractmethod
+    def expire(self, identifier: int, idle_since: float):
+        # removes the session if it is still idle and returns its data, None when it was kept
+        pass
+
+
+class IBufferedSessionStorage(ISessionStorage):
+    # storage that holds commits back and writes them later
+
+    @abc.abstractmethod
+    def flush(self):
+        # writes every commit made so far before returning
+        pass
+
+
+class IPersistentSessionStorage(IExpiringSessionStorage):
+    # storage that actually keeps the data, as opposed to caches layered on top of it
+
+    def commit_many(self, items: typing.List[typing.Tuple[int, typing.Any]]):
+        for identifier, object_inst in items:
+            self.commit(identifier, object_inst)
+
+
 class ISession(abc.ABC):
 
     @property
@@ -68,28 +116,62 @@ class Session(ISession):
         self.__id = value
 
     def clear(self):
-        self.__data.clear()
+        if len(self.__data) != 0:
+            self.__data.clear()
+            self.__cleared = True
+            self.__changed.clear()
+            self.__removed.clear()
 
     @property
     def keys(self) -> typing.Tuple[str, ...]:
         return tuple(self.__data.keys())
 
+    @property
+    def dirty(self) -> bool:
+        return self.__cleared or len(self.__changed) != 0 or len(self.__removed) != 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.__loaded_id == self.__id
+
     def load(self):
+        # every user has its own session in its scope, a clean one already holds what was committed last
+        if self.__loaded_id == self.__id and not self.dirty:
+            return
         data = self.__storage.load(self.id)
-        if data is not None:
-            self.__data = data
+        self.__data = data if data is not None else dict()
+        self.__loaded_id = self.__id
+        self.__reset_changes()
 
     def commit(self):
+        # values are plain str/int/bool, so assignments are the only way the data changes
+        if not self.dirty:
+            return
+        if not self.__cleared and isinstance(self.__storage, IIncrementalSessionStorage):
+            changed = {key: self.__data[key] for key in self.__changed}
+            if self.__storage.commit_changes(self.id, changed, tuple(self.__removed)):
+                self.__reset_changes()
+                return
         self.__storage.commit(self.id, self.__data)
+        self.__reset_changes()
 
     def remove(self, key: str):
         if key in self.__data:
             self.__data.pop(key)
+            self.__changed.discard(key)
+            self.__removed.add(key)
+
+    def __reset_changes(self):
+        self.__changed: typing.Set[str] = set()
+        self.__removed: typing.Set[str] = set()
+        self.__cleared = False
 
     def __init__(self, storage: ISessionStorage):
         self.__id = 0
+        self.__loaded_id: typing.Optional[int] = None
         self.__data: typing.Dict[str, typing.Union[str, int]] = dict()
         self.__storage: ISessionStorage = storage
+        self.__reset_changes()
 
     def __getitem__(self, item: str):
         if item not in self.__data:
@@ -97,33 +179,887 @@ class Session(ISession):
         return self.__data[item]
 
     def __setitem__(self, key: str, value: typing.Union[str, int]):
+        if key in self.__data and self.__data[key] == value and type(self.__data[key]) is type(value):
+            return
         self.__data[key] = value
+        self.__changed.add(key)
+        self.__removed.discard(key)
+
+
+class FileSessionStorage(IPersistentSessionStorage):
+    # <base>/<shard>/.../<id>.session, the shards come from a hash of the id so every directory stays small
+    DEFAULT_LEVELS = 2
+    DEFAULT_FAN_OUT = 256
+    LOCK_STRIPES = 64
+    MIGRATION_BATCH = 500
+    MIGRATION_PAUSE = 0.05
+
+    def __init__(self, codec: typing.Optional[ISessionCodec] = None, base_path: str = "sessions/",
+                 levels: int = DEFAULT_LEVELS, fan_out: int = DEFAULT_FAN_OUT, fsync: bool = True):
+        if fan_out < 2 or fan_out ** levels > 2 ** 32:
+            raise RuntimeError(f"Session layout with {levels} levels of {fan_out} directories is not supported")
+        self.__base_path = base_path
+        self.__codec = codec if codec is not None else PickleSessionCodec()
+        self.__levels = levels
+        self.__fan_out = fan_out
+        self.__fsync = fsync
+        self.__digits = len(format(fan_out - 1, "x"))
+        self.__locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        self.__directories: typing.Set[str] = set()
+        self.__migrated = 0
+        # commit times ordered oldest first, the file times of older sessions are added on the first sweep
+        self.__index_lock = threading.Lock()
+        self.__accessed: typing.OrderedDict[int, float] = collections.OrderedDict()
+        self.__indexed = False
+
+        if not os.path.exists(base_path):
+            os.makedirs(base_path)
+        self.__check_layout()
+        # sessions of the flat layout are moved in the background, until then lookups fall back to them
+        self.__flat_remaining = len(self.__flat_sessions(1)) != 0
+        self.__migrator: typing.Optional[threading.Thread] = None
+        if self.__flat_remaining:
+            self.__migrator = threading.Thread(target=self.__migrate_loop, name="SessionMigrator", daemon=True)
+            self.__migrator.start()
 
+    @property
+    def base_path(self) -> str:
+        return self.__base_path
 
-class FileSessionStorage(ISessionStorage):
+    @property
+    def migrating(self) -> bool:
+        return self.__flat_remaining
 
-    def __init__(self):
-        self.__base_path = "sessions/"
+    @property
+    def migrated(self) -> int:
+        return self.__migrated
+
+    def path_of(self, identifier: int) -> str:
+        shard = zlib.crc32(str(identifier).encode())
+        directories = list()
+        for _ in range(self.__levels):
+            directories.append(format(shard % self.__fan_out, f"0{self.__digits}x"))
+            shard //= self.__fan_out
+        return self.__base_path + "/".join(directories) + "/" + str(identifier) + ".session"
 
     def commit(self, identifier: int, object_inst):
-        path = self.__base_path + str(identifier) + ".session"
-        if not os.path.exists(self.__base_path):
-            os.mkdir(self.__base_path)
+        path = self.path_of(identifier)
+        object_bytes = self.__codec.encode(object_inst)
+        with self.__lock_of(identifier):
+            self.__write(path, object_bytes)
+            if self.__flat_remaining:
+                self.__remove(self.__flat_path(identifier))
+            self.__touch(identifier, time.time())
+
+    def load(self, identifier: int):
+        path = self.path_of(identifier)
+        if not os.path.exists(path):
+            if not self.__flat_remaining:
+                return None
+            self.__move_flat(identifier)
+
+        try:
+            in_stream = open(path, "rb")
+        except FileNotFoundError:
+            # expired between the check and the read
+            return None
+        content = in_stream.read()
+        in_stream.close()
+        object_inst = self.__codec.decode(content)
+        return object_inst
+
+    def idle_sessions(self, idle_since: float, limit: int) -> typing.List[int]:
+        if not self.__indexed:
+            self.__build_index()
+        identifiers = list()
+        with self.__index_lock:
+            for identifier, accessed in self.__accessed.items():
+                if accessed >= idle_since or len(identifiers) >= limit:
+                    break
+                identifiers.append(identifier)
+        return identifiers
+
+    def expire(self, identifier: int, idle_since: float):
+        with self.__lock_of(identifier):
+            if self.__flat_remaining:
+                self.__move_flat(identifier)
+            path = self.path_of(identifier)
+            if not os.path.exists(path):
+                self.__forget(identifier)
+                return None
+            # commits take the same lock, so the session cannot be written between this check and the removal
+            with self.__index_lock:
+                accessed = self.__accessed.get(identifier)
+            if accessed is None:
+                accessed = os.path.getmtime(path)
+            if accessed >= idle_since:
+                return None
+            object_inst = self.load(identifier)
+            os.remove(path)
+            self.__forget(identifier)
+            return object_inst
+
+    def migrate(self, batch_size: int = MIGRATION_BATCH) -> int:
+        # moves a batch of flat <id>.session files into their shard, returns how many were moved
+        moved = 0
+        for identifier in self.__flat_sessions(batch_size):
+            if self.__move_flat(identifier):
+                moved += 1
+        if moved == 0 and len(self.__flat_sessions(1)) == 0:
+            self.__flat_remaining = False
+        self.__migrated += moved
+        return moved
+
+    def __migrate_loop(self):
+        while self.__flat_remaining:
+            try:
+                self.migrate()
+            except OSError:
+                pass
+            # the bot keeps serving meanwhile, pausing between batches leaves it the disk
+            time.sleep(self.MIGRATION_PAUSE)
 
-        object_bytes = pickle.dumps(object_inst)
+    def __move_flat(self, identifier: int) -> bool:
+        flat_path = self.__flat_path(identifier)
+        with self.__lock_of(identifier):
+            if not os.path.exists(flat_path):
+                return False
+            path = self.path_of(identifier)
+            if os.path.exists(path):
+                # committed in the sharded layout already, that copy is newer
+                self.__remove(flat_path)
+                return False
+            self.__ensure_directory(os.path.dirname(path))
+            os.replace(flat_path, path)
+            return True
 
-        out_stream = open(path, "wb")
+    def __write(self, path: str, object_bytes: bytes):
+        # the data goes to a temporary file that replaces the session in one step, a crash never leaves half a file
+        self.__ensure_directory(os.path.dirname(path))
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        out_stream = open(temp_path, "wb")
         out_stream.write(object_bytes)
         out_stream.flush()
+        if self.__fsync:
+            os.fsync(out_stream.fileno())
         out_stream.close()
+        os.replace(temp_path, path)
+
+    def __touch(self, identifier: int, accessed: float):
+        with self.__index_lock:
+            self.__accessed[identifier] = accessed
+            self.__accessed.move_to_end(identifier)
+
+    def __forget(self, identifier: int):
+        with self.__index_lock:
+            self.__accessed.pop(identifier, None)
+
+    def __build_index(self):
+        # one walk over the files, sessions committed meanwhile are newer than any file time and keep their place
+        found = list()
+        for directory, _, names in os.walk(self.__base_path):
+            for name in names:
+                identifier = name[:-len(".session")]
+                if not name.endswith(".session") or not identifier.lstrip('-').isdigit():
+                    continue
+                try:
+                    found.append((os.path.getmtime(os.path.join(directory, name)), int(identifier)))
+                except FileNotFoundError:
+                    continue
+        found.sort()
+        with self.__index_lock:
+            if self.__indexed:
+                return
+            accessed = collections.OrderedDict()
+            for modified, identifier in found:
+                if identifier not in self.__accessed:
+                    accessed[identifier] = modified
+            accessed.update(self.__accessed)
+            self.__accessed = accessed
+            self.__indexed = True
+
+    def __ensure_directory(self, directory: str):
+        if directory not in self.__directories:
+            os.makedirs(directory, exist_ok=True)
+            self.__directories.add(directory)
+
+    def __check_layout(self):
+        # reading sessions with another fan-out would silently miss every one of them
+        layout = f"{self.__levels} {self.__fan_out}"
+        path = self.__base_path + ".layout"
+        if os.path.exists(path):
+            in_stream = open(path, "r", encoding="utf-8")
+            stored = in_stream.read().strip()
+            in_stream.close()
+            if stored != layout:
+                raise RuntimeError(f"Sessions in {self.__base_path} use the layout '{stored}', not '{layout}'")
+            return
+        out_stream = open(path, "w", encoding="utf-8")
+        out_stream.write(layout + "\n")
+        out_stream.close()
+
+    def __flat_sessions(self, limit: int) -> typing.List[int]:
+        identifiers = list()
+        for entry in os.scandir(self.__base_path):
+            identifier = entry.name[:-len(".session")]
+            if entry.name.endswith(".session") and identifier.lstrip('-').isdigit() and entry.is_file():
+                identifiers.append(int(identifier))
+                if len(identifiers) >= limit:
+                    break
+        return identifiers
+
+    def __flat_path(self, identifier: int) -> str:
+        return self.__base_path + str(identifier) + ".session"
+
+    def __lock_of(self, identifier: int) -> threading.RLock:
+        return self.__locks[identifier % self.LOCK_STRIPES]
+
+    @staticmethod
+    def __remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class MemorySessionStorage(IPersistentSessionStorage):
+    # sessions only live as long as the process, for replays and tests that must not touch the disk
+
+    def __init__(self, codec: typing.Optional[ISessionCodec] = None):
+        self.__codec = codec if codec is not None else PickleSessionCodec()
+        self.__lock = threading.Lock()
+        # encoded like on disk, so loads never share state with the committed data
+        self.__sessions: typing.Dict[int, typing.Tuple[bytes, float]] = dict()
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
 
     def load(self, identifier: int):
-        path = self.__base_path + str(identifier) + ".session"
-        if not os.path.exists(path):
+        with self.__lock:
+            entry = self.__sessions.get(identifier)
+        if entry is None:
+            return None
+        return self.__codec.decode(entry[0])
+
+    def commit(self, identifier: int, object_inst):
+        content = self.__codec.encode(object_inst)
+        with self.__lock:
+            self.__sessions[identifier] = (content, time.time())
+
+    def idle_sessions(self, idle_since: float, limit: int) -> typing.List[int]:
+        with self.__lock:
+            return [identifier for identifier, entry in self.__sessions.items() if entry[1] < idle_since][:limit]
+
+    def expire(self, identifier: int, idle_since: float):
+        with self.__lock:
+            entry = self.__sessions.get(identifier)
+            if entry is None or entry[1] >= idle_since:
+                return None
+            self.__sessions.pop(identifier)
+        return self.__codec.decode(entry[0])
+
+
+class CachedSessionStorage(IIncrementalSessionStorage, IExpiringSessionStorage, IBufferedSessionStorage):
+    # keeps recently used sessions in memory and writes committed ones back to the backend in batches
+    DEFAULT_CAPACITY = 10000
+    DEFAULT_FLUSH_INTERVAL = 1.0
+    DEFAULT_FLUSH_BATCH = 256
+
+    def __init__(self, backend: IPersistentSessionStorage):
+        self.__backend = backend
+        self.__capacity = self.DEFAULT_CAPACITY
+        self.__flush_interval = self.DEFAULT_FLUSH_INTERVAL
+        self.__flush_batch = self.DEFAULT_FLUSH_BATCH
+        self.__condition = threading.Condition()
+        self.__flush_lock = threading.Lock()
+        # a None value remembers that the backend has no session for the identifier
+        self.__entries: typing.OrderedDict[int, typing.Any] = collections.OrderedDict()
+        self.__dirty: typing.Set[int] = set()
+        # commit times of cached sessions, the backend only learns about them with the next flush
+        self.__committed: typing.Dict[int, float] = dict()
+        self.__hits = 0
+        self.__misses = 0
+        self.__flushed = 0
+        self.__closed = False
+        self.__flusher = threading.Thread(target=self.__flush_loop, name="SessionFlusher", daemon=True)
+        self.__flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def backend(self) -> IPersistentSessionStorage:
+        return self.__backend
+
+    @property
+    def capacity(self) -> int:
+        return self.__capacity
+
+    @capacity.setter
+    def capacity(self, value: int):
+        self.__capacity = value
+
+    @property
+    def flush_interval(self) -> float:
+        return self.__flush_interval
+
+    @flush_interval.setter
+    def flush_interval(self, value: float):
+        self.__flush_interval = value
+
+    @property
+    def flush_batch(self) -> int:
+        return self.__flush_batch
+
+    @flush_batch.setter
+    def flush_batch(self, value: int):
+        self.__flush_batch = value
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
+
+    @property
+    def flushed(self) -> int:
+        return self.__flushed
+
+    @property
+    def pending(self) -> int:
+        return len(self.__dirty)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def load(self, identifier: int):
+        with self.__condition:
+            if identifier in self.__entries:
+                self.__hits += 1
+                self.__entries.move_to_end(identifier)
+                return self.__copy(self.__entries[identifier])
+            self.__misses += 1
+
+        object_inst = self.__backend.load(identifier)
+        with self.__condition:
+            # a commit may have raced with the backend read, the committed data is newer
+            if identifier not in self.__entries:
+                self.__entries[identifier] = object_inst
+                self.__shrink()
+                return self.__copy(object_inst)
+            return self.__copy(self.__entries[identifier])
+
+    def commit(self, identifier: int, object_inst):
+        with self.__condition:
+            self.__entries[identifier] = self.__copy(object_inst)
+            self.__entries.move_to_end(identifier)
+            self.__dirty.add(identifier)
+            self.__committed[identifier] = time.time()
+            if len(self.__dirty) >= self.__flush_batch:
+                self.__condition.notify()
+            self.__shrink()
+
+    def commit_changes(self, identifier: int, changed: typing.Dict[str, typing.Any],
+                       removed: typing.Tuple[str, ...]) -> bool:
+        with self.__condition:
+            base = self.__entries.get(identifier)
+            if base is None:
+                # evicted since the session was loaded, or never stored, the full data is needed
+                return False
+            data = dict(base)
+            data.update(changed)
+            for key in removed:
+                data.pop(key, None)
+            self.__entries[identifier] = data
+            self.__entries.move_to_end(identifier)
+            self.__dirty.add(identifier)
+            self.__committed[identifier] = time.time()
+            if len(self.__dirty) >= self.__flush_batch:
+                self.__condition.notify()
+            return True
+
+    def idle_sessions(self, idle_since: float, limit: int) -> typing.List[int]:
+        identifiers = self.__backend.idle_sessions(idle_since, limit)
+        with self.__condition:
+            return [identifier for identifier in identifiers if self.__committed.get(identifier, 0.0) < idle_since]
+
+    def expire(self, identifier: int, idle_since: float):
+        with self.__condition:
+            if identifier in self.__dirty or self.__committed.get(identifier, 0.0) >= idle_since:
+                return None
+        # the backend checks the session again under its own lock, other sessions are served meanwhile
+        object_inst = self.__backend.expire(identifier, idle_since)
+        if object_inst is None:
             return None
+        with self.__condition:
+            if identifier in self.__dirty or self.__committed.get(identifier, 0.0) >= idle_since:
+                # committed while the backend removed it, the user is back and the next flush writes it again
+                return None
+            self.__entries.pop(identifier, None)
+            self.__committed.pop(identifier, None)
+            return object_inst
+
+    def flush(self) -> int:
+        with self.__flush_lock:
+            with self.__condition:
+                items = [(identifier, self.__entries[identifier]) for identifier in self.__dirty]
+                self.__dirty.clear()
+            if len(items) == 0:
+                return 0
+            try:
+                self.__backend.commit_many(items)
+            except Exception:
+                with self.__condition:
+                    # written again with the next flush, unless a newer commit is already queued
+                    self.__dirty.update(identifier for identifier, _ in items)
+                raise
+            with self.__condition:
+                self.__flushed += len(items)
+                self.__shrink()
+            return len(items)
+
+    def close(self):
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify()
+        self.__flusher.join()
+        self.flush()
+
+    def __flush_loop(self):
+        while True:
+            with self.__condition:
+                if not self.__closed and len(self.__dirty) < self.__flush_batch:
+                    self.__condition.wait(self.__flush_interval)
+                if self.__closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # the entries stay dirty, the next round retries them
+                time.sleep(self.__flush_interval)
+
+    def __shrink(self):
+        # only clean entries are evicted, dirty ones wait until they are flushed
+        while len(self.__entries) > self.__capacity:
+            victim = None
+            for identifier in self.__entries:
+                if identifier not in self.__dirty:
+                    victim = identifier
+                    break
+            if victim is None:
+                return
+            self.__entries.pop(victim)
+            self.__committed.pop(victim, None)
+
+    @staticmethod
+    def __copy(object_inst):
+        # sessions mutate the dict they loaded, the cached one must stay what was committed
+        if isinstance(object_inst, dict):
+            return dict(object_inst)
+        return object_inst
+
+
+class SqliteSessionStorage(IPersistentSessionStorage, IBufferedSessionStorage):
+    # commits are grouped, every transaction writes whatever was committed since the previous one
+    SCHEMA = "CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)"
+    INDEX = "CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)"
+    SELECT = "SELECT data FROM sessions WHERE id = ?"
+    SELECT_IDLE = "SELECT id FROM sessions WHERE updated < ? LIMIT ?"
+    SELECT_UPDATED = "SELECT data, updated FROM sessions WHERE id = ?"
+    DELETE = "DELETE FROM sessions WHERE id = ?"
+    UPSERT = "INSERT OR REPLACE INTO sessions (id, data, updated) VALUES (?, ?, ?)"
+    DEFAULT_BATCH_INTERVAL = 0.05
+    DEFAULT_BATCH_SIZE = 512
+
+    def __init__(self, path: str = "sessions.db", codec: typing.Optional[ISessionCodec] = None):
+        self.__path = path
+        self.__codec = codec if codec is not None else PickleSessionCodec()
+        self.__batch_interval = self.DEFAULT_BATCH_INTERVAL
+        self.__batch_size = self.DEFAULT_BATCH_SIZE
+        self.__local = threading.local()
+        self.__condition = threading.Condition()
+        self.__pending: typing.Dict[int, bytes] = dict()
+        self.__transactions = 0
+        self.__closed = False
+
+        self.__writer = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__writer.execute("PRAGMA journal_mode=WAL")
+        # with WAL a transaction is durable on checkpoint, syncing every commit buys little
+        self.__writer.execute("PRAGMA synchronous=NORMAL")
+        self.__writer.execute(self.SCHEMA)
+        self.__writer.execute(self.INDEX)
+        self.__writer_lock = threading.Lock()
+        self.__flusher = threading.Thread(target=self.__flush_loop, name="SqliteSessionWriter", daemon=True)
+        self.__flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def transactions(self) -> int:
+        return self.__transactions
+
+    def load(self, identifier: int):
+        with self.__condition:
+            content = self.__pending.get(identifier)
+        if content is None:
+            row = self.__reader().execute(self.SELECT, (identifier,)).fetchone()
+            if row is None:
+                return None
+            content = row[0]
+        return self.__codec.decode(content)
+
+    def commit(self, identifier: int, object_inst):
+        content = self.__codec.encode(object_inst)
+        with self.__condition:
+            self.__pending[identifier] = content
+            if len(self.__pending) >= self.__batch_size:
+                self.__condition.notify()
+
+    def idle_sessions(self, idle_since: float, limit: int) -> typing.List[int]:
+        rows = self.__reader().execute(self.SELECT_IDLE, (idle_since, limit)).fetchall()
+        with self.__condition:
+            # queued commits are newer than what the table says
+            return [row[0] for row in rows if row[0] not in self.__pending]
+
+    def expire(self, identifier: int, idle_since: float):
+        with self.__condition:
+            if identifier in self.__pending:
+                return None
+        with self.__writer_lock:
+            # a commit written meanwhile carries a newer time, so checking and deleting in one lock is enough
+            row = self.__writer.execute(self.SELECT_UPDATED, (identifier,)).fetchone()
+            if row is None or row[1] >= idle_since:
+                return None
+            self.__writer.execute(self.DELETE, (identifier,))
+        return self.__codec.decode(row[0])
+
+    def commit_many(self, items: typing.List[typing.Tuple[int, typing.Any]]):
+        self.write([(identifier, self.__codec.encode(object_inst)) for identifier, object_inst in items])
+
+    def write(self, rows: typing.List[typing.Tuple[int, bytes]]):
+        if len(rows) == 0:
+            return
+        updated = time.time()
+        with self.__writer_lock:
+            self.__writer.execute("BEGIN")
+            try:
+                self.__writer.executemany(self.UPSERT, [(identifier, content, updated) for identifier, content in rows])
+                self.__writer.execute("COMMIT")
+            except Exception:
+                self.__writer.execute("ROLLBACK")
+                raise
+            self.__transactions += 1
+
+    def flush(self):
+        with self.__condition:
+            rows = list(self.__pending.items())
+        self.write(rows)
+        with self.__condition:
+            # entries committed again while writing stay pending with their newer content
+            for identifier, content in rows:
+                if self.__pending.get(identifier) is content:
+                    self.__pending.pop(identifier)
+
+    def close(self):
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify()
+        self.__flusher.join()
+        self.flush()
+        with self.__writer_lock:
+            self.__writer.close()
+
+    def __flush_loop(self):
+        while True:
+            with self.__condition:
+                if not self.__closed and len(self.__pending) < self.__batch_size:
+                    self.__condition.wait(self.__batch_interval)
+                if self.__closed:
+                    return
+                if len(self.__pending) == 0:
+                    continue
+            try:
+                self.flush()
+            except sqlite3.Error:
+                time.sleep(self.__batch_interval)
 
+    def __reader(self) -> sqlite3.Connection:
+        # sqlite connections are not shared between threads, WAL lets every reader have its own
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path)
+            self.__local.connection = connection
+        return connection
+
+
+class LogSessionStorage(IPersistentSessionStorage):
+    # sessions are appended to segment files, the index keeps where the latest record of every user starts
+    # a record without payload is a tombstone, it marks an expired session
+    HEADER = struct.Struct("<qdII")
+    DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+    DEFAULT_COMPACT_INTERVAL = 30.0
+    DEFAULT_COMPACT_RATIO = 0.5
+
+    def __init__(self, base_path: str = "sessions-log/", codec: typing.Optional[ISessionCodec] = None):
+        self.__base_path = base_path
+        self.__codec = codec if codec is not None else PickleSessionCodec()
+        self.__segment_size = self.DEFAULT_SEGMENT_SIZE
+        self.__compact_interval = self.DEFAULT_COMPACT_INTERVAL
+        self.__compact_ratio = self.DEFAULT_COMPACT_RATIO
+        self.__lock = threading.RLock()
+        self.__index: typing.Dict[int, typing.Tuple[int, int, int, float]] = dict()
+        self.__tombstones: typing.Dict[int, typing.Set[int]] = dict()
+        self.__live_bytes: typing.Dict[int, int] = dict()
+        self.__sizes: typing.Dict[int, int] = dict()
+        self.__maps: typing.Dict[int, mmap.mmap] = dict()
+        self.__compactions = 0
+        self.__closed = threading.Event()
+
+        if not os.path.exists(base_path):
+            os.makedirs(base_path)
+        for segment in self.__segments():
+            self.__recover(segment)
+        self.__active = max(self.__sizes.keys(), default=0)
+        if self.__active == 0 or self.__sizes[self.__active] >= self.__segment_size:
+            self.__active += 1
+        self.__active_fd = self.__open_active()
+
+        self.__compactor = threading.Thread(target=self.__compact_loop, name="LogSessionCompactor", daemon=True)
+        self.__compactor.start()
+        atexit.register(self.close)
+
+    @property
+    def base_path(self) -> str:
+        return self.__base_path
+
+    @property
+    def segment_size(self) -> int:
+        return self.__segment_size
+
+    @segment_size.setter
+    def segment_size(self, value: int):
+        self.__segment_size = value
+
+    @property
+    def sessions(self) -> int:
+        return len(self.__index)
+
+    @property
+    def segments(self) -> typing.List[int]:
+        with self.__lock:
+            return sorted(self.__sizes.keys())
+
+    @property
+    def compactions(self) -> int:
+        return self.__compactions
+
+    def load(self, identifier: int):
+        with self.__lock:
+            location = self.__index.get(identifier)
+            if location is None:
+                return None
+            segment, offset, length, _ = location
+            mapped = self.__map(segment, offset + length)
+        # the record is decoded straight from the mapping, a retired segment stays mapped until this returns
+        return self.__decode(mapped, offset, length)
+
+    def commit(self, identifier: int, object_inst):
+        self.commit_many([(identifier, object_inst)])
+
+    def commit_many(self, items: typing.List[typing.Tuple[int, typing.Any]]):
+        updated = time.time()
+        records = [(identifier, self.__codec.encode(object_inst), updated) for identifier, object_inst in items]
+        with self.__lock:
+            self.__append(records)
+
+    def idle_sessions(self, idle_since: float, limit: int) -> typing.List[int]:
+        identifiers = list()
+        with self.__lock:
+            for identifier, location in self.__index.items():
+                if location[3] < idle_since:
+                    identifiers.append(identifier)
+                    if len(identifiers) >= limit:
+                        break
+        return identifiers
+
+    def expire(self, identifier: int, idle_since: float):
+        with self.__lock:
+            location = self.__index.get(identifier)
+            if location is None or location[3] >= idle_since:
+                return None
+            segment, offset, length, _ = location
+            object_inst = self.__decode(self.__map(segment, offset + length), offset, length)
+            self.__append([(identifier, b"", time.time())])
+            return object_inst
+
+    def compact(self) -> int:
+        # sealed segments that are mostly overwritten get their live records appended again and are removed
+        with self.__lock:
+            candidates = [segment for segment in self.__sizes.keys() if segment != self.__active
+                          and self.__live_bytes.get(segment, 0) < self.__sizes[segment] * self.__compact_ratio]
+        for segment in candidates:
+            self.__compact_segment(segment)
+        return len(candidates)
+
+    def close(self):
+        with self.__lock:
+            if self.__closed.is_set():
+                return
+            self.__closed.set()
+            os.close(self.__active_fd)
+            for mapped in self.__maps.values():
+                mapped.close()
+            self.__maps.clear()
+        self.__compactor.join()
+
+    def __append(self, records: typing.List[typing.Tuple[int, bytes, float]]):
+        if self.__closed.is_set():
+            raise RuntimeError(f"Session log {self.__base_path} is closed")
+        if self.__sizes[self.__active] >= self.__segment_size:
+            self.__rotate()
+
+        chunks = list()
+        offset = self.__sizes[self.__active]
+        for identifier, content, updated in records:
+            chunks.append(self.HEADER.pack(identifier, updated, len(content), zlib.crc32(content)))
+            chunks.append(content)
+            length = self.HEADER.size + len(content)
+            self.__index_record(identifier, self.__active, offset, length, updated)
+            offset += length
+        # one write per batch, a crash leaves at most a torn tail that recovery cuts off
+        os.write(self.__active_fd, b"".join(chunks))
+        self.__sizes[self.__active] = offset
+
+    def __index_record(self, identifier: int, segment: int, offset: int, length: int, updated: float):
+        previous = self.__index.get(identifier)
+        if previous is not None:
+            self.__live_bytes[previous[0]] -= previous[2]
+        if length == self.HEADER.size:
+            self.__index.pop(identifier, None)
+            self.__tombstones.setdefault(segment, set()).add(identifier)
+            return
+        self.__index[identifier] = (segment, offset, length, updated)
+        self.__live_bytes[segment] = self.__live_bytes.get(segment, 0) + length
+
+    def __decode(self, mapped: mmap.mmap, offset: int, length: int):
+        with memoryview(mapped) as view:
+            with view[offset + self.HEADER.size:offset + length] as payload:
+                return self.__codec.decode(payload)
+
+    def __rotate(self):
+        os.close(self.__active_fd)
+        self.__active += 1
+        self.__active_fd = self.__open_active()
+
+    def __open_active(self) -> int:
+        self.__sizes.setdefault(self.__active, 0)
+        self.__live_bytes.setdefault(self.__active, 0)
+        return os.open(self.__segment_path(self.__active), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __map(self, segment: int, end: int) -> mmap.mmap:
+        mapped = self.__maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            # the active segment grows, its mapping is renewed once a record lies past the mapped end
+            in_stream = open(self.__segment_path(segment), "rb")
+            mapped = mmap.mmap(in_stream.fileno(), 0, access=mmap.ACCESS_READ)
+            in_stream.close()
+            self.__maps[segment] = mapped
+        return mapped
+
+    def __compact_segment(self, segment: int):
+        with self.__lock:
+            if self.__closed.is_set() or segment not in self.__sizes:
+                return
+            records = list()
+            live = [(identifier, location) for identifier, location in self.__index.items() if location[0] == segment]
+            if len(live) != 0:
+                mapped = self.__map(segment, self.__sizes[segment])
+                for identifier, (_, offset, length, updated) in live:
+                    records.append((identifier, mapped[offset + self.HEADER.size:offset + length], updated))
+            if min(self.__sizes.keys()) < segment:
+                # an older segment may still hold a record the tombstone hides, so the tombstone has to survive
+                for identifier in self.__tombstones.get(segment, ()):
+                    if identifier not in self.__index:
+                        records.append((identifier, b"", time.time()))
+            if len(records) != 0:
+                self.__append(records)
+            self.__sizes.pop(segment)
+            self.__live_bytes.pop(segment, None)
+            self.__tombstones.pop(segment, None)
+            # readers that already hold the mapping keep it alive, unlinking does not invalidate it
+            self.__maps.pop(segment, None)
+            os.remove(self.__segment_path(segment))
+            self.__compactions += 1
+
+    def __compact_loop(self):
+        while not self.__closed.wait(self.__compact_interval):
+            try:
+                self.compact()
+            except (OSError, RuntimeError):
+                pass
+
+    def __recover(self, segment: int):
+        path = self.__segment_path(segment)
         in_stream = open(path, "rb")
         content = in_stream.read()
         in_stream.close()
-        object_inst = pickle.loads(content)
-        return object_inst
+
+        offset = 0
+        while offset + self.HEADER.size <= len(content):
+            identifier, updated, size, checksum = self.HEADER.unpack_from(content, offset)
+            end = offset + self.HEADER.size + size
+            if end > len(content) or zlib.crc32(content[offset + self.HEADER.size:end]) != checksum:
+                break
+            self.__index_record(identifier, segment, offset, end - offset, updated)
+            offset = end
+        if offset != len(content):
+            os.truncate(path, offset)
+        self.__sizes[segment] = offset
+        self.__live_bytes.setdefault(segment, 0)
+
+    def __segments(self) -> typing.List[int]:
+        segments = list()
+        for name in os.listdir(self.__base_path):
+            if name.endswith(".segment") and name[:-len(".segment")].isdigit():
+                segments.append(int(name[:-len(".segment")]))
+        return sorted(segments)
+
+    def __segment_path(self, segment: int) -> str:
+        return f"{self.__base_path}{segment:08d}.segment"
+
+
+def import_file_sessions(storage: IPersistentSessionStorage, base_path: str = "sessions/",
+                         batch_size: int = 500, codec: typing.Optional[ISessionCodec] = None) -> int:
+    # copies every <id>.session file of the flat or the sharded layout into the given storage, the files stay
+    if codec is None:
+        # reads both pickled files and files written by the compact codec, the files are trusted here
+        codec = CompactSessionCodec(legacy_pickle=True)
+    if not os.path.exists(base_path):
+        return 0
+    imported = 0
+    batch = list()
+    # the walk visits flat files before the shards, so a session caught mid-migration ends with its sharded copy
+    for directory, _, names in os.walk(base_path):
+        for name in names:
+            identifier = name[:-len(".session")]
+            if not name.endswith(".session") or not identifier.lstrip('-').isdigit():
+                continue
+            in_stream = open(os.path.join(directory, name), "rb")
+            content = in_stream.read()
+            in_stream.close()
+            batch.append((int(identifier), codec.decode(content)))
+            if len(batch) >= batch_size:
+                storage.commit_many(batch)
+                imported += len(batch)
+                batch = list()
+    if len(batch) != 0:
+        storage.commit_many(batch)
+        imported += len(batch)
+    return imported
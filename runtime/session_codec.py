@@ -0,0 +1,242 @@
+import abc
+import pickle
+import struct
+import typing
+
+
+class ISessionCodec(abc.ABC):
+
+    @abc.abstractmethod
+    def encode(self, object_inst) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, content: typing.Union[bytes, memoryview]):
+        pass
+
+
+class PickleSessionCodec(ISessionCodec):
+
+    def __init__(self):
+        self.__compact: typing.Optional[CompactSessionCodec] = None
+
+    def encode(self, object_inst) -> bytes:
+        return pickle.dumps(object_inst)
+
+    def decode(self, content: typing.Union[bytes, memoryview]):
+        # sessions written by the compact codec stay readable, no pickle starts with its magic
+        if content[:2] == _MAGIC:
+            if self.__compact is None:
+                self.__compact = CompactSessionCodec()
+            return self.__compact.decode(content)
+        return pickle.loads(content)
+
+
+# the position of a string is its code in the format, new entries may only be appended
+WELL_KNOWN_STRINGS = (
+    "__current_command__", "__current_state__", "__stage__", "__prop_index__", "__mode__", "__holding__",
+    "__command__", "__redir__", "__add_text__", "__message_id__", "__model__", "__property__",
+    "init", "edit", "prop_set", "send", "cancel", "review", "back", "show_hint", "enter_val", "ask", "yes", "no",
+    "manual", "auto",
+)
+
+PROPERTY_PREFIX = "__property_"
+
+_MAGIC = b"\xc5\x01"
+_NONE = 0x00
+_FALSE = 0x01
+_TRUE = 0x02
+_INT8 = 0x03
+_INT32 = 0x04
+_INT64 = 0x05
+_BIG_INT = 0x06
+_FLOAT = 0x07
+_SHORT_STR = 0x08
+_STR = 0x09
+_WELL_KNOWN = 0x0a
+_PROPERTY = 0x0b
+_BYTES = 0x0c
+_LIST = 0x0d
+_TUPLE = 0x0e
+_DICT = 0x0f
+
+# integers are packed together with their tag
+_INT8_STRUCT = struct.Struct("<Bb")
+_INT32_STRUCT = struct.Struct("<Bi")
+_INT64_STRUCT = struct.Struct("<Bq")
+_FLOAT_STRUCT = struct.Struct("<d")
+_LENGTH_STRUCT = struct.Struct("<I")
+
+
+class CompactSessionCodec(ISessionCodec):
+    # a tagged binary format that only knows plain data, decoding never constructs arbitrary objects
+    # it is less than half the size of pickle but, being pure python, several times slower per call,
+    # so startup keeps pickle and a bot opts in once its sessions were rewritten by migrate_sessions.py
+    KEY_CACHE_SIZE = 4096
+
+    def __init__(self, legacy_pickle: bool = False):
+        # reading pickled sessions runs whatever they contain, only the one-off migration of old files allows it
+        self.__legacy_pickle = legacy_pickle
+        self.__well_known = {value: bytes((_WELL_KNOWN, index)) for index, value in enumerate(WELL_KNOWN_STRINGS)}
+        # dict keys repeat across sessions, their encoding is looked up instead of rebuilt
+        self.__keys: typing.Dict[str, bytes] = dict(self.__well_known)
+
+    @property
+    def legacy_pickle(self) -> bool:
+        return self.__legacy_pickle
+
+    def encode(self, object_inst) -> bytes:
+        parts = [_MAGIC]
+        self.__encode(object_inst, parts)
+        return b"".join(parts)
+
+    def decode(self, content: typing.Union[bytes, memoryview]):
+        if content[:2] != _MAGIC:
+            if self.__legacy_pickle:
+                return pickle.loads(content)
+            raise ValueError("Session content is not in the compact session format")
+        value, position = self.__decode(content, 2)
+        if position != len(content):
+            raise ValueError(f"Session content has {len(content) - position} trailing bytes")
+        return value
+
+    def __encode(self, value, parts: typing.List[bytes]):
+        value_type = type(value)
+        if value_type is str:
+            encoded = self.__well_known.get(value)
+            parts.append(encoded if encoded is not None else self.__encode_str(value))
+        elif value_type is int:
+            parts.append(self.__encode_int(value))
+        elif value_type is bool:
+            parts.append(b"\x02" if value else b"\x01")
+        elif value is None:
+            parts.append(b"\x00")
+        elif value_type is dict:
+            keys = self.__keys
+            parts.append(b"\x0f" + _LENGTH_STRUCT.pack(len(value)))
+            well_known = self.__well_known
+            for key, item in value.items():
+                encoded = keys.get(key) if type(key) is str else None
+                if encoded is None:
+                    encoded = self.__encode_key(key)
+                parts.append(encoded)
+                # flat sessions hold strings and small numbers, those skip the recursive call
+                item_type = type(item)
+                if item_type is str:
+                    encoded = well_known.get(item)
+                    parts.append(encoded if encoded is not None else self.__encode_str(item))
+                elif item_type is int:
+                    parts.append(self.__encode_int(item))
+                else:
+                    self.__encode(item, parts)
+        elif value_type is float:
+            parts.append(b"\x07" + _FLOAT_STRUCT.pack(value))
+        elif value_type is list or value_type is tuple:
+            parts.append((b"\x0d" if value_type is list else b"\x0e") + _LENGTH_STRUCT.pack(len(value)))
+            for item in value:
+                self.__encode(item, parts)
+        elif value_type is bytes:
+            parts.append(b"\x0c" + _LENGTH_STRUCT.pack(len(value)) + value)
+        else:
+            raise TypeError(f"Session values of type {value_type.__name__} can not be encoded")
+
+    def __encode_key(self, key) -> bytes:
+        parts = list()
+        self.__encode(key, parts)
+        encoded = b"".join(parts)
+        if type(key) is str and len(self.__keys) < self.KEY_CACHE_SIZE:
+            self.__keys[key] = encoded
+        return encoded
+
+    @staticmethod
+    def __encode_str(value: str) -> bytes:
+        prefix = b""
+        if value.startswith(PROPERTY_PREFIX):
+            prefix = b"\x0b"
+            value = value[len(PROPERTY_PREFIX):]
+        content = value.encode("utf-8")
+        if len(content) < 0x100:
+            return prefix + bytes((_SHORT_STR, len(content))) + content
+        return prefix + b"\x09" + _LENGTH_STRUCT.pack(len(content)) + content
+
+    @staticmethod
+    def __encode_int(value: int) -> bytes:
+        if -0x80 <= value < 0x80:
+            return _INT8_STRUCT.pack(_INT8, value)
+        if -0x80000000 <= value < 0x80000000:
+            return _INT32_STRUCT.pack(_INT32, value)
+        if -0x8000000000000000 <= value < 0x8000000000000000:
+            return _INT64_STRUCT.pack(_INT64, value)
+        content = value.to_bytes((value.bit_length() + 8) // 8, "little", signed=True)
+        return b"\x06" + _LENGTH_STRUCT.pack(len(content)) + content
+
+    def __decode(self, content: typing.Union[bytes, memoryview], position: int) -> typing.Tuple[typing.Any, int]:
+        tag = content[position]
+        position += 1
+        if tag == _WELL_KNOWN:
+            return WELL_KNOWN_STRINGS[content[position]], position + 1
+        if tag == _SHORT_STR:
+            end = position + 1 + content[position]
+            return str(content[position + 1:end], "utf-8"), end
+        if tag == _INT8:
+            return _INT8_STRUCT.unpack_from(content, position - 1)[1], position + 1
+        if tag == _DICT:
+            length = _LENGTH_STRUCT.unpack_from(content, position)[0]
+            position += 4
+            value = dict()
+            for _ in range(length):
+                key_tag = content[position]
+                if key_tag == _WELL_KNOWN:
+                    key = WELL_KNOWN_STRINGS[content[position + 1]]
+                    position += 2
+                elif key_tag == _PROPERTY and content[position + 1] == _SHORT_STR:
+                    end = position + 3 + content[position + 2]
+                    key = PROPERTY_PREFIX + str(content[position + 3:end], "utf-8")
+                    position = end
+                else:
+                    key, position = self.__decode(content, position)
+                item_tag = content[position]
+                if item_tag == _WELL_KNOWN:
+                    value[key] = WELL_KNOWN_STRINGS[content[position + 1]]
+                    position += 2
+                elif item_tag == _SHORT_STR:
+                    end = position + 2 + content[position + 1]
+                    value[key] = str(content[position + 2:end], "utf-8")
+                    position = end
+                elif item_tag == _INT8:
+                    value[key] = _INT8_STRUCT.unpack_from(content, position)[1]
+                    position += 2
+                else:
+                    value[key], position = self.__decode(content, position)
+            return value, position
+        if tag == _NONE:
+            return None, position
+        if tag == _FALSE:
+            return False, position
+        if tag == _TRUE:
+            return True, position
+        if tag == _INT32:
+            return _INT32_STRUCT.unpack_from(content, position - 1)[1], position + 4
+        if tag == _INT64:
+            return _INT64_STRUCT.unpack_from(content, position - 1)[1], position + 8
+        if tag == _FLOAT:
+            return _FLOAT_STRUCT.unpack_from(content, position)[0], position + 8
+        if tag == _PROPERTY:
+            value, position = self.__decode(content, position)
+            return PROPERTY_PREFIX + value, position
+
+        length = _LENGTH_STRUCT.unpack_from(content, position)[0]
+        position += 4
+        if tag == _STR:
+            return str(content[position:position + length], "utf-8"), position + length
+        if tag == _BYTES:
+            return bytes(content[position:position + length]), position + length
+        if tag == _BIG_INT:
+            return int.from_bytes(content[position:position + length], "little", signed=True), position + length
+        if tag == _LIST or tag == _TUPLE:
+            items = list()
+            for _ in range(length):
+                item, position = self.__decode(content, position)
+                items.append(item)
+            return (items if tag == _LIST else tuple(items)), position
+        raise ValueError(f"Unknown session value tag {tag} at {position - 5}")
@@ -0,0 +1,189 @@
+import collections
+import json
+import os
+import threading
+import time
+import typing
+
+
+class Span:
+
+    def __init__(self, name: str, category: str, update_id: typing.Optional[int], user_id: typing.Optional[int],
+                 start: float, duration: float, thread_id: int):
+        self.__name = name
+        self.__category = category
+        self.__update_id = update_id
+        self.__user_id = user_id
+        self.__start = start
+        self.__duration = duration
+        self.__thread_id = thread_id
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def category(self) -> str:
+        return self.__category
+
+    @property
+    def update_id(self) -> typing.Optional[int]:
+        return self.__update_id
+
+    @property
+    def user_id(self) -> typing.Optional[int]:
+        return self.__user_id
+
+    @property
+    def start(self) -> float:
+        return self.__start
+
+    @property
+    def duration(self) -> float:
+        return self.__duration
+
+    @property
+    def thread_id(self) -> int:
+        return self.__thread_id
+
+
+class ActiveSpan:
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, update_id: typing.Optional[int],
+                 user_id: typing.Optional[int]):
+        self.__tracer = tracer
+        self.__name = name
+        self.__category = category
+        self.__update_id = update_id
+        self.__user_id = user_id
+        self.__start = 0.0
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__tracer.record(self.__name, self.__category, self.__update_id, self.__user_id, self.__start,
+                             time.perf_counter() - self.__start)
+        return False
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    # finished spans are kept in a ring buffer, so a long running bot only holds the most recent ones
+
+    def __init__(self, capacity: int = 100000, enabled: bool = True):
+        self.__spans: typing.Deque[Span] = collections.deque(maxlen=capacity)
+        self.__enabled = enabled
+        self.__origin = time.perf_counter()
+        self.__origin_wall = time.time()
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    @enabled.setter
+    def enabled(self, value: bool):
+        self.__enabled = value
+
+    @property
+    def spans(self) -> typing.List[Span]:
+        return list(self.__spans)
+
+    def clear(self):
+        self.__spans.clear()
+
+    def record(self, name: str, category: str, update_id: typing.Optional[int], user_id: typing.Optional[int],
+               start: float, duration: float):
+        # deque.append is atomic, workers record without a lock
+        self.__spans.append(Span(name, category, update_id, user_id, start, duration, threading.get_ident()))
+
+    def span(self, name: str, category: str, update_id: typing.Optional[int] = None,
+             user_id: typing.Optional[int] = None):
+        if not self.__enabled:
+            return NULL_SPAN
+        return ActiveSpan(self, name, category, update_id, user_id)
+
+    def wrap(self, name: str, category: str, invoker: typing.Callable):
+        # the span covers the rest of the chain as well, trace viewers show the self time of each middleware
+        def invoke(context):
+            if not self.__enabled:
+                return invoker(context)
+            start = time.perf_counter()
+            try:
+                return invoker(context)
+            finally:
+                self.record(name, category, context.bot_request.update_id, context.user.id, start,
+                            time.perf_counter() - start)
+        return invoke
+
+    def wrap_async(self, name: str, category: str, invoker: typing.Callable):
+        async def invoke(context):
+            if not self.__enabled:
+                return await invoker(context)
+            start = time.perf_counter()
+            try:
+                return await invoker(context)
+            finally:
+                self.record(name, category, context.bot_request.update_id, context.user.id, start,
+                            time.perf_counter() - start)
+        return invoke
+
+    def chrome_trace(self) -> typing.Dict[str, typing.Any]:
+        process_id = os.getpid()
+        events = list()
+        for span in self.spans:
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start - self.__origin) * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": process_id,
+                "tid": span.thread_id,
+                "args": {"update_id": span.update_id, "user_id": span.user_id},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path: str):
+        out_stream = open(path, "w", encoding="utf-8")
+        json.dump(self.chrome_trace(), out_stream)
+        out_stream.close()
+
+    def records(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        # flat records with the opentelemetry span fields, spans of one update share a trace id
+        records = list()
+        for index, span in enumerate(self.spans):
+            start_nano = int((self.__origin_wall + span.start - self.__origin) * 1e9)
+            records.append({
+                "trace_id": format(span.update_id if span.update_id is not None else 0, "032x"),
+                "span_id": format(index + 1, "016x"),
+                "name": span.name,
+                "kind": "INTERNAL",
+                "start_time_unix_nano": start_nano,
+                "end_time_unix_nano": start_nano + int(span.duration * 1e9),
+                "attributes": {
+                    "category": span.category,
+                    "update_id": span.update_id,
+                    "user_id": span.user_id,
+                    "thread_id": span.thread_id,
+                },
+            })
+        return records
+
+    def export_records(self, path: str):
+        out_stream = open(path, "w", encoding="utf-8")
+        for record in self.records():
+            out_stream.write(json.dumps(record) + "\n")
+        out_stream.close()
@@ -0,0 +1,103 @@
+import hmac
+import http.server
+import json
+import threading
+import typing
+
+import telegram
+
+from runtime.dispatcher import UpdateDispatcher
+
+
+class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+    server: "WebhookServer"
+
+    def do_POST(self):
+        if self.path.split('?')[0] != self.server.path:
+            self.__reply(404)
+            return
+        if not self.__is_authorized():
+            self.__reply(403)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length).decode("utf-8"))
+            update = telegram.Update.de_json(data, self.server.bot)
+        except (ValueError, TypeError, KeyError):
+            self.__reply(400)
+            return
+        if update is None:
+            self.__reply(400)
+            return
+
+        # telegram only waits for the acknowledgement, the update itself is handled by the dispatcher workers
+        self.__reply(200)
+        self.server.dispatcher.dispatch(update)
+
+    def do_GET(self):
+        self.__reply(405)
+
+    def __is_authorized(self) -> bool:
+        # telegram repeats the secret given to set_webhook in every request it sends
+        if self.server.secret_token is None:
+            return True
+        token = self.headers.get(self.SECRET_TOKEN_HEADER, "")
+        return hmac.compare_digest(token.encode("utf-8"), self.server.secret_token.encode("utf-8"))
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def __reply(self, status: int):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, path: str, bot: telegram.Bot, dispatcher: UpdateDispatcher,
+                 secret_token: typing.Optional[str] = None):
+        super().__init__((host, port), WebhookRequestHandler)
+        if not path.startswith('/'):
+            path = '/' + path
+        self.__path = path
+        self.__bot = bot
+        self.__dispatcher = dispatcher
+        self.__secret_token = secret_token
+        self.__thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def bot(self) -> telegram.Bot:
+        return self.__bot
+
+    @property
+    def dispatcher(self) -> UpdateDispatcher:
+        return self.__dispatcher
+
+    @property
+    def secret_token(self) -> typing.Optional[str]:
+        return self.__secret_token
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, name="WebhookServer", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
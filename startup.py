@@ -1,11 +1,15 @@
+import os
+
 from modules.commands import Handler
 from runtime.builder import ApplicationBuilder
 from runtime.commands import ModelCommandBase
 from runtime.logging import Logger
+from runtime.metrics import MetricsRegistry
 from runtime.middleware import CommandsMiddleware, CommandsModelMiddleware, ErrorHandlerMiddleware, LoggingMiddleware
-from runtime.options import CommandsOptions
+from runtime.options import CommandsOptions, OutboundOptions, SessionExpiryOptions
 import runtime.dependency_injection
 import runtime.session
+import runtime.session_codec
 import modules.commands
 from runtime.resources import XmlResourceParser, IResourceParser, IResourceProvider, Resources
 
@@ -15,24 +19,55 @@ class Startup:
     def configure_services(self, services: runtime.dependency_injection.ServiceCollection):
         services.add_singleton(CommandsMiddleware)
         services.add_commands(self.configure_commands)
-        services.add_singleton(runtime.session.ISession, runtime.session.Session)
-        services.add_singleton(runtime.session.ISessionStorage, runtime.session.FileSessionStorage)
+        services.add_scoped(runtime.session.ISession, runtime.session.Session)
+        services.add_singleton(runtime.session.ISessionStorage, runtime.session.CachedSessionStorage)
+        services.add_singleton(runtime.session.IPersistentSessionStorage, runtime.session.FileSessionStorage)
+        services.add_singleton(runtime.session_codec.ISessionCodec, runtime.session_codec.PickleSessionCodec)
         services.add_singleton(IResourceParser, XmlResourceParser)
         services.add_singleton(CommandsModelMiddleware)
-        services.add_singleton(IResourceProvider, Resources)
+        services.add_scoped(IResourceProvider, Resources)
         services.add_scoped(ModelCommandBase)
         services.add_scoped(Handler)
         services.add_singleton(Logger)
         services.add_singleton(ErrorHandlerMiddleware)
         services.add_singleton(LoggingMiddleware)
+        services.add_singleton(MetricsRegistry)
 
     def configure(self, app_builder: ApplicationBuilder):
-        app_builder.use_bot_token("1222869042:AAGqMH0Nn5mVIHnuK6c_q_pG1FlzIgBL3tk")
+        # a bot given by the caller, e.g. the FakeBot of a replay, needs no token
+        if app_builder.bot is None:
+            app_builder.use_bot_token(self.bot_token())
         app_builder.timeout = 3000
         app_builder.updates_limit = 3
+        app_builder.max_updates_limit = 100
+        app_builder.workers = 4
         app_builder.use_middleware(LoggingMiddleware)
         app_builder.use_middleware(CommandsModelMiddleware)
         app_builder.use_commands(self.configure_commands)
+        app_builder.use_outbound_dispatcher(self.configure_outbound)
+        app_builder.use_update_journal("journal/")
+        app_builder.use_metrics_endpoint("127.0.0.1", 9100)
+        app_builder.use_session_expiry(self.configure_session_expiry)
+
+    @staticmethod
+    def bot_token() -> str:
+        token = os.environ.get("SUBOT_TOKEN", "").strip()
+        if len(token) == 0:
+            raise RuntimeError("The bot token is not configured, set the SUBOT_TOKEN environment variable")
+        return token
+
+    def configure_outbound(self):
+        options = OutboundOptions()
+        options.use_workers(4)
+        options.use_global_rate(30)
+        options.use_chat_rate(1, burst=3)
+        return options
+
+    def configure_session_expiry(self):
+        options = SessionExpiryOptions()
+        options.use_idle_timeout(7 * 24 * 3600)
+        options.use_archive("sessions-archive/")
+        return options
 
     def configure_commands(self):
         options = CommandsOptions()
@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture
+def work_path(tmp_path, monkeypatch):
+    # the runtime resolves sessions/, logs/ and journal/ against the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
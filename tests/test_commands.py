@@ -0,0 +1,136 @@
+import itertools
+
+import pytest
+import telegram
+
+from runtime.bot import BotResponse
+from runtime.commands import EditMessageMarkupResult, EditMessageResult, MessageResult, RenderCache, \
+    SendOrEditMessage, merge_message_edits, rendered_messages
+from runtime.replay import FakeBot
+
+# the render cache is shared by the whole process, every test renders into its own chat
+_chats = itertools.count(900000)
+
+
+class FailingEditBot(FakeBot):
+
+    def __init__(self, error: str):
+        super().__init__()
+        self.__error = error
+
+    def edit_message_text(self, text: str, chat_id: int = None, message_id: int = None, *args, **kwargs):
+        super().edit_message_text(text, chat_id, message_id, *args, **kwargs)
+        raise telegram.error.BadRequest(self.__error)
+
+
+def _markup(label: str) -> telegram.InlineKeyboardMarkup:
+    return telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(label, callback_data=label)]])
+
+
+def test_text_edit_then_markup_edit_merge_into_one_edit():
+    markup = _markup("next")
+    merged = merge_message_edits(EditMessageResult(1, 10, "hello", None),
+                                 EditMessageMarkupResult(1, 10, markup))
+
+    assert isinstance(merged, EditMessageResult)
+    assert merged.text == "hello"
+    assert merged.reply_markup is markup
+
+
+def test_later_text_edit_replaces_the_earlier_one():
+    markup = _markup("next")
+    merged = merge_message_edits(EditMessageMarkupResult(1, 10, markup),
+                                 EditMessageResult(1, 10, "second", None))
+
+    assert isinstance(merged, EditMessageResult)
+    assert merged.text == "second"
+    assert merged.reply_markup is None
+
+
+def test_send_or_edit_absorbs_a_following_edit():
+    markup = _markup("next")
+    merged = merge_message_edits(SendOrEditMessage(1, 10, "hello", None),
+                                 EditMessageMarkupResult(1, 10, markup))
+
+    assert isinstance(merged, SendOrEditMessage)
+    assert merged.text == "hello"
+    assert merged.reply_markup is markup
+
+
+def test_edits_of_different_messages_are_kept_apart():
+    assert merge_message_edits(EditMessageResult(1, 10, "a", None), EditMessageResult(1, 11, "b", None)) is None
+    assert merge_message_edits(EditMessageResult(1, 10, "a", None), EditMessageResult(2, 10, "b", None)) is None
+    assert merge_message_edits(MessageResult("a", 1), EditMessageResult(1, 10, "b", None)) is None
+
+
+def test_coalesce_keeps_the_order_of_unrelated_actions():
+    sent = MessageResult("hi", 1)
+    response = BotResponse()
+    response.add_action(EditMessageResult(1, 10, "first", None))
+    response.add_action(EditMessageMarkupResult(1, 10, _markup("next")))
+    response.add_action(sent)
+    response.add_action(EditMessageResult(1, 10, "last", None))
+    response.coalesce()
+
+    actions = response.actions_queue
+    assert len(actions) == 3
+    assert actions[0].text == "first" and actions[0].reply_markup is not None
+    assert actions[1] is sent
+    assert actions[2].text == "last"
+
+
+def test_unchanged_render_is_skipped():
+    chat_id = next(_chats)
+    bot = FakeBot()
+    EditMessageResult(chat_id, 10, "hello", None, _markup("next")).execute(bot)
+    EditMessageResult(chat_id, 10, "hello", None, _markup("next")).execute(bot)
+    EditMessageMarkupResult(chat_id, 10, _markup("next")).execute(bot)
+
+    assert len(bot.calls_of("edit_message_text")) == 1
+    assert len(bot.calls_of("edit_message_reply_markup")) == 0
+
+    EditMessageResult(chat_id, 10, "changed", None, _markup("next")).execute(bot)
+    assert len(bot.calls_of("edit_message_text")) == 2
+
+
+def test_sent_message_is_not_edited_to_the_same_content():
+    chat_id = next(_chats)
+    bot = FakeBot()
+    MessageResult("hello", chat_id, None).execute(bot)
+    # a fresh fake bot numbers its messages from 1
+    EditMessageResult(chat_id, 1, "hello", None).execute(bot)
+
+    assert len(bot.calls_of("edit_message_text")) == 0
+
+
+def test_message_is_not_modified_counts_as_rendered():
+    chat_id = next(_chats)
+    bot = FailingEditBot("Message is not modified: specified new message content is the same")
+    EditMessageResult(chat_id, 10, "hello", None).execute(bot)
+    EditMessageResult(chat_id, 10, "hello", None).execute(bot)
+
+    assert len(bot.calls_of("edit_message_text")) == 1
+    assert rendered_messages.is_rendered(chat_id, 10, RenderCache.text_fingerprint("hello", None),
+                                          RenderCache.markup_fingerprint(None))
+
+
+def test_real_edit_failure_forgets_the_render():
+    chat_id = next(_chats)
+    EditMessageResult(chat_id, 10, "hello", None).execute(FakeBot())
+    with pytest.raises(telegram.error.BadRequest):
+        EditMessageResult(chat_id, 10, "changed", None).execute(FailingEditBot("Message to edit not found"))
+
+    assert not rendered_messages.is_rendered(chat_id, 10, RenderCache.text_fingerprint("hello", None),
+                                              RenderCache.markup_fingerprint(None))
+
+
+def test_send_or_edit_sends_only_when_the_edit_really_fails():
+    chat_id = next(_chats)
+    bot = FailingEditBot("Message is not modified")
+    SendOrEditMessage(chat_id, 10, "hello", None).execute(bot)
+    assert len(bot.calls_of("send_message")) == 0
+
+    bot = FailingEditBot("Message to edit not found")
+    SendOrEditMessage(chat_id, 11, "hello", None).execute(bot)
+    assert len(bot.calls_of("edit_message_text")) == 1
+    assert len(bot.calls_of("send_message")) == 1
@@ -0,0 +1,248 @@
+import re
+import time
+import typing
+
+import pytest
+
+from runtime.dependency_injection import ScopePolicy, ServiceCollection, ServiceEngine
+
+
+class Clock:
+    pass
+
+
+class Draft:
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.disposed = False
+
+    def dispose(self):
+        self.disposed = True
+
+
+def _engine(scope_policy: ScopePolicy) -> ServiceEngine:
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_scoped(Draft)
+    return ServiceEngine(services.services, scope_policy)
+
+
+def test_scoped_instances_are_shared_within_a_scope():
+    engine = _engine(ScopePolicy(None, None))
+    first = engine.get_or_create_instance(Draft, 1)
+    assert engine.get_or_create_instance(Draft, 1) is first
+    assert engine.get_or_create_instance(Draft, 2) is not first
+    assert engine.get_or_create_instance(Draft, 2).clock is first.clock
+
+
+def test_least_recently_used_scope_is_evicted():
+    engine = _engine(ScopePolicy(max_scopes=2, idle_timeout=None))
+    first = engine.get_or_create_instance(Draft, 1)
+    second = engine.get_or_create_instance(Draft, 2)
+    # scope 1 is used again, scope 2 is now the oldest
+    engine.get_or_create_instance(Draft, 1)
+    engine.get_or_create_instance(Draft, 3)
+
+    assert engine.live_scopes == 2
+    assert engine.evicted_scopes == 1
+    assert second.disposed
+    assert not first.disposed
+    assert engine.get_or_create_instance(Draft, 1) is first
+    assert engine.get_or_create_instance(Draft, 2) is not second
+
+
+def test_idle_scopes_are_evicted():
+    engine = _engine(ScopePolicy(max_scopes=None, idle_timeout=0.05))
+    draft = engine.get_or_create_instance(Draft, 1)
+    assert engine.evict_idle() == 0
+
+    time.sleep(0.06)
+    assert engine.evict_idle() == 1
+    assert draft.disposed
+    assert engine.live_scopes == 0
+
+
+def test_disposed_scope_starts_over():
+    engine = _engine(ScopePolicy(None, None))
+    draft = engine.get_or_create_instance(Draft, 1)
+    assert engine.dispose_scope(1)
+    assert not engine.dispose_scope(1)
+    assert draft.disposed
+    assert engine.get_or_create_instance(Draft, 1) is not draft
+
+
+def test_invalidated_scope_is_replaced_when_the_next_request_starts():
+    engine = _engine(ScopePolicy(None, None))
+    draft = engine.get_or_create_instance(Draft, 1)
+    assert engine.invalidate_scope(1)
+    assert not engine.invalidate_scope(2)
+    # a request that is still running keeps its instances
+    assert engine.get_or_create_instance(Draft, 1) is draft
+    assert not draft.disposed
+
+    engine.renew_scope(1)
+    assert draft.disposed
+    renewed = engine.get_or_create_instance(Draft, 1)
+    assert renewed is not draft
+    engine.renew_scope(1)
+    assert engine.get_or_create_instance(Draft, 1) is renewed
+
+
+def test_private_scope_is_not_shared_with_the_user_scope():
+    engine = _engine(ScopePolicy(None, None))
+    draft = engine.get_or_create_instance(Draft, 1)
+    scope = engine.create_scope(1)
+    private = engine.get_or_create_instance(Draft, 1, scope)
+    assert private is not draft
+    assert private.clock is draft.clock
+    assert engine.get_or_create_instance(Draft, 1, scope) is private
+
+    scope.dispose()
+    assert private.disposed
+    assert not draft.disposed
+    assert engine.live_scopes == 1
+
+
+class Registry:
+
+    def __init__(self, draft: Draft):
+        self.draft = draft
+
+
+class Formatter:
+
+    def __init__(self, draft: Draft):
+        self.draft = draft
+
+
+class Renderer:
+
+    def __init__(self, formatter: Formatter):
+        self.formatter = formatter
+
+
+class Ping:
+
+    def __init__(self, pong: "Pong"):
+        self.pong = pong
+
+
+class Pong:
+
+    def __init__(self, ping: Ping):
+        self.ping = ping
+
+
+def test_singleton_cannot_capture_a_scoped_service():
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_scoped(Draft)
+    services.add_singleton(Registry)
+    with pytest.raises(RuntimeError, match="cannot depend on scoped"):
+        ServiceEngine(services.services)
+
+
+def test_singleton_cannot_capture_a_scoped_service_through_a_transient():
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_scoped(Draft)
+    services.add_transient(Formatter)
+    services.add_singleton(Renderer)
+    with pytest.raises(RuntimeError, match="cannot depend on scoped"):
+        ServiceEngine(services.services)
+
+
+def test_scoped_service_may_depend_on_a_singleton():
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_scoped(Draft)
+    services.add_scoped(Formatter)
+    engine = ServiceEngine(services.services)
+    formatter = engine.get_or_create_instance(Formatter, 1)
+    assert formatter.draft is engine.get_or_create_instance(Draft, 1)
+
+
+def test_dependency_cycle_is_rejected():
+    services = ServiceCollection()
+    services.add_transient(Ping)
+    services.add_transient(Pong)
+    with pytest.raises(RuntimeError, match="Recursive injection"):
+        ServiceEngine(services.services)
+
+
+class Greeter:
+
+    def __init__(self, clock: Clock, draft: typing.Optional[Draft], greeting: str = "hi"):
+        self.clock = clock
+        self.draft = draft
+        self.greeting = greeting
+
+
+class IClock:
+    pass
+
+
+class SystemClock(IClock):
+    pass
+
+
+class Alarm:
+
+    def __init__(self, clock: SystemClock):
+        self.clock = clock
+
+
+def test_missing_dependency_is_reported_when_the_engine_is_built():
+    services = ServiceCollection()
+    services.add_scoped(Draft)
+    message = f"Cannot resolve parameter 'clock: {Clock}' of {Draft}, the type is not registered"
+    with pytest.raises(RuntimeError, match=re.escape(message)):
+        ServiceEngine(services.services)
+
+
+def test_optional_and_default_parameters_do_not_need_a_registration():
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_transient(Greeter)
+    greeter = ServiceEngine(services.services).get_or_create_instance(Greeter, 1)
+    assert isinstance(greeter.clock, Clock)
+    assert greeter.draft is None
+    assert greeter.greeting == "hi"
+
+
+def test_optional_parameter_is_injected_when_registered():
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_scoped(Draft)
+    services.add_transient(Greeter)
+    engine = ServiceEngine(services.services)
+    assert engine.get_or_create_instance(Greeter, 1).draft is engine.get_or_create_instance(Draft, 1)
+
+
+def test_implementation_type_resolves_to_its_registration():
+    services = ServiceCollection()
+    services.add_singleton(IClock, SystemClock)
+    services.add_transient(Alarm)
+    engine = ServiceEngine(services.services)
+    assert engine.get_or_create_instance(Alarm).clock is engine.get_or_create_instance(IClock)
+
+
+def test_dependency_cycle_message_names_the_path():
+    services = ServiceCollection()
+    services.add_transient(Ping)
+    services.add_transient(Pong)
+    message = f"Recursive injection is not allowed: {Ping} -> {Pong} -> {Ping}"
+    with pytest.raises(RuntimeError, match=re.escape(message)):
+        ServiceEngine(services.services)
+
+
+def test_captive_dependency_message_names_both_types():
+    services = ServiceCollection()
+    services.add_singleton(Clock)
+    services.add_scoped(Draft)
+    services.add_transient(Formatter)
+    services.add_singleton(Renderer)
+    message = f"Singleton {Renderer} cannot depend on scoped {Draft}"
+    with pytest.raises(RuntimeError, match=re.escape(message)):
+        ServiceEngine(services.services)
@@ -0,0 +1,103 @@
+import collections
+import threading
+import time
+
+from runtime.dispatcher import OffsetTracker, UpdateDispatcher
+from runtime.replay import message_update
+
+
+def test_offset_waits_for_the_oldest_pending_update():
+    tracker = OffsetTracker(10)
+    assert tracker.begin(10)
+    assert tracker.begin(11)
+    assert tracker.begin(12)
+
+    tracker.complete(11)
+    tracker.complete(12)
+    assert tracker.offset == 10
+    tracker.complete(10)
+    assert tracker.offset == 13
+    assert tracker.pending_count == 0
+
+
+def test_redelivered_updates_are_not_begun_again():
+    tracker = OffsetTracker(5)
+    assert not tracker.begin(4)
+    assert tracker.begin(5)
+    assert not tracker.begin(5)
+    assert tracker.received == 6
+
+
+def test_retained_update_needs_one_more_complete():
+    tracker = OffsetTracker()
+    tracker.begin(1)
+    tracker.retain(1)
+
+    tracker.complete(1)
+    assert tracker.offset == 1
+    tracker.complete(1)
+    assert tracker.offset == 2
+
+
+def test_wait_for_progress_returns_once_the_offset_moves():
+    tracker = OffsetTracker()
+    tracker.begin(0)
+    threading.Timer(0.05, tracker.complete, (0,)).start()
+
+    assert tracker.wait_for_progress(0, 5.0)
+    assert tracker.offset == 1
+    assert not tracker.wait_for_progress(1, 0.01)
+
+
+def test_updates_of_one_user_are_handled_in_order():
+    handled = collections.defaultdict(list)
+    lock = threading.Lock()
+
+    def handler(update):
+        # a random pause per update would reorder them if two workers shared a user
+        time.sleep(0.001 * (update.update_id % 3))
+        with lock:
+            handled[update.effective_user.id].append(update.update_id)
+
+    tracker = OffsetTracker()
+    dispatcher = UpdateDispatcher(handler, 4, tracker)
+    dispatcher.start()
+    updates = [message_update(update_id, update_id % 7 + 1, "text") for update_id in range(200)]
+    for update in updates:
+        assert dispatcher.dispatch(update)
+    dispatcher.stop()
+
+    assert sum(len(ids) for ids in handled.values()) == len(updates)
+    for ids in handled.values():
+        assert ids == sorted(ids)
+    assert tracker.offset == 200
+
+
+def test_failed_update_is_reported_and_completed():
+    errors = list()
+
+    def handler(update):
+        raise ValueError("broken")
+
+    for workers in (0, 2):
+        tracker = OffsetTracker()
+        dispatcher = UpdateDispatcher(handler, workers, tracker, lambda update, exception: errors.append(exception))
+        dispatcher.start()
+        assert dispatcher.dispatch(message_update(0, 1, "text"))
+        dispatcher.stop()
+        assert tracker.offset == 1
+    assert len(errors) == 2
+    assert all(isinstance(error, ValueError) for error in errors)
+
+
+def test_unordered_tracker_accepts_updates_that_overtook_each_other():
+    tracker = OffsetTracker(10, ordered=False)
+    assert tracker.begin(12)
+    assert tracker.begin(11)
+    assert not tracker.begin(12)
+    assert tracker.offset == 11
+
+    tracker.complete(11)
+    tracker.complete(12)
+    assert tracker.offset == 13
+    assert tracker.received == 13
@@ -0,0 +1,100 @@
+import os
+import pickle
+import time
+
+from runtime.dependency_injection import ServiceCollection, ServiceProvider
+from runtime.expiry import SessionSweeper
+from runtime.options import SessionExpiryOptions
+from runtime.session import CachedSessionStorage, FileSessionStorage, MemorySessionStorage
+
+
+class Draft:
+
+    def __init__(self):
+        self.disposed = False
+
+    def dispose(self):
+        self.disposed = True
+
+
+def _service_provider() -> ServiceProvider:
+    services = ServiceCollection()
+    services.add_scoped(Draft)
+    service_provider = ServiceProvider()
+    service_provider.populate(services.services, services.scope_policy)
+    return service_provider
+
+
+def test_sweep_expires_idle_sessions_a_batch_at_a_time(tmp_path):
+    storage = MemorySessionStorage()
+    for identifier in (1, 2, 3):
+        storage.commit(identifier, {"__stage__": "init", "__prop_index__": identifier})
+    idle_since = time.time()
+    time.sleep(0.02)
+    storage.commit(4, {"__stage__": "init"})
+
+    options = SessionExpiryOptions()
+    options.use_idle_timeout(1.0)
+    options.use_batch_size(2)
+    options.use_archive(str(tmp_path) + "/archive/")
+    service_provider = _service_provider()
+    sweeper = SessionSweeper(storage, service_provider, options)
+    draft = service_provider.get_instance(Draft, 1)
+
+    now = idle_since + 1.0
+    assert sweeper.sweep(now) == 2
+    assert sweeper.sweep(now) == 1
+    assert sweeper.sweep(now) == 0
+    assert sweeper.expired == 3
+    assert len(storage) == 1
+    assert storage.load(4) == {"__stage__": "init"}
+    # a worker may still use the scope of an expired user, it is only replaced once the user comes back
+    assert not draft.disposed
+    service_provider.renew_scope(1)
+    assert draft.disposed
+    assert service_provider.get_instance(Draft, 1) is not draft
+
+    archived = sorted(os.listdir(str(tmp_path) + "/archive/"))
+    assert [name.split(".")[0] for name in archived] == ["1", "2", "3"]
+    with open(str(tmp_path) + "/archive/" + archived[0], "rb") as in_stream:
+        assert pickle.loads(in_stream.read()) == {"__stage__": "init", "__prop_index__": 1}
+
+
+def test_sweep_keeps_sessions_committed_to_the_cache(tmp_path):
+    backend = MemorySessionStorage()
+    backend.commit(1, {"__stage__": "init"})
+    storage = CachedSessionStorage(backend)
+    try:
+        now = time.time() + 1.0
+        # the backend still has the old commit time, the cache knows the user is back
+        storage.commit(1, {"__stage__": "edit"})
+        options = SessionExpiryOptions()
+        options.use_idle_timeout(0.5)
+        assert SessionSweeper(storage, _service_provider(), options).sweep(now) == 0
+        assert storage.load(1) == {"__stage__": "edit"}
+    finally:
+        storage.close()
+
+
+def test_file_index_orders_sessions_by_their_last_commit(tmp_path):
+    base_path = str(tmp_path / "sessions") + "/"
+    storage = FileSessionStorage(base_path=base_path, fsync=False)
+    for identifier in (1, 2, 3):
+        storage.commit(identifier, {"__prop_index__": identifier})
+    started = time.time()
+    # sessions written by an earlier run are only known by their file time
+    for age, identifier in ((300, 1), (200, 2), (100, 3)):
+        os.utime(storage.path_of(identifier), (started - age, started - age))
+    storage = FileSessionStorage(base_path=base_path, fsync=False)
+
+    assert storage.idle_sessions(started - 50, 10) == [1, 2, 3]
+    assert storage.idle_sessions(started - 150, 10) == [1, 2]
+    assert storage.idle_sessions(started - 50, 1) == [1]
+
+    storage.commit(1, {"__prop_index__": 10})
+    assert storage.idle_sessions(started - 50, 10) == [2, 3]
+    assert storage.expire(1, started - 50) is None
+    assert storage.expire(2, started - 50) == {"__prop_index__": 2}
+    assert not os.path.exists(storage.path_of(2))
+    assert storage.idle_sessions(started - 50, 10) == [3]
+    assert storage.expire(2, started - 50) is None
@@ -0,0 +1,101 @@
+import os
+import time
+
+from runtime.dispatcher import OffsetTracker
+from runtime.journal import UpdateJournal
+from runtime.pipeline import CheckpointDaemon, OffsetCommitter
+from runtime.replay import message_update
+
+
+def _journal(work_path, **kwargs) -> UpdateJournal:
+    return UpdateJournal(str(work_path) + "/journal/", sync_interval=0.0, **kwargs)
+
+
+def test_finished_updates_survive_a_restart(work_path):
+    journal = _journal(work_path)
+    for update_id in range(1, 6):
+        journal.received(message_update(update_id, 1, "text"))
+    journal.done(message_update(3, 1, "text"))
+    journal.failed(message_update(4, 1, "text"), RuntimeError("broken"))
+    journal.checkpoint(2)
+    journal.close()
+
+    journal = _journal(work_path)
+    assert journal.offset == 2
+    assert journal.is_finished(3)
+    assert journal.is_finished(4)
+    assert not journal.is_finished(2)
+    assert not journal.is_finished(5)
+    # only updates that never got a status are handled again
+    assert [update.update_id for update in journal.read(statuses=(UpdateJournal.RECEIVED,), from_update_id=2)] == [2, 5]
+    journal.close()
+
+
+def test_torn_tail_record_is_ignored(work_path):
+    journal = _journal(work_path)
+    journal.received(message_update(1, 1, "text"))
+    journal.done(message_update(1, 1, "text"))
+    journal.close()
+    with open(str(work_path) + "/journal/updates.log", "a", encoding="utf-8") as out_stream:
+        out_stream.write('{"id": 2, "status": "do')
+
+    journal = _journal(work_path)
+    assert journal.is_finished(1)
+    assert [update.update_id for update in journal.read()] == [1]
+    # records appended after the recovery do not merge with the torn line
+    journal.received(message_update(3, 1, "text"))
+    journal.done(message_update(3, 1, "text"))
+    journal.close()
+
+    journal = _journal(work_path)
+    assert journal.is_finished(3)
+    assert [update.update_id for update in journal.read()] == [1, 3]
+    journal.close()
+
+
+def test_compaction_keeps_records_past_the_checkpoint(work_path):
+    journal = _journal(work_path, compact_records=6)
+    for update_id in range(1, 5):
+        journal.received(message_update(update_id, 1, "text"))
+        journal.done(message_update(update_id, 1, "text"))
+    journal.checkpoint(3)
+    assert journal.compact_due
+
+    journal.compact()
+    assert not journal.compact_due
+    assert [update.update_id for update in journal.read()] == [3, 4]
+    with open(str(work_path) + "/journal/updates.log", "r", encoding="utf-8") as in_stream:
+        assert len(in_stream.readlines()) == 4
+
+    # the log is still appended to after compaction
+    journal.received(message_update(5, 1, "text"))
+    assert [update.update_id for update in journal.read()] == [3, 4, 5]
+    journal.close()
+    journal.compact()
+    assert os.path.exists(str(work_path) + "/journal/updates.log")
+
+
+def test_checkpoint_daemon_follows_the_tracker(work_path):
+    journal = _journal(work_path, compact_records=4)
+    tracker = OffsetTracker(journal.offset, ordered=False)
+    daemon = CheckpointDaemon(tracker, OffsetCommitter(tracker.offset, journal), 0.01)
+    daemon.start()
+    for update_id in (2, 1, 3):
+        tracker.begin(update_id)
+        journal.received(message_update(update_id, 1, "text"))
+    for update_id in (1, 2):
+        journal.done(message_update(update_id, 1, "text"))
+        tracker.complete(update_id)
+    deadline = time.monotonic() + 5.0
+    while journal.offset != 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert journal.offset == 3
+
+    journal.done(message_update(3, 1, "text"))
+    tracker.complete(3)
+    daemon.stop()
+    assert journal.offset == 4
+    # the log was compacted once the checkpoint passed the first two updates
+    with open(str(work_path) + "/journal/updates.log", "r", encoding="utf-8") as in_stream:
+        assert len(in_stream.readlines()) < 6
+    journal.close()
@@ -0,0 +1,135 @@
+import threading
+import typing
+
+import telegram.error
+
+from runtime.commands import CommandResult
+from runtime.options import OutboundOptions
+from runtime.outbound import OutboundDispatcher
+
+
+class FastOutboundDispatcher(OutboundDispatcher):
+    BACKOFF_BASE = 0.001
+
+
+class ScriptedResult(CommandResult):
+    # raises the given errors on the first attempts, then succeeds
+
+    def __init__(self, chat_id: int, errors: typing.List[Exception] = ()):
+        self.__chat_id = chat_id
+        self.__errors = list(errors)
+        self.attempts = 0
+        self.sent = threading.Event()
+
+    @property
+    def chat_id(self) -> int:
+        return self.__chat_id
+
+    def execute(self, bot):
+        self.attempts += 1
+        if len(self.__errors) != 0:
+            raise self.__errors.pop(0)
+        self.sent.set()
+
+
+def _dispatcher(max_retries: int = 3) -> OutboundDispatcher:
+    options = OutboundOptions()
+    options.use_workers(2)
+    options.use_global_rate(10000)
+    options.use_chat_rate(10000, burst=100)
+    options.use_max_retries(max_retries)
+    dispatcher = FastOutboundDispatcher(None, options)
+    dispatcher.start()
+    return dispatcher
+
+
+def test_transient_errors_are_retried():
+    dispatcher = _dispatcher()
+    result = ScriptedResult(1, [telegram.error.RetryAfter(0.01), telegram.error.NetworkError("timed out")])
+    dispatcher.submit(result)
+    dispatcher.stop(5.0)
+
+    assert result.sent.is_set()
+    assert result.attempts == 3
+    assert dispatcher.retried == 2
+    assert dispatcher.sent == 1
+    assert dispatcher.dropped == 0
+
+
+def test_bad_request_is_dropped_without_retry():
+    dispatcher = _dispatcher()
+    result = ScriptedResult(1, [telegram.error.BadRequest("message is not modified")])
+    following = ScriptedResult(1)
+    dispatcher.submit(result)
+    dispatcher.submit(following)
+    dispatcher.stop(5.0)
+
+    assert result.attempts == 1
+    assert dispatcher.dropped == 1
+    # a dropped action does not hold back the rest of the chat
+    assert following.sent.is_set()
+    assert dispatcher.queue_depth == 0
+
+
+def test_action_is_dropped_after_max_retries():
+    dispatcher = _dispatcher(max_retries=2)
+    result = ScriptedResult(1, [telegram.error.NetworkError("timed out")] * 5)
+    dispatcher.submit(result)
+    dispatcher.stop(5.0)
+
+    assert result.attempts == 3
+    assert not result.sent.is_set()
+    assert dispatcher.retried == 2
+    assert dispatcher.dropped == 1
+
+
+def test_actions_of_one_chat_keep_their_order():
+    order = list()
+
+    class OrderedResult(ScriptedResult):
+        def __init__(self, chat_id: int, index: int, errors=()):
+            super().__init__(chat_id, errors)
+            self.index = index
+
+        def execute(self, bot):
+            super().execute(bot)
+            order.append((self.chat_id, self.index))
+
+    dispatcher = _dispatcher()
+    for index in range(20):
+        errors = [telegram.error.NetworkError("timed out")] if index % 5 == 0 else []
+        dispatcher.submit(OrderedResult(index % 2, index, errors))
+    dispatcher.stop(5.0)
+
+    for chat_id in (0, 1):
+        indexes = [index for chat, index in order if chat == chat_id]
+        assert indexes == sorted(indexes)
+        assert len(indexes) == 10
+
+
+def test_delivery_callback_waits_for_every_action_of_the_update():
+    delivered = threading.Event()
+    dispatcher = _dispatcher()
+    blocked = threading.Event()
+
+    class BlockingResult(ScriptedResult):
+        def execute(self, bot):
+            blocked.wait(5.0)
+            super().execute(bot)
+
+    first = BlockingResult(1)
+    second = ScriptedResult(2, [telegram.error.BadRequest("chat not found")])
+    dispatcher.submit(first, 7)
+    dispatcher.submit(second, 7)
+    dispatcher.when_delivered(7, delivered.set)
+    assert not delivered.is_set()
+
+    blocked.set()
+    assert delivered.wait(5.0)
+    assert first.sent.is_set()
+    dispatcher.stop(5.0)
+
+    # nothing queued for the update, the callback runs right away
+    called = list()
+    dispatcher.when_delivered(8, lambda: called.append(8))
+    assert called == [8]
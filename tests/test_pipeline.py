@@ -0,0 +1,96 @@
+import typing
+
+from runtime.bot import BotRequest, BotResponse
+from runtime.context import Context
+from runtime.dependency_injection import ServiceCollection, ServiceProvider
+from runtime.middleware import Middleware
+from runtime.options import Options
+from runtime.pipeline import CompiledPipeline
+from runtime.tracing import Tracer
+from runtime.user import User
+
+
+class Journal:
+
+    def __init__(self):
+        self.entries: typing.List[typing.Tuple[str, int, int]] = list()
+
+
+class AuthMiddleware(Middleware):
+
+    def __init__(self, journal: Journal):
+        super().__init__()
+        self.__journal = journal
+
+    def invoke(self, context: Context):
+        self.__journal.entries.append(("auth", context.user.id, context.bot_request.update_id))
+        self.invoke_next(context)
+
+
+class DraftMiddleware(Middleware):
+    configured = 0
+
+    def __init__(self, journal: Journal):
+        super().__init__()
+        self.__journal = journal
+        self.options: typing.Optional[Options] = None
+
+    def configure(self, options: Options):
+        DraftMiddleware.configured += 1
+        self.options = options
+
+    def invoke(self, context: Context):
+        self.__journal.entries.append(("draft", context.user.id, context.bot_request.update_id))
+        self.invoke_next(context)
+
+
+class ReplyMiddleware(Middleware):
+
+    def __init__(self, journal: Journal):
+        super().__init__()
+        self.__journal = journal
+
+    def invoke(self, context: Context):
+        self.__journal.entries.append(("reply", context.user.id, context.bot_request.update_id))
+
+
+def _context(services: ServiceProvider, user_id: int, update_id: int) -> Context:
+    context = Context()
+    context.user = User()
+    context.user.id = user_id
+    context.bot_request = BotRequest()
+    context.bot_request.update_id = update_id
+    context.bot_response = BotResponse()
+    context.services = services
+    return context
+
+
+def test_scoped_middleware_is_configured_once_per_scope_and_keeps_the_order():
+    DraftMiddleware.configured = 0
+    services = ServiceCollection()
+    services.add_singleton(Journal)
+    services.add_singleton(AuthMiddleware)
+    services.add_scoped(DraftMiddleware)
+    services.add_singleton(ReplyMiddleware)
+    provider = ServiceProvider()
+    provider.populate(services.services, services.scope_policy)
+    tracer = Tracer()
+    pipeline = CompiledPipeline(((AuthMiddleware, None), (DraftMiddleware, Options), (ReplyMiddleware, None)),
+                                services, provider, tracer)
+
+    pipeline.invoke(_context(provider, 1, 10))
+    pipeline.invoke(_context(provider, 1, 11))
+    pipeline.invoke(_context(provider, 2, 12))
+
+    assert DraftMiddleware.configured == 2
+    assert provider.get_instance(DraftMiddleware, 1) is not provider.get_instance(DraftMiddleware, 2)
+    assert provider.get_instance(DraftMiddleware, 1).options is not None
+    assert provider.get_instance(Journal).entries == [
+        ("auth", 1, 10), ("draft", 1, 10), ("reply", 1, 10),
+        ("auth", 1, 11), ("draft", 1, 11), ("reply", 1, 11),
+        ("auth", 2, 12), ("draft", 2, 12), ("reply", 2, 12),
+    ]
+    assert len(pipeline.invokers) == 3
+    # every middleware gets a span per update, the outer spans enclose the inner ones
+    assert [span.name for span in tracer.spans if span.update_id == 12] == \
+        ["ReplyMiddleware", "DraftMiddleware", "AuthMiddleware"]
@@ -0,0 +1,30 @@
+from runtime.polling import AdaptivePoller
+from runtime.replay import FakeBot, message_update
+
+
+def test_backlog_does_not_count_redelivered_updates():
+    bot = FakeBot([message_update(update_id, 1, "text") for update_id in range(1, 11)])
+    poller = AdaptivePoller(bot, 10, 100, 0)
+
+    # updates 1-4 were received before and are still in progress, telegram delivers them again
+    updates = poller.poll(1, pending=4, received=5)
+    assert len(updates) == 10
+    assert poller.statistics.last_backlog == 10
+
+
+def test_batch_size_follows_the_backlog():
+    bot = FakeBot([message_update(update_id, 1, "text") for update_id in range(1, 301)])
+    poller = AdaptivePoller(bot, 10, 100, 30)
+
+    updates = poller.poll(1)
+    assert len(updates) == 10
+    assert poller.limit == 20
+    assert poller.timeout == 0
+
+    offset = updates[-1].update_id + 1
+    while len(updates) != 0:
+        updates = poller.poll(offset)
+        if len(updates) != 0:
+            offset = updates[-1].update_id + 1
+    assert poller.timeout == 30
+    assert poller.statistics.received == 300
@@ -0,0 +1,77 @@
+import typing
+
+import pytest
+
+from runtime.resources import (IResourceEntry, IResourceParser, ResourceIndex, Resources, StringArrayResourceEntry,
+                               StringResourceEntry)
+
+
+def _string(name: str, data: str) -> StringResourceEntry:
+    entry = StringResourceEntry()
+    entry.name = name
+    entry.data = data
+    return entry
+
+
+def _string_array(name: str, data: typing.List[str]) -> StringArrayResourceEntry:
+    entry = StringArrayResourceEntry()
+    entry.name = name
+    entry.data = data
+    return entry
+
+
+class FakeResourceParser(IResourceParser):
+    # keyed like the files strings.xml, strings-ru.xml and strings-ru-RU.xml
+
+    def __init__(self):
+        self.parsed = 0
+
+    def parse_strings(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
+        self.parsed += 1
+        return {
+            "": [_string("hello", "Hello"), _string("bye", "Bye"), _string("help", "Help"),
+                 _string_array("yes_no", ["Yes", "No"])],
+            "-ru": [_string("hello", "Привет"), _string("bye", "Пока"), _string("hello", "duplicate")],
+            "-ru-RU": [_string("hello", "Здравствуйте")],
+        }
+
+    def parse_models(self) -> typing.Dict[str, typing.List[IResourceEntry]]:
+        return dict()
+
+
+def test_fallback_chain():
+    assert ResourceIndex.fallback_chain("ru-RU") == ("ru-ru", "ru", "")
+    assert ResourceIndex.fallback_chain(" pt_BR ") == ("pt-br", "pt", "")
+    assert ResourceIndex.fallback_chain("en") == ("en", "")
+    assert ResourceIndex.fallback_chain(None) == ("",)
+
+
+def test_most_specific_locale_wins():
+    resources = Resources(FakeResourceParser())
+    resources.configuration = "ru-RU"
+    assert resources.get_string("hello") == "Здравствуйте"
+    assert resources.get_string("bye") == "Пока"
+    assert resources.get_string("help") == "Help"
+    assert resources.get_string_array("yes_no") == ("Yes", "No")
+
+    resources.configuration = "ru"
+    # the first entry of a name wins within a locale
+    assert resources.get_string("hello") == "Привет"
+    resources.configuration = "de-AT"
+    assert resources.get_string("hello") == "Hello"
+    resources.configuration = None
+    assert resources.get_string("bye") == "Bye"
+    with pytest.raises(RuntimeError):
+        resources.get_string("missing")
+
+
+def test_resources_of_one_parser_share_the_index():
+    parser = FakeResourceParser()
+    first = Resources(parser)
+    second = Resources(parser)
+    first.configuration = "ru"
+    second.configuration = "ru-ru"
+    assert first.get_string("hello") == "Привет"
+    assert second.get_string("hello") == "Здравствуйте"
+    assert parser.parsed == 1
+    assert ResourceIndex.of(parser) is ResourceIndex.of(parser)
@@ -0,0 +1,117 @@
+import typing
+
+from runtime.session import CachedSessionStorage, ISessionStorage, MemorySessionStorage, Session
+
+
+class RecordingStorage(ISessionStorage):
+
+    def __init__(self):
+        self.sessions: typing.Dict[int, dict] = dict()
+        self.commits = 0
+        self.loads = 0
+
+    def commit(self, identifier: int, object_inst):
+        self.commits += 1
+        self.sessions[identifier] = dict(object_inst)
+
+    def load(self, identifier: int):
+        self.loads += 1
+        return dict(self.sessions[identifier]) if identifier in self.sessions else None
+
+
+def _session(storage: ISessionStorage, identifier: int = 1) -> Session:
+    session = Session(storage)
+    session.id = identifier
+    session.load()
+    return session
+
+
+def test_unchanged_session_is_not_committed():
+    storage = RecordingStorage()
+    storage.sessions[1] = {"__stage__": "init", "__prop_index__": 0}
+    session = _session(storage)
+
+    assert not session.dirty
+    session["__stage__"] = "init"
+    session["__prop_index__"] = 0
+    session.remove("missing")
+    assert not session.dirty
+    session.commit()
+    assert storage.commits == 0
+
+
+def test_value_of_another_type_marks_the_session_dirty():
+    storage = RecordingStorage()
+    storage.sessions[1] = {"__prop_index__": 1}
+    session = _session(storage)
+
+    session["__prop_index__"] = True
+    assert session.dirty
+    session.commit()
+    assert storage.sessions[1]["__prop_index__"] is True
+    assert not session.dirty
+
+
+def test_remove_and_clear_are_committed():
+    storage = RecordingStorage()
+    storage.sessions[1] = {"__stage__": "init", "__mode__": "edit"}
+    session = _session(storage)
+
+    session.remove("__mode__")
+    assert session.dirty
+    session.commit()
+    assert storage.sessions[1] == {"__stage__": "init"}
+
+    session.clear()
+    assert session.dirty
+    session.commit()
+    assert storage.sessions[1] == {}
+    # clearing an empty session changes nothing
+    session.clear()
+    assert not session.dirty
+
+
+def test_clean_session_is_not_loaded_again():
+    storage = RecordingStorage()
+    session = _session(storage)
+    session.load()
+    assert storage.loads == 1
+
+    session.id = 2
+    session.load()
+    assert storage.loads == 2
+    assert session.loaded
+
+
+def test_incremental_commit_merges_changes_into_the_cached_session():
+    backend = MemorySessionStorage()
+    backend.commit(1, {"__stage__": "init", "__mode__": "edit", "__property_name__": "old"})
+    storage = CachedSessionStorage(backend)
+    try:
+        session = _session(storage)
+        session["__property_name__"] = "new"
+        session.remove("__mode__")
+        session.commit()
+
+        assert storage.pending == 1
+        # the backend only sees the merged session once it is flushed
+        assert backend.load(1)["__property_name__"] == "old"
+        assert storage.flush() == 1
+        assert backend.load(1) == {"__stage__": "init", "__property_name__": "new"}
+    finally:
+        storage.close()
+
+
+def test_incremental_commit_falls_back_to_the_full_session():
+    backend = MemorySessionStorage()
+    storage = CachedSessionStorage(backend)
+    storage.capacity = 0
+    try:
+        session = _session(storage)
+        session["__stage__"] = "init"
+        # the empty session was evicted from the cache, the whole session is written
+        session.commit()
+        storage.flush()
+        assert backend.load(1) == {"__stage__": "init"}
+    finally:
+        storage.close()
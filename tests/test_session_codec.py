@@ -0,0 +1,76 @@
+import os
+import pickle
+
+import pytest
+
+from runtime.dependency_injection import ServiceCollection
+from runtime.session import FileSessionStorage
+from runtime.session_codec import CompactSessionCodec, ISessionCodec, PickleSessionCodec
+from startup import Startup
+
+
+SESSION = {
+    "__current_command__": "profile",
+    "__stage__": "prop_set",
+    "__prop_index__": 3,
+    "__property_name__": "Ann",
+    "__property_bio__": "x" * 300,
+    "__property_age__": 2 ** 40,
+    "__property_huge__": -2 ** 80,
+    "__property_score__": 1.5,
+    "__property_active__": True,
+    "__property_blocked__": False,
+    "__property_note__": None,
+    "__property_tags__": ["a", "б", 70000],
+    "__property_pair__": (1, -129),
+    "__property_raw__": b"\x00\x01",
+    "__property_nested__": {"init": {1: "send"}},
+    "custom": "auto",
+}
+
+
+def test_compact_codec_round_trip():
+    codec = CompactSessionCodec()
+    content = codec.encode(SESSION)
+    decoded = codec.decode(content)
+
+    assert decoded == SESSION
+    assert [type(value) for value in decoded.values()] == [type(value) for value in SESSION.values()]
+    assert len(content) < len(PickleSessionCodec().encode(SESSION))
+    # keys come from the cache on the next call, the output stays the same
+    assert codec.encode(SESSION) == content
+    assert CompactSessionCodec().decode(memoryview(content)) == SESSION
+
+
+def test_compact_codec_refuses_pickle_by_default():
+    content = pickle.dumps({"__stage__": "init"})
+    with pytest.raises(ValueError):
+        CompactSessionCodec().decode(content)
+    assert CompactSessionCodec(legacy_pickle=True).decode(content) == {"__stage__": "init"}
+
+
+def test_compact_codec_rejects_what_it_can_not_represent():
+    codec = CompactSessionCodec()
+    with pytest.raises(TypeError):
+        codec.encode({"__stage__": object()})
+    with pytest.raises(ValueError):
+        codec.decode(codec.encode({"__stage__": "init"}) + b"\x00")
+
+
+def test_pickle_codec_reads_sessions_written_by_the_compact_codec():
+    codec = PickleSessionCodec()
+    assert codec.decode(CompactSessionCodec().encode(SESSION)) == SESSION
+    assert codec.decode(codec.encode(SESSION)) == SESSION
+
+
+def test_startup_keeps_reading_pickled_sessions(tmp_path):
+    services = ServiceCollection()
+    Startup().configure_services(services)
+    codec_type = services.get_service(ISessionCodec).implementation_type
+    base_path = str(tmp_path / "sessions") + "/"
+    os.makedirs(base_path)
+    with open(base_path + "7.session", "wb") as out_stream:
+        out_stream.write(pickle.dumps({"__stage__": "init"}))
+
+    storage = FileSessionStorage(codec_type(), base_path, fsync=False)
+    assert storage.load(7) == {"__stage__": "init"}
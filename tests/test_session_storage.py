@@ -0,0 +1,164 @@
+import os
+import pickle
+import time
+
+import pytest
+
+from runtime.session import FileSessionStorage, LogSessionStorage, SqliteSessionStorage
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    storage = SqliteSessionStorage(str(tmp_path / "sessions.db"))
+    yield storage
+    storage.close()
+
+
+def test_sqlite_queued_commit_is_read_back_before_it_is_written(sqlite_storage):
+    sqlite_storage.commit(1, {"__stage__": "init"})
+    assert sqlite_storage.load(1) == {"__stage__": "init"}
+    assert sqlite_storage.load(2) is None
+
+    sqlite_storage.flush()
+    sqlite_storage.commit(1, {"__stage__": "edit"})
+    assert sqlite_storage.load(1) == {"__stage__": "edit"}
+
+
+def test_sqlite_commits_survive_reopening(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    storage = SqliteSessionStorage(path)
+    storage.commit_many([(identifier, {"__prop_index__": identifier}) for identifier in range(10)])
+    storage.commit(10, {"__prop_index__": 10})
+    storage.close()
+    # closing twice is harmless, atexit calls it again
+    storage.close()
+
+    storage = SqliteSessionStorage(path)
+    assert [storage.load(identifier)["__prop_index__"] for identifier in range(11)] == list(range(11))
+    storage.close()
+
+
+def test_sqlite_expires_idle_sessions_only(sqlite_storage):
+    sqlite_storage.commit_many([(1, {"__stage__": "init"}), (2, {"__stage__": "edit"})])
+    idle_since = time.time() + 1.0
+    sqlite_storage.commit(2, {"__stage__": "review"})
+
+    # session 2 has a queued commit, it is newer than what the table says
+    assert sqlite_storage.idle_sessions(idle_since, 10) == [1]
+    assert sqlite_storage.expire(2, idle_since) is None
+    assert sqlite_storage.expire(1, idle_since) == {"__stage__": "init"}
+    assert sqlite_storage.load(1) is None
+    assert sqlite_storage.expire(1, idle_since) is None
+
+    sqlite_storage.flush()
+    assert sqlite_storage.expire(2, time.time() - 60.0) is None
+    assert sqlite_storage.load(2) == {"__stage__": "review"}
+
+
+def test_log_recovers_sessions_and_cuts_a_torn_tail(tmp_path):
+    base_path = str(tmp_path / "sessions-log") + "/"
+    storage = LogSessionStorage(base_path)
+    storage.commit_many([(1, {"__stage__": "init"}), (2, {"__stage__": "edit"})])
+    storage.commit(1, {"__stage__": "review"})
+    storage.close()
+    segment_path = base_path + "00000001.segment"
+    size = os.path.getsize(segment_path)
+    with open(segment_path, "ab") as out_stream:
+        out_stream.write(LogSessionStorage.HEADER.pack(3, time.time(), 100, 0) + b"torn")
+
+    storage = LogSessionStorage(base_path)
+    assert os.path.getsize(segment_path) == size
+    assert storage.sessions == 2
+    assert storage.load(1) == {"__stage__": "review"}
+    assert storage.load(3) is None
+    # new records follow the last complete one
+    storage.commit(3, {"__stage__": "init"})
+    storage.close()
+    storage = LogSessionStorage(base_path)
+    assert storage.load(3) == {"__stage__": "init"}
+    storage.close()
+
+
+def test_log_tombstone_hides_an_expired_session_after_reopening(tmp_path):
+    base_path = str(tmp_path / "sessions-log") + "/"
+    storage = LogSessionStorage(base_path)
+    storage.commit_many([(1, {"__stage__": "init"}), (2, {"__stage__": "edit"})])
+    idle_since = time.time() + 1.0
+    assert storage.idle_sessions(idle_since, 10) == [1, 2]
+    assert storage.expire(1, idle_since) == {"__stage__": "init"}
+    assert storage.expire(1, idle_since) is None
+    assert storage.expire(2, time.time() - 60.0) is None
+    storage.close()
+
+    storage = LogSessionStorage(base_path)
+    assert storage.load(1) is None
+    assert storage.idle_sessions(idle_since, 10) == [2]
+    storage.close()
+
+
+def test_log_compaction_moves_live_records_and_keeps_tombstones(tmp_path):
+    base_path = str(tmp_path / "sessions-log") + "/"
+    storage = LogSessionStorage(base_path)
+    storage.segment_size = 256
+    for round_index in range(4):
+        storage.commit_many([(identifier, {"__prop_index__": round_index}) for identifier in range(1, 6)])
+    storage.commit(6, {"__stage__": "init"})
+    storage.expire(6, time.time() + 1.0)
+    storage.commit(7, {"__stage__": "init"})
+    segments = storage.segments
+    assert len(segments) > 2
+
+    assert storage.compact() != 0
+    assert storage.compactions != 0
+    assert len(storage.segments) < len(segments)
+    assert [storage.load(identifier)["__prop_index__"] for identifier in range(1, 6)] == [3] * 5
+    assert storage.load(6) is None
+    storage.close()
+
+    storage = LogSessionStorage(base_path)
+    assert [storage.load(identifier)["__prop_index__"] for identifier in range(1, 6)] == [3] * 5
+    assert storage.load(6) is None
+    assert storage.load(7) == {"__stage__": "init"}
+    storage.close()
+
+
+def test_file_sessions_are_sharded(tmp_path):
+    base_path = str(tmp_path / "sessions") + "/"
+    storage = FileSessionStorage(base_path=base_path, levels=2, fan_out=16, fsync=False)
+    storage.commit(42, {"__stage__": "init"})
+
+    path = storage.path_of(42)
+    assert path.startswith(base_path) and path.endswith("/42.session")
+    assert len(os.path.relpath(path, base_path).split(os.sep)) == 3
+    assert os.path.exists(path)
+    assert storage.load(42) == {"__stage__": "init"}
+    assert storage.load(43) is None
+
+
+def test_flat_sessions_are_migrated_into_their_shard(tmp_path):
+    base_path = str(tmp_path / "sessions") + "/"
+    os.makedirs(base_path)
+    for identifier in (0, 1, 2):
+        with open(base_path + str(identifier) + ".session", "wb") as out_stream:
+            out_stream.write(pickle.dumps({"__prop_index__": identifier}))
+
+    storage = FileSessionStorage(base_path=base_path, fsync=False)
+    # lookups fall back to the flat files until the migration is done
+    assert storage.load(0) == {"__prop_index__": 0}
+    storage.commit(1, {"__prop_index__": 10})
+    deadline = time.monotonic() + 5.0
+    while storage.migrating and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert not storage.migrating
+    assert not any(name.endswith(".session") for name in os.listdir(base_path))
+    assert [storage.load(identifier)["__prop_index__"] for identifier in (0, 1, 2)] == [0, 10, 2]
+
+
+def test_file_sessions_refuse_another_layout(tmp_path):
+    base_path = str(tmp_path / "sessions") + "/"
+    FileSessionStorage(base_path=base_path, levels=2, fan_out=16, fsync=False).commit(1, {"__stage__": "init"})
+    with pytest.raises(RuntimeError, match="layout"):
+        FileSessionStorage(base_path=base_path, levels=2, fan_out=256, fsync=False)
+    with pytest.raises(RuntimeError):
+        FileSessionStorage(base_path=base_path, levels=1, fan_out=1, fsync=False)
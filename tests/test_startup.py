@@ -0,0 +1,29 @@
+import pytest
+
+from runtime.builder import ApplicationBuilder
+from runtime.replay import ReplayRunner, message_update
+from startup import Startup
+
+
+def test_bot_token_is_required(monkeypatch):
+    monkeypatch.delenv("SUBOT_TOKEN", raising=False)
+    with pytest.raises(RuntimeError, match="SUBOT_TOKEN"):
+        Startup().configure(ApplicationBuilder())
+    monkeypatch.setenv("SUBOT_TOKEN", "  ")
+    with pytest.raises(RuntimeError, match="SUBOT_TOKEN"):
+        Startup().configure(ApplicationBuilder())
+
+
+def test_bot_token_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv("SUBOT_TOKEN", "123456:test-token")
+    app_builder = ApplicationBuilder()
+    Startup().configure(app_builder)
+    assert app_builder.bot.token == "123456:test-token"
+
+
+def test_replay_needs_no_bot_token(monkeypatch):
+    monkeypatch.delenv("SUBOT_TOKEN", raising=False)
+    runner = ReplayRunner(Startup(), [message_update(1, 1, "/start")])
+    report = runner.run()
+    assert report.count == 1
+    assert len(runner.bot.calls) != 0
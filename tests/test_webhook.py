@@ -0,0 +1,74 @@
+import json
+import queue
+import typing
+import urllib.error
+import urllib.request
+
+import pytest
+
+from runtime.dispatcher import UpdateDispatcher
+from runtime.replay import FakeBot, message_update
+from runtime.webhook import WebhookRequestHandler, WebhookServer
+
+
+@pytest.fixture
+def webhook():
+    handled: queue.Queue = queue.Queue()
+    server = WebhookServer("127.0.0.1", 0, "/hook", FakeBot(), UpdateDispatcher(handled.put), secret_token="s3cret")
+    server.start()
+    yield server, handled
+    server.stop()
+
+
+def _post(server: WebhookServer, path: str, body: bytes, secret_token: typing.Optional[str] = None) -> int:
+    request = urllib.request.Request("http://127.0.0.1:" + str(server.port) + path, data=body, method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret_token is not None:
+        request.add_header(WebhookRequestHandler.SECRET_TOKEN_HEADER, secret_token)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def _recorded_update(update_id: int) -> bytes:
+    return json.dumps(message_update(update_id, 42, "/start").to_dict()).encode("utf-8")
+
+
+def test_posted_update_is_dispatched(webhook):
+    server, handled = webhook
+    assert _post(server, "/hook", _recorded_update(7), "s3cret") == 200
+
+    update = handled.get(timeout=5)
+    assert update.update_id == 7
+    assert update.effective_user.id == 42
+    assert update.message.text == "/start"
+
+
+def test_wrong_or_missing_secret_token_is_rejected(webhook):
+    server, handled = webhook
+    assert _post(server, "/hook", _recorded_update(7), "guess") == 403
+    assert _post(server, "/hook", _recorded_update(8)) == 403
+
+    assert _post(server, "/hook", _recorded_update(9), "s3cret") == 200
+    assert handled.get(timeout=5).update_id == 9
+    assert handled.empty()
+
+
+def test_unknown_path_and_malformed_body_are_rejected(webhook):
+    server, handled = webhook
+    assert _post(server, "/other", _recorded_update(7), "s3cret") == 404
+    assert _post(server, "/hook", b"not json", "s3cret") == 400
+    assert handled.empty()
+
+
+def test_server_without_secret_token_accepts_any_request():
+    handled: queue.Queue = queue.Queue()
+    server = WebhookServer("127.0.0.1", 0, "hook", FakeBot(), UpdateDispatcher(handled.put))
+    server.start()
+    try:
+        assert _post(server, "/hook", _recorded_update(7)) == 200
+        assert handled.get(timeout=5).update_id == 7
+    finally:
+        server.stop()